@@ -1,3 +1,126 @@
+"""
+Админка для больших таблиц.
+
+Списки не считают точный COUNT(*) по всей таблице (show_full_result_count
+= False, EstimatedCountPaginator), связанные объекты подгружаются одним
+JOIN (list_select_related), а поля-ссылки на большие таблицы - поле ID
+или автодополнение вместо выпадающего списка всех строк. Сортировка -
+только по первичному ключу и уникальным полям. Обращения и сообщения
+показываются из основной базы (шард default).
+"""
+import json
+
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .models import Message, Ticket, VKGroup, VKUserSummary
+
+# Оценка меньше этого числа строк перепроверяется точным COUNT(*)
+EXACT_COUNT_LIMIT = 10000
+
+
+def estimated_count(queryset):
+    """
+    Оценка числа строк по статистике PostgreSQL: без фильтров - pg_class.reltuples,
+    с фильтрами - оценка плана EXPLAIN. -1, если таблица еще не анализировалась
+    """
+    connection = connections[queryset.db]
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+            return row[0] if row else -1
+        sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator с оценкой числа строк для больших выборок в PostgreSQL, для малых - точный счет"""
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if connections[queryset.db].vendor == 'postgresql':
+            estimate = estimated_count(queryset)
+            if estimate >= EXACT_COUNT_LIMIT:
+                return estimate
+        return queryset.count()
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+
+@admin.register(VKGroup)
+class VKGroupAdmin(admin.ModelAdmin):
+    list_display = ['group_id', 'name', 'is_active', 'shard']
+    list_filter = ['is_active']
+    search_fields = ['=group_id', 'name']
+    readonly_fields = ['shard_moving_from']
+
+
+class MessageInline(admin.TabularInline):
+    model = Message
+    fields = ['created_at', 'is_admin', 'admin_author', 'text', 'is_read']
+    readonly_fields = ['created_at']
+    raw_id_fields = ['admin_author']
+    extra = 0
+    show_change_link = True
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('admin_author')
+
+
+@admin.register(Ticket)
+class TicketAdmin(LargeTableAdmin):
+    list_display = ['ticket_id', 'subject', 'user_name', 'status', 'priority', 'vk_group', 'admin',
+                    'waiting_since', 'updated_at']
+    list_select_related = ['vk_group', 'admin']
+    # Индекс (status, priority) и индекс внешнего ключа группы
+    list_filter = ['status', 'priority', 'vk_group']
+    # Точный поиск по уникальному номеру и по индексу (user_id, created_at)
+    search_fields = ['=ticket_id', '=user_id']
+    ordering = ['-id']
+    sortable_by = ['ticket_id']
+    autocomplete_fields = ['vk_group', 'admin']
+    readonly_fields = ['created_at', 'updated_at', 'first_response_at']
+    inlines = [MessageInline]
+
+
+@admin.register(Message)
+class MessageAdmin(LargeTableAdmin):
+    list_display = ['id', 'ticket', 'short_text', 'is_admin', 'admin_author', 'is_read', 'created_at']
+    list_select_related = ['ticket', 'admin_author']
+    # Частые значения: страница набирается обходом первичного ключа без сортировки
+    list_filter = ['is_admin', 'is_read']
+    # Поиск через уникальный индекс номера обращения
+    search_fields = ['=ticket__ticket_id']
+    ordering = ['-id']
+    sortable_by = ['id']
+    raw_id_fields = ['ticket']
+    autocomplete_fields = ['admin_author']
+    readonly_fields = ['created_at']
+
+    @admin.display(description='Текст')
+    def short_text(self, message):
+        return message.text[:80]
+
 
-# Register your models here.
+@admin.register(VKUserSummary)
+class VKUserSummaryAdmin(LargeTableAdmin):
+    list_display = ['user_id', 'user_name', 'ticket_count', 'open_ticket_id', 'last_contact_at']
+    # Поиск по уникальному индексу; сводки ведет прием сообщений (rebuild_user_summaries)
+    search_fields = ['=user_id']
+    ordering = ['-id']
+    sortable_by = ['user_id']
@@ -0,0 +1,136 @@
+"""
+Допуск запросов Callback API до разбора и обработки.
+
+Дешевые проверки идут первыми: размер тела (по Content-Length, до чтения;
+запросы без него отклоняются, чтобы не читать тело неизвестной длины),
+разбор JSON, известная группа и секретный ключ - и только после них запрос
+логируется и передается обработчику, поэтому поток мусорных запросов не
+стоит столько же, сколько настоящие события. Пока обработка событий
+перегружена (в очереди больше SHED_QUEUE_DEPTH событий или самое старое
+ждет дольше SHED_LATENCY секунд; без очереди - среднее время обработки
+callback больше SHED_LATENCY), события типов не из PRIORITY_TYPES
+подтверждаются VK без обработки. Отказы считаются в кэше по причинам
+(rejection_counts), их показывает consume_events --stats.
+"""
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from .models import InboundEvent, VKGroup
+
+REJECT_REASONS = ('no_length', 'too_large', 'invalid_json', 'unknown_group', 'invalid_secret', 'shed')
+
+
+def get_admission_settings():
+    options = {
+        # Запросы с телом больше этого отклоняются до чтения, байты
+        'MAX_BODY_BYTES': 64 * 1024,
+        # Типы событий, которые обрабатываются и при перегрузке
+        'PRIORITY_TYPES': ['message_new'],
+        # Перегрузка: событий в очереди больше SHED_QUEUE_DEPTH (None - не проверять)
+        'SHED_QUEUE_DEPTH': 10000,
+        # или задержка обработки больше SHED_LATENCY секунд (None - не проверять)
+        'SHED_LATENCY': 10,
+        # Как часто перепроверять нагрузку, секунды
+        'LOAD_CHECK_INTERVAL': 2,
+        # Как часто перечитывать список групп, секунды
+        'GROUPS_REFRESH_INTERVAL': 60,
+    }
+    options.update(getattr(settings, 'SERVICEDESK_ADMISSION', {}))
+    return options
+
+
+def count_rejection(reason):
+    """Учитывает отказ в общем для процессов счетчике"""
+    key = f'servicedesk:callback_rejected:{reason}'
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def rejection_counts():
+    """{причина: число отказов} с момента очистки кэша"""
+    values = cache.get_many([f'servicedesk:callback_rejected:{reason}' for reason in REJECT_REASONS])
+    return {reason: values.get(f'servicedesk:callback_rejected:{reason}', 0) for reason in REJECT_REASONS}
+
+
+def content_length(request):
+    """Размер тела по заголовку Content-Length, без чтения тела; None, если заголовка нет или он испорчен"""
+    try:
+        length = int(request.META['CONTENT_LENGTH'])
+    except (KeyError, ValueError):
+        return None
+    return length if length >= 0 else None
+
+
+# Идентификаторы групп, перечитываются раз в GROUPS_REFRESH_INTERVAL или при смене версии
+_groups = {'checked_at': None, 'version': None, 'ids': frozenset()}
+
+# Версия списка групп в общем кэше: ее смена заставляет все процессы перечитать список
+GROUPS_VERSION_KEY = 'servicedesk:groups-version'
+
+
+def forget_groups():
+    """Сбрасывает список групп этого процесса и версию списка для остальных (при изменении VKGroup)"""
+    _groups['checked_at'] = None
+    cache.delete(GROUPS_VERSION_KEY)
+
+
+def groups_version():
+    version = cache.get(GROUPS_VERSION_KEY)
+    if version is None:
+        cache.add(GROUPS_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(GROUPS_VERSION_KEY)
+    return version
+
+
+def known_group(group_id, refresh_interval):
+    now = time.monotonic()
+    version = groups_version()
+    if (_groups['checked_at'] is None or version != _groups['version']
+            or now - _groups['checked_at'] >= refresh_interval):
+        _groups['ids'] = frozenset(VKGroup.objects.values_list('group_id', flat=True))
+        _groups['checked_at'] = now
+        _groups['version'] = version
+    try:
+        return int(group_id) in _groups['ids']
+    except (TypeError, ValueError):
+        return False
+
+
+# Состояние нагрузки процесса: время проверки, результат и среднее время обработки callback
+_load = {'checked_at': None, 'overloaded': False, 'latency': 0.0}
+
+
+def observe(seconds):
+    """Учитывает время обработки callback без очереди (экспоненциальное среднее)"""
+    _load['latency'] = _load['latency'] * 0.9 + seconds * 0.1
+
+
+def measure_overload(options):
+    # Модуль загружается при старте любого процесса (signals): обработчики событий с клиентами VK
+    # импортируются только при первой проверке нагрузки
+    from .event_queue import queue_enabled
+    if not queue_enabled():
+        return options['SHED_LATENCY'] is not None and _load['latency'] > options['SHED_LATENCY']
+    queue = InboundEvent.objects.filter(failed=False).aggregate(pending=Count('pk'), oldest=Min('received_at'))
+    if options['SHED_QUEUE_DEPTH'] is not None and queue['pending'] > options['SHED_QUEUE_DEPTH']:
+        return True
+    if options['SHED_LATENCY'] is not None and queue['oldest'] is not None:
+        return (timezone.now() - queue['oldest']).total_seconds() > options['SHED_LATENCY']
+    return False
+
+
+def overloaded(options):
+    """Перегружена ли обработка событий; проверяется не чаще раза в LOAD_CHECK_INTERVAL"""
+    now = time.monotonic()
+    if _load['checked_at'] is None or now - _load['checked_at'] >= options['LOAD_CHECK_INTERVAL']:
+        _load['overloaded'] = measure_overload(options)
+        _load['checked_at'] = now
+    return _load['overloaded']
@@ -0,0 +1,209 @@
+"""
+Почасовые агрегаты нагрузки и SLA.
+
+Счетчики обновляются инкрементально при приеме сообщений, ответах и закрытии
+обращений: каждое событие - один INSERT ... ON CONFLICT DO UPDATE по всем
+затронутым срезам (вся поддержка, группа, оператор, теги).
+Отчеты читают только агрегаты и не сканируют Message/Ticket.
+"""
+from collections import defaultdict
+
+from django.db import connections, router
+from django.db.models import Sum
+
+from . import sharding
+from .models import StatsRollup, Ticket
+
+COUNTERS = (
+    'tickets_created',
+    'messages_received',
+    'messages_sent',
+    'first_responses',
+    'first_response_seconds',
+    'resolved',
+    'resolution_seconds',
+)
+
+
+def hour_bucket(moment):
+    """Начало часа, к которому относится событие"""
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def ticket_dimensions(ticket, tag_ids=(), operator_id=None):
+    """Срезы, в которые попадает событие по обращению"""
+    dimensions = [(StatsRollup.ALL, 0), (StatsRollup.GROUP, ticket.vk_group_id)]
+    if operator_id:
+        dimensions.append((StatsRollup.OPERATOR, operator_id))
+    dimensions.extend((StatsRollup.TAG, tag_id) for tag_id in tag_ids)
+    return dimensions
+
+
+def get_tag_ids(tickets):
+    """Теги обращений одним запросом к связующей таблице: {ticket_pk: [tag_pk, ...]}"""
+    tag_ids = defaultdict(list)
+    links = Ticket.tags.through.objects.filter(
+        ticket_id__in=[ticket.pk for ticket in tickets]
+    ).values_list('ticket_id', 'tag_id')
+    for ticket_pk, tag_pk in links:
+        tag_ids[ticket_pk].append(tag_pk)
+    return tag_ids
+
+
+class RollupBatch:
+    """Накапливает приращения счетчиков и записывает их одним запросом"""
+
+    def __init__(self):
+        self.deltas = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+
+    def add(self, dimensions, moment, **counters):
+        bucket = hour_bucket(moment)
+        for dimension, dimension_id in dimensions:
+            row = self.deltas[(dimension, dimension_id, bucket)]
+            for name, value in counters.items():
+                row[name] += value
+
+    def save(self):
+        if not self.deltas:
+            return
+        using = router.db_for_write(StatsRollup)
+        connection = connections[using]
+        meta = StatsRollup._meta
+        quote = connection.ops.quote_name
+        bucket_field = meta.get_field('bucket')
+
+        keys = ('dimension', 'dimension_id', 'bucket')
+        columns = [quote(meta.get_field(name).column) for name in keys + COUNTERS]
+        placeholders = '(' + ', '.join(['%s'] * len(columns)) + ')'
+        params = []
+        for (dimension, dimension_id, bucket), row in self.deltas.items():
+            params.extend([dimension, dimension_id, bucket_field.get_db_prep_save(bucket, connection)])
+            params.extend(row[name] for name in COUNTERS)
+
+        table = quote(meta.db_table)
+        updates = ', '.join(
+            f'{quote(name)} = {table}.{quote(name)} + excluded.{quote(name)}' for name in COUNTERS
+        )
+        sql = (
+            f'INSERT INTO {table} ({", ".join(columns)}) '
+            f'VALUES {", ".join([placeholders] * len(self.deltas))} '
+            f'ON CONFLICT ({", ".join(quote(name) for name in keys)}) DO UPDATE SET {updates}'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        self.deltas.clear()
+
+
+def record_user_message(ticket, message, ticket_created=False):
+    """Входящее сообщение пользователя (и создание обращения, если оно новое)"""
+    tag_ids = [] if ticket_created else get_tag_ids([ticket])[ticket.pk]
+    batch = RollupBatch()
+    dimensions = ticket_dimensions(ticket, tag_ids, ticket.admin_id)
+    batch.add(dimensions, message.created_at, messages_received=1, tickets_created=int(ticket_created))
+    batch.save()
+
+
+def record_user_messages(ticket, messages, ticket_created=False):
+    """Несколько входящих сообщений одного пользователя одной записью агрегатов"""
+    tag_ids = [] if ticket_created else get_tag_ids([ticket])[ticket.pk]
+    batch = RollupBatch()
+    dimensions = ticket_dimensions(ticket, tag_ids, ticket.admin_id)
+    for message in messages:
+        batch.add(dimensions, message.created_at, messages_received=1)
+    if ticket_created:
+        batch.add(dimensions, messages[0].created_at, tickets_created=1)
+    batch.save()
+
+
+def record_reply(ticket, message):
+    """Ответ оператора; первый ответ по обращению учитывается в SLA первой реакции"""
+    batch = RollupBatch()
+    dimensions = ticket_dimensions(ticket, get_tag_ids([ticket])[ticket.pk], message.admin_author_id)
+    batch.add(dimensions, message.created_at, messages_sent=1)
+
+    if ticket.first_response_at is None:
+        # Условное обновление: при гонке двух ответов первым засчитается только один
+        marked = Ticket.objects.filter(pk=ticket.pk, first_response_at__isnull=True).update(
+            first_response_at=message.created_at
+        )
+        if marked:
+            ticket.first_response_at = message.created_at
+            seconds = (message.created_at - ticket.created_at).total_seconds()
+            batch.add(dimensions, message.created_at, first_responses=1, first_response_seconds=int(seconds))
+    batch.save()
+
+
+def record_replies(tickets, replies):
+    """
+    Ответы оператора на несколько обращений сразу (replies[i] - ответ на tickets[i]):
+    первые ответы отмечаются одним UPDATE на момент ответа, агрегаты - одной записью
+    """
+    first_candidates = defaultdict(list)
+    for ticket, message in zip(tickets, replies):
+        if ticket.first_response_at is None:
+            first_candidates[message.created_at].append(ticket.pk)
+
+    marked = set()
+    with sharding.atomic():
+        for moment, pks in first_candidates.items():
+            # Блокировка отсекает параллельный ответ, который мог стать первым раньше
+            pks = list(Ticket.objects.select_for_update().filter(
+                pk__in=pks, first_response_at__isnull=True
+            ).values_list('pk', flat=True))
+            Ticket.objects.filter(pk__in=pks).update(first_response_at=moment)
+            marked.update(pks)
+
+    tag_ids = get_tag_ids(tickets)
+    batch = RollupBatch()
+    for ticket, message in zip(tickets, replies):
+        dimensions = ticket_dimensions(ticket, tag_ids[ticket.pk], message.admin_author_id)
+        batch.add(dimensions, message.created_at, messages_sent=1)
+        if ticket.pk in marked:
+            ticket.first_response_at = message.created_at
+            seconds = (message.created_at - ticket.created_at).total_seconds()
+            batch.add(dimensions, message.created_at, first_responses=1, first_response_seconds=int(seconds))
+    batch.save()
+
+
+def record_resolved(tickets):
+    """Закрытие обращений; у каждого должен быть заполнен closed_at"""
+    tag_ids = get_tag_ids(tickets)
+    batch = RollupBatch()
+    for ticket in tickets:
+        seconds = (ticket.closed_at - ticket.created_at).total_seconds()
+        dimensions = ticket_dimensions(ticket, tag_ids[ticket.pk], ticket.admin_id)
+        batch.add(dimensions, ticket.closed_at, resolved=1, resolution_seconds=int(seconds))
+    batch.save()
+
+
+def report(dimension, start, end, dimension_id=None):
+    """
+    Сводка по срезу за период [start, end): объемы, среднее время первой реакции
+    и решения в секундах по каждому dimension_id
+    """
+    rollups = StatsRollup.objects.filter(dimension=dimension, bucket__gte=start, bucket__lt=end)
+    if dimension_id is not None:
+        rollups = rollups.filter(dimension_id=dimension_id)
+    rows = rollups.values('dimension_id').annotate(
+        **{name: Sum(name) for name in COUNTERS}
+    ).order_by('dimension_id')
+
+    result = []
+    for row in rows:
+        row['avg_first_response_seconds'] = (
+            row['first_response_seconds'] / row['first_responses'] if row['first_responses'] else None
+        )
+        row['avg_resolution_seconds'] = (
+            row['resolution_seconds'] / row['resolved'] if row['resolved'] else None
+        )
+        result.append(row)
+    return result
+
+
+def hourly_volume(dimension, start, end, dimension_id=0):
+    """Почасовой ряд счетчиков для одного значения среза"""
+    return list(
+        StatsRollup.objects.filter(
+            dimension=dimension, dimension_id=dimension_id, bucket__gte=start, bucket__lt=end
+        ).order_by('bucket').values('bucket', *COUNTERS)
+    )
@@ -1,2 +1,9 @@
 from django.apps import AppConfig
 
+
+class ServicedeskConfig(AppConfig):
+    name = 'project.servicedesk'
+    verbose_name = 'Служба поддержки'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,133 @@
+"""
+Автоматическое распределение обращений по наименее загруженным операторам.
+
+Нагрузка оператора хранится в OperatorLoad и меняется атомарными
+инкрементами при назначении, переназначении и закрытии обращений, поэтому
+выбор оператора - одно чтение по индексу без COUNT по обращениям.
+Вес обращения, учтенный в нагрузке, хранится в Ticket.load_weight.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import OperatorLoad, Ticket
+
+
+def get_assignment_settings():
+    options = {
+        'ENABLED': True,
+        'PRIORITY_WEIGHTS': {'low': 1, 'medium': 2, 'high': 3, 'critical': 5},
+        'TAG_WEIGHTS': {},
+    }
+    options.update(getattr(settings, 'SERVICEDESK_ASSIGNMENT', {}))
+    return options
+
+
+def ticket_weight(ticket, tag_names=()):
+    """Вес обращения: приоритет плюс надбавки за теги"""
+    options = get_assignment_settings()
+    weight = options['PRIORITY_WEIGHTS'].get(ticket.priority, 1)
+    weight += sum(options['TAG_WEIGHTS'].get(name, 0) for name in tag_names)
+    return weight
+
+
+def counts_in_load(admin_id, status):
+    return admin_id is not None and status != 'closed'
+
+
+def pick_operator():
+    """
+    Блокирует строку наименее загруженного доступного оператора.
+    Строки, занятые параллельными воркерами, пропускаются, чтобы они
+    не выбирали одного и того же оператора; вызывать внутри транзакции
+    """
+    candidates = OperatorLoad.objects.filter(
+        is_available=True, user__is_active=True
+    ).order_by('weighted_load', 'open_tickets', 'pk')
+    return (candidates.select_for_update(skip_locked=True, of=('self',)).first()
+            or candidates.select_for_update(of=('self',)).first())
+
+
+def assign_ticket(ticket):
+    """Назначает новое обращение наименее загруженному оператору, возвращает его id или None"""
+    if not get_assignment_settings()['ENABLED'] or ticket.admin_id is not None:
+        return None
+
+    weight = ticket_weight(ticket)
+    with transaction.atomic():
+        load = pick_operator()
+        if load is None:
+            return None
+        OperatorLoad.objects.filter(pk=load.pk).update(
+            open_tickets=F('open_tickets') + 1,
+            weighted_load=F('weighted_load') + weight,
+        )
+        Ticket.objects.filter(pk=ticket.pk).update(admin_id=load.user_id, load_weight=weight)
+
+    ticket.admin_id = load.user_id
+    ticket.load_weight = weight
+    return load.user_id
+
+
+def snapshot(tickets):
+    """Запоминает, как обращения учтены в нагрузке до изменения"""
+    return {
+        ticket.pk: (
+            (ticket.admin_id, ticket.load_weight) if counts_in_load(ticket.admin_id, ticket.status) else (None, 0)
+        )
+        for ticket in tickets
+    }
+
+
+def get_tag_names(tickets):
+    """Имена тегов обращений одним запросом; нужны, только если заданы TAG_WEIGHTS"""
+    tag_names = defaultdict(list)
+    if get_assignment_settings()['TAG_WEIGHTS']:
+        links = Ticket.tags.through.objects.filter(
+            ticket_id__in=[ticket.pk for ticket in tickets]
+        ).values_list('ticket_id', 'tag__name')
+        for ticket_pk, name in links:
+            tag_names[ticket_pk].append(name)
+    return tag_names
+
+
+def rebalance(before, tickets):
+    """
+    Переносит нагрузку после смены ответственного, статуса или приоритета.
+    before - результат snapshot() до изменения, tickets - те же обращения после.
+    Запросов: по одному на затронутого оператора и на каждое новое значение веса
+    """
+    tag_names = get_tag_names(tickets)
+    deltas = defaultdict(lambda: [0, 0])
+    new_weights = defaultdict(list)
+
+    for ticket in tickets:
+        old_admin_id, old_weight = before[ticket.pk]
+        if counts_in_load(ticket.admin_id, ticket.status):
+            new_admin_id, new_weight = ticket.admin_id, ticket_weight(ticket, tag_names.get(ticket.pk, ()))
+        else:
+            new_admin_id, new_weight = None, 0
+
+        if (old_admin_id, old_weight) == (new_admin_id, new_weight):
+            continue
+        if old_admin_id is not None:
+            deltas[old_admin_id][0] -= 1
+            deltas[old_admin_id][1] -= old_weight
+        if new_admin_id is not None:
+            deltas[new_admin_id][0] += 1
+            deltas[new_admin_id][1] += new_weight
+        if new_weight != ticket.load_weight:
+            ticket.load_weight = new_weight
+            new_weights[new_weight].append(ticket.pk)
+
+    with transaction.atomic():
+        for user_id, (tickets_delta, weight_delta) in deltas.items():
+            if tickets_delta or weight_delta:
+                OperatorLoad.objects.filter(user_id=user_id).update(
+                    open_tickets=F('open_tickets') + tickets_delta,
+                    weighted_load=F('weighted_load') + weight_delta,
+                )
+        for weight, pks in new_weights.items():
+            Ticket.objects.filter(pk__in=pks).update(load_weight=weight)
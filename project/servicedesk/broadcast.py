@@ -0,0 +1,98 @@
+"""
+Массовый ответ: один текст сразу многим обращениям.
+
+Получатели группируются по сообществу (у каждого свой токен) и отправляются
+через messages.send с peer_ids - до SEND_PEERS_PER_CALL адресатов за вызов,
+а вызовы склеиваются в execute под общим ограничением частоты клиента.
+Сообщения оператора создаются bulk_create, статусы обращений меняются одним
+UPDATE, нагрузка операторов и аналитика пересчитываются пачкой.
+"""
+import logging
+from collections import defaultdict
+
+import requests
+from django.utils import timezone
+
+from . import analytics, assignment, fragments, sharding
+from .models import Message, Ticket
+from .vk_api import SEND_PEERS_PER_CALL, VKAPIError, VKClient, delivered_peers, send_many_params
+
+logger = logging.getLogger(__name__)
+
+
+def deliver(group, tickets, text):
+    """Отправляет текст собеседникам обращений одной группы, возвращает {ticket_pk: message_id}"""
+    client = VKClient(group.access_token)
+    # У собеседника может быть выбрано несколько обращений - сообщение уходит один раз
+    by_peer = defaultdict(list)
+    for ticket in tickets:
+        by_peer[ticket.user_id].append(ticket)
+    peers = list(by_peer)
+
+    with client.batch() as batch:
+        sends = [
+            batch.call('messages.send', **send_many_params(peers[start:start + SEND_PEERS_PER_CALL], text))
+            for start in range(0, len(peers), SEND_PEERS_PER_CALL)
+        ]
+
+    delivered = {}
+    for send in sends:
+        try:
+            sent = delivered_peers(send.result())
+        except VKAPIError as e:
+            logger.warning("VK API error", extra={'vk_error': e.error, 'vk_group_id': group.group_id})
+            continue
+        except requests.RequestException:
+            logger.exception("Error sending bulk reply")
+            continue
+        for peer_id, message_id in sent.items():
+            for ticket in by_peer.get(peer_id, ()):
+                delivered[ticket.pk] = message_id
+    return delivered
+
+
+def send_bulk_reply(tickets, text, author):
+    """
+    Отвечает текстом на все обращения queryset'а tickets текущего шарда от имени author.
+    Возвращает (число отвеченных, число неотправленных)
+    """
+    tickets = list(tickets.select_related('vk_group').exclude(status='closed'))
+    by_group = defaultdict(list)
+    for ticket in tickets:
+        by_group[ticket.vk_group_id].append(ticket)
+
+    delivered = {}
+    for group_tickets in by_group.values():
+        delivered.update(deliver(group_tickets[0].vk_group, group_tickets, text))
+
+    answered = [ticket for ticket in tickets if ticket.pk in delivered]
+    if not answered:
+        return 0, len(tickets)
+
+    now = timezone.now()
+    with sharding.atomic():
+        load_before = assignment.snapshot(answered)
+        replies = Message.objects.bulk_create([
+            Message(
+                ticket=ticket,
+                message_id=delivered[ticket.pk],
+                text=text,
+                is_admin=True,
+                admin_author=author,
+                is_read=True,
+                created_at=now,
+            )
+            for ticket in answered
+        ])
+        Ticket.objects.filter(pk__in=[ticket.pk for ticket in answered]).update(
+            status='answered', waiting_since=None, admin=author, updated_at=now
+        )
+        for ticket in answered:
+            ticket.status = 'answered'
+            ticket.waiting_since = None
+            ticket.admin = author
+        assignment.rebalance(load_before, answered)
+        analytics.record_replies(answered, replies)
+    fragments.touch_tickets([ticket.pk for ticket in answered])
+
+    return len(answered), len(tickets) - len(answered)
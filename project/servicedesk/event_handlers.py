@@ -2,12 +2,17 @@ import json
 import logging
 from datetime import datetime
 
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 import requests
 
 from project import settings
+from . import analytics, assignment, sharding, timeline
 from .models import Message, VKGroup, Ticket
+from .vk_api import AsyncVKClient, VKAPIError, VKClient
 
 logger = logging.getLogger(__name__)
 
@@ -25,45 +30,193 @@ def handle_message_new(data):
     # Получаем информацию о пользователе
     user_info = get_vk_user_info(user_id, group.access_token)
 
-    # Проверяем, есть ли активное обращение у пользователя
-    # Ищем открытые или отвеченные обращения (не закрытые)
-    active_ticket = Ticket.objects.filter(
+    store_user_message(group, message_data, user_info)
+
+
+def handle_message_batch(events):
+    """
+    Несколько событий message_new одного пользователя одной группы (в порядке
+    поступления): один запрос профиля и одна запись в обращение
+    """
+    group = VKGroup.objects.get(group_id=events[0]['group_id'])
+    messages = [event['object']['message'] for event in events]
+    user_info = get_vk_user_info(messages[0]['from_id'], group.access_token)
+    store_user_messages(group, messages, user_info)
+
+
+async def ahandle_message_new(data):
+    """
+    Асинхронная обработка нового сообщения: запрос к VK не занимает поток,
+    работа с БД выполняется одним вызовом через sync_to_async
+    """
+    message_data = data['object']['message']
+    group_id = data['group_id']
+
+    group = await VKGroup.objects.aget(group_id=group_id)
+    user_id = message_data['from_id']
+
+    user_info = await aget_vk_user_info(user_id, group.access_token)
+
+    await sync_to_async(store_user_message)(group, message_data, user_info)
+
+
+class TicketMoved(Exception):
+    """Обращение перенесено в другой шард, пока в него записывалось сообщение"""
+
+
+def find_active_ticket(group, user_id):
+    """Открытое или отвеченное (не закрытое) обращение пользователя в текущем шарде"""
+    return Ticket.objects.filter(
         user_id=user_id,
         vk_group=group,
         status__in=['open', 'answered', 'waiting']
     ).order_by('-created_at').first()
 
+
+def store_user_message(group, message_data, user_info):
+    """Сохраняет сообщение пользователя в шард группы"""
+    return in_group_shard(group, message_data['from_id'], save_user_message, message_data, user_info)
+
+
+def store_user_messages(group, messages, user_info):
+    """Сохраняет несколько сообщений одного пользователя одной записью в шард группы"""
+    return in_group_shard(group, messages[0]['from_id'], save_user_messages, messages, user_info)
+
+
+def in_group_shard(group, user_id, save, *args):
+    """Выполняет save(group, *args) в шарде группы; во время переноса - в шарде активного обращения"""
+    alias = sharding.group_shard(group)
+    if group.shard_moving_from:
+        # Во время переноса активное обращение может еще лежать в исходном шарде
+        with sharding.use_shard(group.shard_moving_from):
+            if find_active_ticket(group, user_id) is not None:
+                alias = group.shard_moving_from
+    try:
+        with sharding.use_shard(alias):
+            return save(group, *args)
+    except TicketMoved:
+        with sharding.use_shard(sharding.group_shard(group)):
+            return save(group, *args)
+
+
+def save_user_message(group, message_data, user_info):
+    """Сохраняет сообщение пользователя в активное обращение текущего шарда или создает новое"""
+    user_id = message_data['from_id']
+
+    # Проверяем, есть ли активное обращение у пользователя
+    active_ticket = find_active_ticket(group, user_id)
+
     # Определяем тему обращения из первого сообщения
-    if not active_ticket:
-        subject = extract_subject(message_data.get('text', ''))
-        # Создаем новое обращение
-        active_ticket = Ticket.objects.create(
-            user_id=user_id,
-            user_name=user_info.get('name', f'Пользователь {user_id}'),
-            user_photo=user_info.get('photo', ''),
-            subject=subject,
-            vk_group=group,
-            status='open'
-        )
-
-    # Создаем сообщение
-    Message.objects.create(
-        ticket=active_ticket,
-        message_id=message_data['id'],
-        text=message_data.get('text', ''),
-        attachments=message_data.get('attachments', []),
-        is_admin=False,
-        is_read=False
-    )
+    ticket_created = not active_ticket
+    if ticket_created:
+        active_ticket = create_ticket(group, message_data, user_info)
+
+    # Создаем сообщение; повторная доставка того же события VK не создает дубль
+    try:
+        with sharding.atomic():
+            message = Message.objects.create(
+                ticket=active_ticket,
+                message_id=message_data['id'],
+                text=message_data.get('text', ''),
+                attachments=message_data.get('attachments', []),
+                is_admin=False,
+                is_read=False
+            )
+    except IntegrityError:
+        if group.shard_moving_from and not Ticket.objects.filter(pk=active_ticket.pk).exists():
+            raise TicketMoved()
+        logger.info("Duplicate VK message skipped", extra={'vk_message_id': message_data['id']})
+        return active_ticket
 
-    # Обновляем статус обращения
+    # Обновляем статус обращения; update_fields не дает заново вставить
+    # обращение, которое перенесли в другой шард после записи сообщения
     if active_ticket.status == 'closed':
         active_ticket.status = 'open'
         active_ticket.closed_at = None
-        active_ticket.save()
+        active_ticket.waiting_since = message.created_at
+        active_ticket.save(update_fields=['status', 'closed_at', 'waiting_since', 'updated_at'])
     elif active_ticket.status == 'answered':
         active_ticket.status = 'waiting'
-        active_ticket.save()
+        active_ticket.waiting_since = message.created_at
+        active_ticket.save(update_fields=['status', 'waiting_since', 'updated_at'])
+    elif active_ticket.waiting_since is None:
+        active_ticket.waiting_since = message.created_at
+        Ticket.objects.filter(pk=active_ticket.pk).update(waiting_since=message.created_at)
+
+    analytics.record_user_message(active_ticket, message, ticket_created)
+    timeline.record_contact(active_ticket, message.created_at, ticket_created)
+    return active_ticket
+
+
+def create_ticket(group, message_data, user_info):
+    """Новое обращение по первому сообщению пользователя, назначенное оператору"""
+    user_id = message_data['from_id']
+    ticket = Ticket.objects.create(
+        user_id=user_id,
+        user_name=user_info.get('name', f'Пользователь {user_id}'),
+        user_photo=user_info.get('photo', ''),
+        subject=extract_subject(message_data.get('text', '')),
+        vk_group=group,
+        status='open',
+        waiting_since=timezone.now()
+    )
+    assignment.assign_ticket(ticket)
+    return ticket
+
+
+def save_user_messages(group, messages, user_info):
+    """
+    Сохраняет подряд пришедшие сообщения пользователя в активное обращение
+    текущего шарда: одна вставка сообщений, одно обновление обращения,
+    одна запись агрегатов и один сброс кэша строки
+    """
+    active_ticket = find_active_ticket(group, messages[0]['from_id'])
+    ticket_created = not active_ticket
+    if ticket_created:
+        active_ticket = create_ticket(group, messages[0], user_info)
+
+    try:
+        with sharding.atomic():
+            # Повторно доставленные события VK не создают дублей
+            existing = set(Message.objects.filter(
+                ticket=active_ticket, message_id__in=[message_data['id'] for message_data in messages]
+            ).values_list('message_id', flat=True))
+            new_messages = {}
+            for message_data in messages:
+                if message_data['id'] not in existing:
+                    new_messages.setdefault(message_data['id'], Message(
+                        ticket=active_ticket,
+                        message_id=message_data['id'],
+                        text=message_data.get('text', ''),
+                        attachments=message_data.get('attachments', []),
+                        is_admin=False,
+                        is_read=False
+                    ))
+            created = Message.objects.bulk_create(list(new_messages.values()))
+    except IntegrityError:
+        if group.shard_moving_from and not Ticket.objects.filter(pk=active_ticket.pk).exists():
+            raise TicketMoved()
+        raise
+    if not created:
+        logger.info("Duplicate VK messages skipped", extra={'vk_message_ids': [m['id'] for m in messages]})
+        return active_ticket
+
+    # Обращение ждет ответа с первого из новых сообщений
+    waiting_since = created[0].created_at
+    if active_ticket.status in ('closed', 'answered'):
+        active_ticket.status = 'open' if active_ticket.status == 'closed' else 'waiting'
+        active_ticket.closed_at = None
+        active_ticket.waiting_since = waiting_since
+        active_ticket.save(update_fields=['status', 'closed_at', 'waiting_since', 'updated_at'])
+    else:
+        if active_ticket.waiting_since is None:
+            active_ticket.waiting_since = waiting_since
+        # Одно обновление: ожидание и время изменения для сортировки списка
+        active_ticket.save(update_fields=['waiting_since', 'updated_at'])
+
+    analytics.record_user_messages(active_ticket, created, ticket_created)
+    timeline.record_contact(active_ticket, created[-1].created_at, ticket_created)
+    return active_ticket
 
 
 def extract_subject(text):
@@ -82,47 +235,53 @@ def send_message(user_id, text, keyboard=None):
     """
     Отправка сообщения через VK API
     """
-    url = "https://api.vk.com/method/messages.send"
     params = {
         'user_id': user_id,
         'message': text,
         'random_id': 0,
-        'access_token': settings.VK_CALLBACK_API['ACCESS_TOKEN'],
-        'v': '5.199'  # версия API
     }
 
     if keyboard:
         params['keyboard'] = json.dumps(keyboard)
 
     try:
-        response = requests.post(url, params=params)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        logger.error(f"Error sending message: {e}")
+        return {'response': VKClient(settings.VK_CALLBACK_API['ACCESS_TOKEN']).call('messages.send', **params)}
+    except (requests.RequestException, VKAPIError):
+        logger.exception("Error sending message")
         return None
 
 
+USER_FIELDS = 'first_name,last_name,photo_100'
+
+
+def parse_user_info(users, user_id):
+    """Приводит ответ users.get к виду {'name': ..., 'photo': ...}"""
+    if users:
+        user = users[0]
+        return {
+            'name': f"{user['first_name']} {user['last_name']}",
+            'photo': user.get('photo_100')
+        }
+    return {'name': f'Пользователь {user_id}'}
+
+
 def get_vk_user_info(user_id, access_token):
     """Получение информации о пользователе ВКонтакте"""
-    url = 'https://api.vk.com/method/users.get'
-    params = {
-        'user_ids': user_id,
-        'access_token': access_token,
-        'v': '5.131',
-        'fields': 'first_name,last_name,photo_100'
-    }
+    try:
+        users = VKClient(access_token).call('users.get', user_ids=user_id, fields=USER_FIELDS)
+        return parse_user_info(users, user_id)
+    except Exception:
+        logger.exception("Error getting user info", extra={'vk_user_id': user_id})
+
+    return {'name': f'Пользователь {user_id}'}
+
 
+async def aget_vk_user_info(user_id, access_token):
+    """Асинхронное получение информации о пользователе ВКонтакте"""
     try:
-        response = requests.get(url, params=params)
-        data = response.json()
-        if 'response' in data and len(data['response']) > 0:
-            user = data['response'][0]
-            return {
-                'name': f"{user['first_name']} {user['last_name']}",
-                'photo': user.get('photo_100')
-            }
-    except Exception as e:
-        print(f"Error getting user info: {e}")
+        users = await AsyncVKClient(access_token).call('users.get', user_ids=user_id, fields=USER_FIELDS)
+        return parse_user_info(users, user_id)
+    except Exception:
+        logger.exception("Error getting user info", extra={'vk_user_id': user_id})
 
     return {'name': f'Пользователь {user_id}'}
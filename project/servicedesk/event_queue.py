@@ -0,0 +1,481 @@
+"""
+Очередь входящих событий VK с параллельной обработкой по партициям.
+
+При QUEUE=True Callback API только сохраняет событие в InboundEvent, а
+обрабатывают события процессы команды consume_events. Партиция события
+определяется по (group_id, from_id): сообщения одного собеседника всегда
+попадают в одну партицию и обрабатываются строго по порядку, разные
+партиции обрабатываются параллельно. Партиции арендуются обработчиками
+(EventPartition): каждый живой обработчик (EventConsumer) берет свою долю,
+при запуске или остановке обработчиков доли перераспределяются.
+
+Подряд пришедшие сообщения одного собеседника склеиваются: обработчик ждет
+COALESCE_WINDOW секунд после первого из них и записывает все накопившиеся
+одной пачкой (EVENT_BATCH_HANDLERS). Сообщения сверх FLOOD_LIMIT за
+FLOOD_PERIOD от одного пользователя откладываются до конца периода
+(available_at) вместе со следующими его сообщениями, чтобы один источник
+спама не занимал обработчики; учитываются только успешно обработанные
+сообщения. Отложенность собеседника берется из InboundEvent.available_at,
+поэтому порядок его сообщений сохраняется и после переезда партиции к
+другому обработчику. Счетчики сообщений хранятся в кэше default, который
+должен быть общим для процессов (consume_events предупреждает, если нет).
+
+Обработанные события удаляются одним DELETE на пачку; после сбоя процесса
+часть пачки будет обработана повторно, поэтому обработчики событий должны
+быть идемпотентны (дубли сообщений отсекает message_vk_id_unique).
+"""
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import zlib
+from datetime import timedelta
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.models import Count, Max, Min, Q
+from django.db.models.fields.json import KT
+from django.utils import timezone
+
+from . import profiling
+from .event_handlers import handle_message_batch, handle_message_new
+from .models import EventConsumer, EventPartition, InboundEvent
+
+logger = logging.getLogger(__name__)
+
+EVENT_HANDLERS = {
+    'message_new': handle_message_new,
+}
+
+# Обработчики нескольких событий одного собеседника сразу
+EVENT_BATCH_HANDLERS = {
+    'message_new': handle_message_batch,
+}
+
+
+def get_event_settings():
+    options = {
+        # Складывать события Callback API в очередь вместо обработки в запросе
+        'QUEUE': False,
+        # Число партиций; менять только при пустой очереди, иначе нарушится порядок
+        'PARTITIONS': 64,
+        # Процессов-обработчиков в consume_events
+        'WORKERS': 4,
+        # Событий партиции за один проход
+        'BATCH_SIZE': 100,
+        # Срок аренды партиции и отклика обработчика, секунды
+        'LEASE_SECONDS': 30,
+        # Пауза, когда событий нет, секунды
+        'POLL_INTERVAL': 0.5,
+        # После стольких неудачных попыток событие откладывается (failed)
+        'MAX_ATTEMPTS': 5,
+        # Как часто писать в лог отставание партиций, секунды
+        'METRICS_INTERVAL': 60,
+        # Сколько секунд ждать следующих сообщений собеседника перед записью (0 - не ждать)
+        'COALESCE_WINDOW': 1,
+        # Не больше FLOOD_LIMIT сообщений пользователя за FLOOD_PERIOD секунд (None - без ограничения)
+        'FLOOD_LIMIT': 30,
+        'FLOOD_PERIOD': 60,
+    }
+    options.update(getattr(settings, 'SERVICEDESK_EVENTS', {}))
+    return options
+
+
+def queue_enabled():
+    return get_event_settings()['QUEUE']
+
+
+def event_key(data):
+    """Ключ упорядочивания: группа и собеседник; для событий без сообщения - только группа"""
+    message = (data.get('object') or {}).get('message') or {}
+    return f"{data.get('group_id')}:{message.get('from_id', '')}"
+
+
+def partition_for(data, partitions=None):
+    """Партиция события; crc32 одинаков во всех процессах, в отличие от hash()"""
+    partitions = partitions or get_event_settings()['PARTITIONS']
+    return zlib.crc32(event_key(data).encode()) % partitions
+
+
+def build_event(data):
+    return InboundEvent(partition=partition_for(data), event_type=data.get('type', ''), payload=data)
+
+
+def enqueue(data):
+    """Ставит событие в очередь"""
+    event = build_event(data)
+    event.save()
+    return event
+
+
+async def aenqueue(data):
+    event = build_event(data)
+    await event.asave()
+    return event
+
+
+def handle_event(data, handlers=None):
+    """Обрабатывает событие сразу; события без обработчика пропускаются"""
+    handler = (handlers or EVENT_HANDLERS).get(data.get('type'))
+    if handler:
+        handler(data)
+
+
+def default_batch_handlers(handlers, batch_handlers):
+    """Стандартные пакетные обработчики годятся только вместе со стандартными одиночными"""
+    if batch_handlers is not None:
+        return batch_handlers
+    return EVENT_BATCH_HANDLERS if handlers is None else {}
+
+
+def coalesce(items, batch_types, payload=lambda item: item):
+    """
+    Разбивает пачку на прогоны: события типов batch_types одного собеседника
+    собираются в один прогон на месте первого из них, остальные идут по одному.
+    Порядок событий каждого собеседника сохраняется
+    """
+    runs = []
+    by_key = {}
+    for item in items:
+        data = payload(item)
+        if data.get('type') not in batch_types:
+            runs.append([item])
+            continue
+        key = (data['type'], event_key(data))
+        if key in by_key:
+            by_key[key].append(item)
+        else:
+            by_key[key] = [item]
+            runs.append(by_key[key])
+    return runs
+
+
+def handle_run(events, handlers=None, batch_handlers=None):
+    """Обрабатывает прогон из coalesce: несколько событий - пакетным обработчиком, если он есть"""
+    batch_handler = (batch_handlers or {}).get(events[0].get('type'))
+    if batch_handler and len(events) > 1:
+        batch_handler(events)
+        return
+    for data in events:
+        handle_event(data, handlers)
+
+
+def flood_allowance(key, count, limit):
+    """Сколько из count новых сообщений собеседника key еще укладываются в limit текущего периода"""
+    return max(0, min(count, limit - cache.get(f'servicedesk:flood:{key}', 0)))
+
+
+def record_flood(key, count, period):
+    """Учитывает count обработанных сообщений собеседника key в счетчике на period секунд"""
+    cache_key = f'servicedesk:flood:{key}'
+    cache.add(cache_key, 0, period)
+    try:
+        cache.incr(cache_key, count)
+    except ValueError:
+        # Счетчик истек между add и incr
+        cache.set(cache_key, count, period)
+
+
+def partition_lag():
+    """
+    Отставание партиций с необработанными событиями:
+    [{'partition', 'pending', 'lag_seconds', 'owner'}], lag - возраст самого старого события
+    """
+    now = timezone.now()
+    owners = dict(EventPartition.objects.values_list('partition', 'owner'))
+    rows = InboundEvent.objects.filter(failed=False).values('partition').annotate(
+        pending=Count('pk'), oldest=Min('received_at')
+    ).order_by('partition')
+    return [
+        {
+            'partition': row['partition'],
+            'pending': row['pending'],
+            'lag_seconds': (now - row['oldest']).total_seconds(),
+            'owner': owners.get(row['partition'], ''),
+        }
+        for row in rows
+    ]
+
+
+def log_lag():
+    lag = partition_lag()
+    logger.info("Event queue lag", extra={
+        'pending': sum(row['pending'] for row in lag),
+        'max_lag_seconds': max((row['lag_seconds'] for row in lag), default=0),
+        'partitions': lag,
+        'failed': InboundEvent.objects.filter(failed=True).count(),
+    })
+
+
+class PartitionConsumer:
+    """
+    Обработчик очереди в одном процессе: арендует свою долю партиций и
+    по очереди обрабатывает их пачками. stop - threading.Event или
+    multiprocessing.Event; после stop.set() текущая пачка дорабатывается
+    и аренда освобождается
+    """
+
+    def __init__(self, name=None, stop=None, handlers=None, batch_handlers=None, options=None):
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.stop = stop or threading.Event()
+        self.handlers = handlers or EVENT_HANDLERS
+        self.batch_handlers = default_batch_handlers(handlers, batch_handlers)
+        self.options = options or get_event_settings()
+        self.lease = timedelta(seconds=self.options['LEASE_SECONDS'])
+        self.partitions = []
+        # {партиция: time.monotonic(), раньше которого не повторять упавшее событие}
+        self.retry_at = {}
+        self.stats = {'processed': 0, 'failed': 0, 'flooded': 0}
+
+    def run(self):
+        ensure_partitions(self.options['PARTITIONS'])
+        metrics_at = time.monotonic()
+        try:
+            while not self.stop.is_set():
+                processed = self.step()
+                if time.monotonic() - metrics_at >= self.options['METRICS_INTERVAL']:
+                    log_lag()
+                    metrics_at = time.monotonic()
+                if not processed:
+                    self.stop.wait(self.options['POLL_INTERVAL'])
+        finally:
+            self.release()
+        return self.stats
+
+    def run_once(self):
+        """Один проход по своей доле партиций без ожидания, затем аренда освобождается"""
+        ensure_partitions(self.options['PARTITIONS'])
+        try:
+            return self.step()
+        finally:
+            self.release()
+
+    def step(self):
+        """Один проход: отклик, перераспределение и по пачке из каждой своей партиции"""
+        self.heartbeat()
+        self.rebalance()
+        processed = 0
+        for partition in list(self.partitions):
+            if self.stop.is_set():
+                break
+            processed += self.drain(partition)
+        return processed
+
+    def heartbeat(self):
+        now = timezone.now()
+        EventConsumer.objects.update_or_create(name=self.name, defaults={'heartbeat_at': now})
+        # Записи давно остановленных обработчиков больше не нужны
+        EventConsumer.objects.filter(heartbeat_at__lt=now - 10 * self.lease).delete()
+
+    def rebalance(self):
+        """Оставляет себе не больше равной доли партиций и добирает свободные до нее"""
+        now = timezone.now()
+        alive = EventConsumer.objects.filter(heartbeat_at__gte=now - self.lease).count()
+        share = math.ceil(self.options['PARTITIONS'] / max(alive, 1))
+
+        with transaction.atomic():
+            owned = list(EventPartition.objects.select_for_update().filter(owner=self.name).order_by('partition'))
+            keep, extra = owned[:share], owned[share:]
+            if extra:
+                # Лишние партиции отдаются между пачками, поэтому порядок внутри них сохраняется
+                EventPartition.objects.filter(pk__in=[row.pk for row in extra]).update(owner='', lease_until=None)
+            partitions = [row.partition for row in keep]
+            if len(keep) < share:
+                free = list(EventPartition.objects.select_for_update(skip_locked=True).filter(
+                    Q(owner='') | Q(lease_until__lt=now)
+                ).order_by('partition').values_list('pk', 'partition')[:share - len(keep)])
+                EventPartition.objects.filter(pk__in=[pk for pk, _ in free]).update(owner=self.name)
+                partitions += [partition for _, partition in free]
+            EventPartition.objects.filter(owner=self.name).update(lease_until=now + self.lease)
+
+        self.partitions = sorted(partitions)
+
+    def renew(self, partition):
+        """Продлевает аренду партиции; False, если ее уже забрал другой обработчик"""
+        return EventPartition.objects.filter(partition=partition, owner=self.name).update(
+            lease_until=timezone.now() + self.lease
+        ) > 0
+
+    def drain(self, partition):
+        """Обрабатывает пачку событий партиции по порядку, возвращает число обработанных"""
+        if self.retry_at.get(partition, 0) > time.monotonic():
+            return 0
+        if not self.renew(partition):
+            self.partitions.remove(partition)
+            return 0
+
+        self.retry_at.pop(partition, None)
+        events = list(
+            InboundEvent.objects.filter(partition=partition, failed=False)
+            .filter(Q(available_at__isnull=True) | Q(available_at__lte=timezone.now()))
+            .order_by('id')[:self.options['BATCH_SIZE']]
+        )
+        deferred = self.flood_deferrals(partition) if events else {}
+        done = []
+        renewed_at = time.monotonic()
+        try:
+            for run in coalesce(events, self.batch_handlers, attrgetter('payload')):
+                if time.monotonic() - renewed_at > self.lease.total_seconds() / 2:
+                    # Медленная пачка может пережить аренду: продлеваем ее между прогонами
+                    if not self.renew(partition):
+                        # Партицию забрал другой обработчик, остаток пачки теперь его
+                        self.partitions.remove(partition)
+                        break
+                    renewed_at = time.monotonic()
+                delay = self.coalesce_delay(run)
+                if delay > 0:
+                    # Ждем сообщения, которые собеседник еще допишет в окне склейки
+                    self.retry_at[partition] = time.monotonic() + delay
+                    break
+                run = self.flood_limit(run, deferred)
+                if not run:
+                    continue
+                try:
+                    with profiling.capture('event', run[0].event_type) as profile:
+                        if profile is not None:
+                            profile['events'] = len(run)
+                        handle_run([event.payload for event in run], self.handlers, self.batch_handlers)
+                except Exception as e:
+                    if not self.fail(run, e):
+                        # Следующие события собеседника ждут повтора этих, чтобы не нарушить порядок
+                        self.retry_at[partition] = time.monotonic() + 2 ** run[0].attempts
+                        break
+                    continue
+                done.extend(event.pk for event in run)
+                self.stats['processed'] += len(run)
+                if self.flood_limited(run):
+                    record_flood(event_key(run[0].payload), len(run), self.options['FLOOD_PERIOD'])
+        finally:
+            InboundEvent.objects.filter(pk__in=done).delete()
+        if events:
+            EventPartition.objects.filter(partition=partition).update(processed_at=timezone.now())
+        return len(done)
+
+    def coalesce_delay(self, run):
+        """Сколько секунд еще ждать до записи прогона сообщений"""
+        if run[0].event_type not in self.batch_handlers:
+            return 0
+        age = (timezone.now() - run[0].received_at).total_seconds()
+        return self.options['COALESCE_WINDOW'] - age
+
+    def flood_limited(self, run):
+        return bool(self.options['FLOOD_LIMIT']) and run[0].event_type in self.batch_handlers
+
+    def flood_deferrals(self, partition):
+        """{ключ собеседника: available_at} для собеседников партиции, чьи сообщения сейчас отложены"""
+        if not self.options['FLOOD_LIMIT']:
+            return {}
+        rows = InboundEvent.objects.filter(
+            partition=partition, failed=False, available_at__gt=timezone.now()
+        ).values(
+            group_id=KT('payload__group_id'), from_id=KT('payload__object__message__from_id')
+        ).annotate(until=Max('available_at')).order_by()
+        return {f"{row['group_id']}:{row['from_id'] or ''}": row['until'] for row in rows}
+
+    def flood_limit(self, run, deferred):
+        """
+        Возвращает события прогона в пределах FLOOD_LIMIT; остальные откладываются
+        до конца периода, а пока он идет (deferred из flood_deferrals), откладываются
+        и новые сообщения собеседника
+        """
+        if not self.flood_limited(run):
+            return run
+        key = event_key(run[0].payload)
+        available_at = deferred.get(key)
+        allowed = 0 if available_at else flood_allowance(key, len(run), self.options['FLOOD_LIMIT'])
+        if allowed < len(run):
+            if not available_at:
+                available_at = deferred[key] = timezone.now() + timedelta(seconds=self.options['FLOOD_PERIOD'])
+            postponed = run[allowed:]
+            for event in postponed:
+                event.available_at = available_at
+            InboundEvent.objects.bulk_update(postponed, ['available_at'])
+            logger.warning("User flood limit exceeded", extra={'event_key': key, 'deferred': len(postponed)})
+            self.stats['flooded'] += len(postponed)
+        return run[:allowed]
+
+    def fail(self, run, error):
+        """Учитывает неудачную попытку прогона; True, если события отложены и партиция идет дальше"""
+        for event in run:
+            event.attempts += 1
+            event.last_error = repr(error)
+            event.failed = event.attempts >= self.options['MAX_ATTEMPTS']
+        InboundEvent.objects.bulk_update(run, ['attempts', 'last_error', 'failed'])
+        logger.exception("Error processing VK event", extra={
+            'event_ids': [event.pk for event in run], 'event_type': run[0].event_type,
+            'attempts': run[0].attempts,
+        })
+        if run[0].failed:
+            self.stats['failed'] += len(run)
+        return run[0].failed
+
+    def release(self):
+        EventPartition.objects.filter(owner=self.name).update(owner='', lease_until=None)
+        EventConsumer.objects.filter(name=self.name).delete()
+        self.partitions = []
+
+
+def ensure_partitions(count):
+    EventPartition.objects.bulk_create(
+        [EventPartition(partition=partition) for partition in range(count)], ignore_conflicts=True
+    )
+
+
+def consumer_process(stop):
+    """Точка входа дочернего процесса пула; остановкой управляет родитель через stop"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        PartitionConsumer(stop=stop).run()
+    finally:
+        connections.close_all()
+
+
+def run_pool(workers, log=None):
+    """
+    Запускает workers процессов-обработчиков и перезапускает упавшие.
+    SIGTERM/SIGINT останавливают пул: процессы дорабатывают текущую пачку
+    и освобождают партиции
+    """
+    log = log or (lambda message: None)
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    # Обработчик сигнала только запоминает сигнал: stop.set() внутри него может
+    # ждать блокировку, которую держит прерванный им же код
+    signals = []
+    previous = {sig: signal.signal(sig, lambda sig, frame: signals.append(sig))
+                for sig in (signal.SIGTERM, signal.SIGINT)}
+
+    def start(index):
+        # Соединения с БД не должны достаться дочернему процессу по наследству
+        connections.close_all()
+        process = context.Process(target=consumer_process, args=(stop,), name=f'event-consumer-{index}')
+        process.start()
+        return process
+
+    processes = [start(index) for index in range(workers)]
+    log(f'Запущено обработчиков: {workers}')
+    try:
+        while True:
+            time.sleep(1)
+            if signals:
+                break
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    log(f'Обработчик {process.name} завершился с кодом {process.exitcode}, перезапуск')
+                    processes[index] = start(index)
+    finally:
+        stop.set()
+        for process in processes:
+            process.join(get_event_settings()['LEASE_SECONDS'])
+            if process.is_alive():
+                process.terminate()
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+    log('Обработчики остановлены')
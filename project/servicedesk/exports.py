@@ -0,0 +1,110 @@
+"""
+Потоковая выгрузка обращений с перепиской.
+
+Обращения читаются серверным курсором (.iterator) пачками по chunk_size,
+сообщения подгружаются prefetch'ем на каждую пачку, а данные отдаются
+строками по мере чтения - расход памяти не зависит от объема выгрузки.
+"""
+import csv
+import json
+from itertools import chain
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+
+from . import sharding
+from .models import Message
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'jsonl': ('application/x-ndjson; charset=utf-8', 'jsonl'),
+}
+
+DEFAULT_CHUNK_SIZE = 200
+
+TICKET_COLUMNS = (
+    'ticket_id', 'user_id', 'user_name', 'subject', 'status', 'priority',
+    'created_at', 'updated_at', 'closed_at',
+)
+MESSAGE_COLUMNS = ('message_id', 'is_admin', 'author', 'created_at', 'text', 'attachments')
+
+# С этих символов Excel начинает формулу: такие ячейки CSV экранируются апострофом
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+class Echo:
+    """Псевдофайл для csv.writer: write возвращает строку вместо записи"""
+
+    def write(self, value):
+        return value
+
+
+def iter_tickets(tickets, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Обращения с перепиской по всем шардам; сообщения загружаются одним запросом
+    на пачку обращений
+    """
+    messages = Message.objects.select_related('admin_author').order_by('created_at')
+    tickets = tickets.select_related('admin').prefetch_related(
+        Prefetch('messages', queryset=messages)
+    ).order_by('pk')
+    return chain.from_iterable(
+        queryset.iterator(chunk_size=chunk_size) for queryset in sharding.spread(tickets)
+    )
+
+
+def ticket_values(ticket):
+    values = [getattr(ticket, column) for column in TICKET_COLUMNS]
+    return values + [ticket.admin.username if ticket.admin else '']
+
+
+def message_values(message):
+    return [
+        message.message_id,
+        message.is_admin,
+        message.admin_author.username if message.admin_author else '',
+        message.created_at,
+        message.text,
+        json.dumps(message.attachments, ensure_ascii=False) if message.attachments else '',
+    ]
+
+
+def csv_safe(values):
+    """Текст пользователя, похожий на формулу (=HYPERLINK(...)), Excel покажет как текст"""
+    return [
+        f"'{value}" if isinstance(value, str) and value.startswith(FORMULA_PREFIXES) else value
+        for value in values
+    ]
+
+
+def stream_csv(tickets, chunk_size=DEFAULT_CHUNK_SIZE):
+    """CSV: строка на каждое сообщение, обращение без сообщений - одна строка"""
+    writer = csv.writer(Echo())
+    # BOM, чтобы Excel распознал UTF-8
+    yield '\ufeff' + writer.writerow(
+        list(TICKET_COLUMNS) + ['admin'] + [f'message_{column}' for column in MESSAGE_COLUMNS]
+    )
+    for ticket in iter_tickets(tickets, chunk_size):
+        prefix = csv_safe(ticket_values(ticket))
+        ticket_messages = ticket.messages.all()
+        if not ticket_messages:
+            yield writer.writerow(prefix)
+            continue
+        yield ''.join(writer.writerow(prefix + csv_safe(message_values(message))) for message in ticket_messages)
+
+
+def stream_jsonl(tickets, chunk_size=DEFAULT_CHUNK_SIZE):
+    """JSON Lines: одно обращение с массивом сообщений на строку"""
+    for ticket in iter_tickets(tickets, chunk_size):
+        data = dict(zip(TICKET_COLUMNS + ('admin',), ticket_values(ticket)))
+        data['messages'] = [
+            {**dict(zip(MESSAGE_COLUMNS, message_values(message))), 'attachments': message.attachments}
+            for message in ticket.messages.all()
+        ]
+        yield json.dumps(data, ensure_ascii=False, cls=DjangoJSONEncoder) + '\n'
+
+
+def export_tickets_stream(tickets, export_format, chunk_size=DEFAULT_CHUNK_SIZE):
+    if export_format == 'jsonl':
+        return stream_jsonl(tickets, chunk_size)
+    return stream_csv(tickets, chunk_size)
@@ -0,0 +1,145 @@
+"""Фильтры списка обращений, общие для страницы списка, API и выгрузок"""
+import hashlib
+import json
+from operator import itemgetter
+
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Count, Q
+
+from . import sharding
+from .fragments import get_cache_settings
+from .models import Ticket, TicketTag
+
+TICKET_FILTERS = ('status', 'priority', 'assigned', 'q', 'tag_mode')
+
+# Режимы фильтра по нескольким тегам: хотя бы один из тегов или все сразу
+TAG_MODES = ('any', 'all')
+
+# Подсказки поиска: сколько вариантов и с какой длины запроса
+TYPEAHEAD_LIMIT = 10
+TYPEAHEAD_MIN_LENGTH = 2
+# pg_trgm не извлекает триграммы из более коротких подстрок, и поиск идет мимо индекса
+TRIGRAM_MIN_LENGTH = 3
+
+
+def get_ticket_filters(params):
+    """
+    Значения фильтров из GET-параметров; отсутствующие - пустые строки.
+    Теги передаются несколькими параметрами ?tag=1&tag=2 и собираются в список id
+    """
+    filters = {name: params.get(name, '') for name in TICKET_FILTERS}
+    filters['tag'] = sorted({int(value) for value in params.getlist('tag') if value.isdigit()})
+    return filters
+
+
+def tagged_ticket_ids(tag_ids, mode='any'):
+    """Подзапрос id обращений с любым (any) или всеми (all) тегами; идет по индексу (tag, ticket)"""
+    links = TicketTag.objects.filter(tag_id__in=tag_ids)
+    if mode == 'all':
+        links = links.order_by().values('ticket_id').annotate(
+            matched=Count('tag_id')
+        ).filter(matched=len(tag_ids))
+    return links.values('ticket_id')
+
+
+def filter_tickets(tickets, filters, user=None):
+    """Применяет фильтры к queryset обращений; assigned=me учитывается только при user"""
+    if filters.get('status'):
+        tickets = tickets.filter(status=filters['status'])
+    if filters.get('priority'):
+        tickets = tickets.filter(priority=filters['priority'])
+    if filters.get('assigned') == 'me' and user is not None:
+        tickets = tickets.filter(admin=user)
+    elif filters.get('assigned') == 'unassigned':
+        tickets = tickets.filter(admin__isnull=True)
+    if filters.get('tag'):
+        tickets = tickets.filter(pk__in=tagged_ticket_ids(filters['tag'], filters.get('tag_mode')))
+
+    # Поиск
+    search_query = filters.get('q')
+    if search_query:
+        tickets = tickets.filter(
+            Q(ticket_id__icontains=search_query) |
+            Q(user_name__icontains=search_query) |
+            Q(subject__icontains=search_query) |
+            Q(messages__text__icontains=search_query)
+        ).distinct()
+    return tickets
+
+
+def facets_cache_key(filters, user=None):
+    """Ключ кэша по набору фильтров; для assigned=me набор зависит от пользователя"""
+    signature = {name: value for name, value in filters.items() if value}
+    if filters.get('assigned') == 'me' and user is not None:
+        signature['user'] = user.pk
+    digest = hashlib.md5(json.dumps(signature, sort_keys=True).encode()).hexdigest()
+    return f'servicedesk:tag-facets:{digest}'
+
+
+def tag_facets(filters, user=None):
+    """
+    Число обращений с каждым тегом при текущих фильтрах: {tag_id: count}.
+    Считается одним GROUP BY по таблице связей каждого шарда и кэшируется по набору фильтров
+    на FACETS_TIMEOUT секунд
+    """
+    key = facets_cache_key(filters, user)
+    counts = cache.get(key)
+    if counts is None:
+        counts = {}
+        for _ in sharding.for_each_shard():
+            tickets = filter_tickets(Ticket.objects.all(), filters, user)
+            rows = TicketTag.objects.filter(ticket_id__in=tickets.values('pk')).order_by().values(
+                'tag_id'
+            ).annotate(count=Count('ticket_id'))
+            for row in rows:
+                counts[row['tag_id']] = counts.get(row['tag_id'], 0) + row['count']
+        cache.set(key, counts, get_cache_settings()['FACETS_TIMEOUT'])
+    return counts
+
+
+def typeahead_filter(query, vendor):
+    """Условие подсказок, которое идет по индексам миграции 0012"""
+    if vendor == 'postgresql':
+        # Подстрока: GIN pg_trgm по UPPER(user_name) и ticket_id
+        return Q(ticket_id__contains=query) | Q(user_name__icontains=query)
+    # Без pg_trgm - только начало номера или имени
+    return Q(ticket_id__startswith=query) | Q(user_name__istartswith=query)
+
+
+def typeahead_min_length(vendor):
+    return TRIGRAM_MIN_LENGTH if vendor == 'postgresql' else TYPEAHEAD_MIN_LENGTH
+
+
+def typeahead_tickets(query, vendor, limit=TYPEAHEAD_LIMIT):
+    """
+    Подсказки одного шарда, новые первыми. Сортировка по created_at, а не по pk:
+    для ORDER BY pk LIMIT планировщик может пойти обратным проходом по первичному
+    ключу и при редком совпадении прочитать всю таблицу, а отдельного индекса по
+    created_at нет, поэтому совпадения берутся по индексам подсказок
+    """
+    return Ticket.objects.filter(typeahead_filter(query, vendor)).order_by('-created_at').values(
+        'ticket_id', 'user_name', 'subject', 'status', 'created_at'
+    )[:limit]
+
+
+def ticket_typeahead(query, limit=TYPEAHEAD_LIMIT):
+    """
+    Подсказки по части имени пользователя или номера обращения:
+    [{ticket_id, user_name, subject, status, created_at}], новые первыми.
+    Результат кэшируется по тексту запроса на TYPEAHEAD_TIMEOUT секунд
+    """
+    query = query.strip()
+    if len(query) < TYPEAHEAD_MIN_LENGTH:
+        return []
+    key = f'servicedesk:typeahead:{limit}:{hashlib.md5(query.encode()).hexdigest()}'
+    results = cache.get(key)
+    if results is None:
+        results = []
+        for alias in sharding.for_each_shard():
+            vendor = connections[alias].vendor
+            if len(query) >= typeahead_min_length(vendor):
+                results.extend(typeahead_tickets(query, vendor, limit))
+        results = sorted(results, key=itemgetter('created_at'), reverse=True)[:limit]
+        cache.set(key, results, get_cache_settings()['TYPEAHEAD_TIMEOUT'])
+    return results
@@ -0,0 +1,90 @@
+"""
+Кэширование отрендеренных фрагментов шаблонов и редко меняющихся справочников.
+
+Строка списка обращений кэшируется по версии обращения, пузырь сообщения -
+по id сообщения. Версия обращения хранится в кэше: сигналы сохранения
+Ticket/Message (signals.py) ее сбрасывают, а для массовых UPDATE, которые
+сигналов не вызывают, нужно явно вызвать touch_tickets(). Версии строк
+страницы читаются одним get_many, поэтому заново рендерятся только
+изменившиеся строки. id в разных шардах могут совпадать, поэтому ключи
+включают шард (по умолчанию - текущий).
+
+Кэш должен быть общим для всех процессов (Redis, Memcached): иначе сброс
+в одном процессе не виден в остальных.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db import DEFAULT_DB_ALIAS
+
+from . import sharding
+from .models import Tag
+
+ROW_FRAGMENT = 'ticket_row'
+MESSAGE_FRAGMENT = 'message_bubble'
+TAGS_KEY = 'servicedesk:tags'
+
+
+def get_cache_settings():
+    options = {
+        # Время жизни фрагментов и версий обращений, секунды
+        'FRAGMENT_TIMEOUT': 3600,
+        # Время жизни справочника тегов, секунды
+        'TAGS_TIMEOUT': 300,
+        # Время жизни счетчиков обращений по тегам для набора фильтров, секунды
+        'FACETS_TIMEOUT': 60,
+        # Время жизни подсказок поиска для одного запроса, секунды
+        'TYPEAHEAD_TIMEOUT': 30,
+    }
+    options.update(getattr(settings, 'SERVICEDESK_CACHE', {}))
+    return options
+
+
+def version_key(ticket_pk, shard=None):
+    shard = shard or sharding.current_shard()
+    if shard == DEFAULT_DB_ALIAS:
+        return f'servicedesk:ticket-version:{ticket_pk}'
+    return f'servicedesk:ticket-version:{shard}:{ticket_pk}'
+
+
+def attach_versions(tickets):
+    """Проставляет ticket.fragment_version каждому обращению одним чтением кэша"""
+    keys = [version_key(ticket.pk, sharding.instance_shard(ticket)) for ticket in tickets]
+    versions = cache.get_many(keys)
+    missing = {}
+    for ticket, key in zip(tickets, keys):
+        if key not in versions:
+            versions[key] = missing[key] = uuid.uuid4().hex
+        ticket.fragment_version = versions[key]
+    if missing:
+        cache.set_many(missing, get_cache_settings()['FRAGMENT_TIMEOUT'])
+    return tickets
+
+
+def touch_tickets(ticket_pks, shard=None):
+    """Сбрасывает версии обращений шарда: их строки будут отрендерены заново"""
+    cache.delete_many([version_key(pk, shard) for pk in ticket_pks])
+
+
+def message_key(message_pk, shard=None):
+    """Ключ фрагмента пузыря сообщения; в шаблоне - {% cache ... message_bubble message.pk shard %}"""
+    return make_template_fragment_key(MESSAGE_FRAGMENT, [message_pk, shard or sharding.current_shard()])
+
+
+def invalidate_messages(message_pks, shard=None):
+    cache.delete_many([message_key(pk, shard) for pk in message_pks])
+
+
+def cached_tags():
+    """Все теги; список сбрасывается сигналами сохранения и удаления Tag"""
+    tags = cache.get(TAGS_KEY)
+    if tags is None:
+        tags = list(Tag.objects.all())
+        cache.set(TAGS_KEY, tags, get_cache_settings()['TAGS_TIMEOUT'])
+    return tags
+
+
+def invalidate_tags():
+    cache.delete(TAGS_KEY)
@@ -0,0 +1,197 @@
+"""
+Импорт истории диалогов сообщества из VK API.
+
+Сначала messages.getConversations дает снимок списка собеседников: список
+отсортирован по последнему сообщению, и диалог с новым сообщением уходит в
+его начало, поэтому по смещению в живом списке часть диалогов пропускалась
+бы. Снимок и число обработанных из него собеседников хранятся в
+JobCheckpoint, поэтому прерванный импорт продолжается по тому же снимку.
+Дальше история каждого собеседника - messages.getHistory в несколько
+потоков, профили - одним users.get на страницу. Обращения создаются
+bulk_create, сообщения - пачками с проверкой уже сохраненных message_id.
+Для параллельного запуска нескольких процессов диалоги делятся на части
+по peer_id (shard_index из shard_count), у каждой части свой снимок.
+Обращения пишутся в шард базы группы (sharding.group_shard).
+
+Импорт пишет обращения и сообщения напрямую, минуя распределение по
+операторам, счетчики аналитики и сводки пользователей: после него нужно
+выполнить rebuild_user_summaries, backfill_analytics и rebuild_operator_load.
+Импортированные открытые обращения остаются неназначенными и ждут в очереди.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+
+from . import sharding
+from .event_handlers import USER_FIELDS, extract_subject
+from .models import JobCheckpoint, Message, Ticket
+from .vk_api import VKClient
+
+CONVERSATIONS_PAGE = 200
+HISTORY_PAGE = 200
+USERS_PER_CALL = 1000
+
+
+def message_time(item):
+    return datetime.fromtimestamp(item['date'], tz=dt_timezone.utc)
+
+
+class HistoryImporter:
+    """Импорт диалогов одной группы ВК; client - любой объект с методом call(method, **params)"""
+
+    def __init__(self, group, client=None, workers=4, shard_index=0, shard_count=1,
+                 chunk_size=1000, log=None):
+        self.group = group
+        self.client = client or VKClient(group.access_token)
+        self.workers = workers
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.chunk_size = chunk_size
+        self.log = log or (lambda message: None)
+        self.checkpoint = JobCheckpoint.load(
+            f'vk_import:{group.group_id}:{shard_index}/{shard_count}'
+        )
+        self.stats = {'conversations': 0, 'tickets': 0, 'messages': 0}
+
+    def run(self, max_pages=None):
+        with sharding.use_shard(sharding.group_shard(self.group)):
+            return self.import_pages(max_pages)
+
+    def reset(self):
+        """Следующий запуск начнет импорт заново, с нового снимка диалогов"""
+        self.checkpoint.position = {}
+        self.checkpoint.save(update_fields=['position', 'updated_at'])
+
+    def import_pages(self, max_pages):
+        if 'peers' not in self.checkpoint.position:
+            self.checkpoint.store(peers=self.snapshot_peers(), done=0)
+        snapshot = self.checkpoint.position['peers']
+        done = self.checkpoint.position['done']
+        pages = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while done < len(snapshot) and (max_pages is None or pages < max_pages):
+                peers = snapshot[done:done + CONVERSATIONS_PAGE]
+                histories = dict(zip(peers, pool.map(self.fetch_history, peers)))
+                profiles = self.fetch_profiles(peers)
+                self.store(histories, profiles)
+
+                done += len(peers)
+                pages += 1
+                self.checkpoint.store(done=done)
+                self.stats['conversations'] += len(peers)
+                self.log(f"Диалогов: {self.stats['conversations']}, сообщений: {self.stats['messages']}")
+        return self.stats
+
+    def snapshot_peers(self):
+        """
+        Собеседники этой части диалогов в порядке списка. Диалоги, получившие
+        сообщение во время чтения списка, переезжают в уже прочитанное начало,
+        поэтому в конце начало списка перечитывается до диалогов старше снимка
+        """
+        started = time.time()
+        peers = {}
+        self.read_conversations(peers)
+        self.read_conversations(peers, since=started)
+        return list(peers)
+
+    def read_conversations(self, peers, since=None):
+        """Добавляет в peers собеседников из списка диалогов; с since - только до первого диалога старше since"""
+        offset = 0
+        while True:
+            page = self.client.call('messages.getConversations', offset=offset, count=CONVERSATIONS_PAGE)
+            items = page.get('items', [])
+            for item in items:
+                if since is not None and item.get('last_message', {}).get('date', 0) < since:
+                    return
+                peer = item['conversation']['peer']
+                if peer['type'] == 'user' and peer['id'] % self.shard_count == self.shard_index:
+                    peers[peer['id']] = True
+            if not items:
+                return
+            offset += len(items)
+
+    def fetch_history(self, peer_id):
+        """Вся история диалога в хронологическом порядке"""
+        items = []
+        while True:
+            page = self.client.call(
+                'messages.getHistory', peer_id=peer_id, offset=len(items), count=HISTORY_PAGE, rev=1
+            )
+            batch = page.get('items', [])
+            items.extend(batch)
+            if len(batch) < HISTORY_PAGE:
+                return items
+
+    def fetch_profiles(self, peers):
+        profiles = {}
+        for start in range(0, len(peers), USERS_PER_CALL):
+            user_ids = ','.join(str(peer) for peer in peers[start:start + USERS_PER_CALL])
+            for user in self.client.call('users.get', user_ids=user_ids, fields=USER_FIELDS):
+                profiles[user['id']] = {
+                    'name': f"{user['first_name']} {user['last_name']}",
+                    'photo': user.get('photo_100') or '',
+                }
+        return profiles
+
+    def store(self, histories, profiles):
+        histories = {peer: items for peer, items in histories.items() if items}
+        if not histories:
+            return
+
+        with sharding.atomic():
+            # Историю добавляем в последнее обращение собеседника, если оно уже есть
+            tickets = {}
+            for ticket in Ticket.objects.filter(vk_group=self.group, user_id__in=histories).order_by('created_at'):
+                tickets[ticket.user_id] = ticket
+
+            new_tickets = [
+                self.build_ticket(peer, items, profiles.get(peer, {}))
+                for peer, items in histories.items() if peer not in tickets
+            ]
+            for ticket, ticket_id in zip(new_tickets, Ticket.allocate_ticket_ids(len(new_tickets))):
+                ticket.ticket_id = ticket_id
+            for ticket in Ticket.objects.bulk_create(new_tickets):
+                tickets[ticket.user_id] = ticket
+            self.stats['tickets'] += len(new_tickets)
+
+        pending = [(tickets[peer], item) for peer, items in histories.items() for item in items]
+        for start in range(0, len(pending), self.chunk_size):
+            self.store_messages(pending[start:start + self.chunk_size])
+
+    def build_ticket(self, peer, items, profile):
+        first_text = next((item.get('text', '') for item in items if item['from_id'] == peer), '')
+        last = items[-1]
+        # Если последним писал пользователь, обращение ждет ответа
+        is_waiting = last['from_id'] == peer
+        return Ticket(
+            user_id=peer,
+            user_name=profile.get('name', f'Пользователь {peer}'),
+            user_photo=profile.get('photo', ''),
+            subject=extract_subject(first_text),
+            status='open' if is_waiting else 'closed',
+            closed_at=None if is_waiting else message_time(last),
+            waiting_since=message_time(last) if is_waiting else None,
+            created_at=message_time(items[0]),
+            vk_group=self.group,
+        )
+
+    def store_messages(self, chunk):
+        with sharding.atomic():
+            existing = set(Message.objects.filter(
+                ticket__in={ticket.pk for ticket, _ in chunk},
+                message_id__in=[item['id'] for _, item in chunk],
+            ).values_list('ticket_id', 'message_id'))
+            messages = [
+                Message(
+                    ticket=ticket,
+                    message_id=item['id'],
+                    text=item.get('text', ''),
+                    attachments=item.get('attachments', []),
+                    is_admin=item['from_id'] != ticket.user_id,
+                    is_read=True,
+                    created_at=message_time(item),
+                )
+                for ticket, item in chunk if (ticket.pk, item['id']) not in existing
+            ]
+            Message.objects.bulk_create(messages, ignore_conflicts=True)
+        self.stats['messages'] += len(messages)
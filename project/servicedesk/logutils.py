@@ -0,0 +1,119 @@
+"""
+Структурированное логирование с фоновой записью.
+
+Обработчики запросов только кладут запись в ограниченную очередь,
+форматирование в JSON и запись в поток выполняет фоновый поток.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# Атрибуты, которые есть у любой LogRecord; все остальные пришли через extra
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def truncate(value, max_length):
+    """Обрезает строку до max_length символов с пометкой об исходной длине"""
+    if len(value) <= max_length:
+        return value
+    return f"{value[:max_length]}...(+{len(value) - max_length})"
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись в одну строку JSON, длинные поля обрезаются"""
+
+    def __init__(self, max_length=2000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_length = max_length
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': truncate(record.getMessage(), self.max_length),
+        }
+        for key, value in vars(record).items():
+            if key in _RECORD_ATTRS or key.startswith('_'):
+                continue
+            if not isinstance(value, (str, int, float, bool, type(None))):
+                value = json.dumps(value, ensure_ascii=False, default=str)
+            if isinstance(value, str):
+                value = truncate(value, self.max_length)
+            entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class EventSamplingFilter(logging.Filter):
+    """
+    Пропускает долю записей в зависимости от типа события (атрибут event_type).
+    Предупреждения и ошибки пропускаются всегда.
+    """
+
+    def __init__(self, rates=None, default_rate=1.0):
+        super().__init__()
+        self.rates = rates or {}
+        self.default_rate = default_rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        event_type = getattr(record, 'event_type', None)
+        if event_type is None:
+            return True
+        rate = self.rates.get(event_type, self.default_rate)
+        return rate >= 1 or random.random() < rate
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Кладет записи в ограниченную очередь, которую разбирает фоновый поток.
+    При переполнении очереди запись отбрасывается и учитывается в dropped,
+    поэтому логирование никогда не блокирует обработку запроса.
+    """
+
+    def __init__(self, handler=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = handler or logging.StreamHandler(sys.stdout)
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+        self.closed = False
+        atexit.register(self.close)
+        # Поток записи не переживает fork (serve, consume_events): в дочернем процессе запускается свой
+        os.register_at_fork(after_in_child=self.restart)
+
+    def restart(self):
+        if self.closed:
+            return
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        # Форматирование выполняется в фоновом потоке целевым обработчиком
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Очередь внутри процесса: запись не нужно сериализовать заранее
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.closed = True
+        if self.listener._thread is not None:
+            self.listener.stop()
+        self.target.close()
+        super().close()
@@ -0,0 +1,160 @@
+"""
+Прием событий сообщества через Bots Long Poll API вместо Callback API.
+
+Сервер и ключ выдает groups.getLongPollServer, дальше один долгий запрос
+a_check возвращает все накопившиеся события пачкой. События в том же
+формате, что и у Callback API, и идут в те же обработчики (event_queue):
+при QUEUE=True пачка ставится в очередь одной вставкой. Номер ts
+сохраняется в JobCheckpoint после того, как пачка принята, поэтому после
+перезапуска прием продолжается без потерь (возможны повторы, обработчики
+к ним устойчивы). Если обработчик упал, ts не сдвигается: после паузы
+пачка запрашивается с сохраненного ts и обрабатывается заново. Попытки
+с одного ts считаются в JobCheckpoint; на последней из MAX_ATTEMPTS
+(SERVICEDESK_EVENTS) события, которые снова упали, откладываются в
+InboundEvent с failed=True, как в очереди событий, и прием идет дальше.
+"""
+import logging
+import time
+
+import requests
+
+from . import event_queue
+from .models import InboundEvent, JobCheckpoint
+from .vk_api import VKAPIError, VKClient
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд сервер держит запрос без событий (максимум VK - 90)
+DEFAULT_WAIT = 25
+
+# Пауза перед повтором после сетевой ошибки растет до этого значения, секунды
+MAX_RETRY_DELAY = 60
+
+
+class DeliveryError(Exception):
+    """Обработчик упал на событии пачки; ts не сохранен, пачка будет получена повторно"""
+
+
+class LongPollListener:
+    """
+    Цикл приема событий одной группы; client - объект с методом call(method, **params),
+    session - с методом get, как у requests.Session
+    """
+
+    def __init__(self, group, client=None, session=None, wait=DEFAULT_WAIT, log=None, handlers=None,
+                 batch_handlers=None):
+        self.group = group
+        self.client = client or VKClient(group.access_token)
+        self.session = session or requests.Session()
+        self.wait = wait
+        self.log = log or (lambda message: None)
+        self.handlers = handlers
+        self.batch_handlers = event_queue.default_batch_handlers(handlers, batch_handlers)
+        self.checkpoint = JobCheckpoint.load(f'vk_longpoll:{group.group_id}')
+        self.server = self.key = None
+        self.stopped = False
+        self.stats = {'polls': 0, 'events': 0, 'reconnects': 0}
+
+    @property
+    def ts(self):
+        return self.checkpoint.position.get('ts')
+
+    @property
+    def attempts(self):
+        """Сколько раз уже упала обработка пачки с сохраненного ts"""
+        return self.checkpoint.position.get('attempts', 0)
+
+    def store_ts(self, ts):
+        self.checkpoint.store(ts=ts, attempts=0)
+
+    def stop(self):
+        """Остановка после текущего запроса (например, из обработчика SIGTERM)"""
+        self.stopped = True
+
+    def run(self, max_polls=None):
+        retry_delay = 1
+        while not self.stopped and (max_polls is None or self.stats['polls'] < max_polls):
+            try:
+                if self.server is None:
+                    self.connect()
+                self.poll()
+                retry_delay = 1
+            except DeliveryError:
+                # ts не сохранен, пачка будет получена повторно с тем же ключом
+                logger.exception("Error processing VK events", extra={'vk_group_id': self.group.group_id})
+                self.checkpoint.store(attempts=self.attempts + 1)
+            except (requests.RequestException, VKAPIError, ValueError):
+                logger.exception("Long Poll request failed", extra={'vk_group_id': self.group.group_id})
+                self.server = None
+            else:
+                continue
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+        return self.stats
+
+    def connect(self, new_ts=False):
+        """Получает сервер и ключ; ts берется новый, только если сохраненного нет или он потерян"""
+        server = self.client.call('groups.getLongPollServer', group_id=self.group.group_id)
+        self.server, self.key = server['server'], server['key']
+        if new_ts or self.ts is None:
+            self.store_ts(server['ts'])
+        self.stats['reconnects'] += 1
+
+    def poll(self):
+        response = self.session.get(
+            self.server,
+            params={'act': 'a_check', 'key': self.key, 'ts': self.ts, 'wait': self.wait},
+            timeout=self.wait + 10,
+        )
+        response.raise_for_status()
+        data = response.json()
+        self.stats['polls'] += 1
+
+        failed = data.get('failed')
+        if failed == 1:
+            # Часть истории событий потеряна: продолжаем с ts, который вернул сервер
+            logger.warning("Long Poll history lost", extra={'vk_group_id': self.group.group_id})
+            self.store_ts(data['ts'])
+        elif failed == 2:
+            # Истек ключ: ts остается прежним
+            self.connect()
+        elif failed == 3:
+            # Потеряна информация о подключении: нужны новые ключ и ts
+            logger.warning("Long Poll session lost", extra={'vk_group_id': self.group.group_id})
+            self.connect(new_ts=True)
+        elif failed:
+            raise ValueError(f'Unexpected Long Poll answer: {data}')
+        else:
+            updates = data.get('updates', [])
+            if updates:
+                self.deliver(updates)
+            self.store_ts(data['ts'])
+
+    def deliver(self, updates):
+        """
+        Передает пачку событий обработчикам или в очередь. Ошибка обработчика -
+        DeliveryError, чтобы ts не сохранился и пачка не потерялась; на последней
+        попытке упавшие события откладываются в InboundEvent с failed=True
+        """
+        if event_queue.queue_enabled():
+            InboundEvent.objects.bulk_create([event_queue.build_event(update) for update in updates])
+        else:
+            max_attempts = event_queue.get_event_settings()['MAX_ATTEMPTS']
+            failed = []
+            # Сообщения одного пользователя из пачки записываются вместе
+            for run in event_queue.coalesce(updates, self.batch_handlers):
+                try:
+                    event_queue.handle_run(run, self.handlers, self.batch_handlers)
+                except Exception as e:
+                    if self.attempts + 1 < max_attempts:
+                        raise DeliveryError(f'Handler failed on {run[0].get("type")}') from e
+                    logger.exception("Error processing VK event, event set aside", extra={
+                        'event_type': run[0].get('type'), 'vk_group_id': self.group.group_id,
+                    })
+                    for data in run:
+                        event = event_queue.build_event(data)
+                        event.attempts, event.last_error, event.failed = max_attempts, repr(e), True
+                        failed.append(event)
+            InboundEvent.objects.bulk_create(failed)
+        self.stats['events'] += len(updates)
+        self.log(f"Событий: {self.stats['events']}")
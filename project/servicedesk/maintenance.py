@@ -0,0 +1,152 @@
+"""
+Обслуживание данных: автозакрытие простаивающих обращений и очистка старой
+переписки по политике хранения.
+
+Все шаги идут пачками ограниченного размера с ключевой итерацией по pk,
+каждая пачка - отдельная короткая транзакция, строки, занятые операторами,
+пропускаются (SKIP LOCKED). Позиция шага сохраняется в JobCheckpoint, поэтому
+прерванный запуск продолжается с того же места. Шарды обращений обходятся
+по очереди, у каждого шарда свои позиции шагов. Функцию run_maintenance
+можно вызывать из планировщика (cron, celery beat) или командой maintain_tickets.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+from . import analytics, assignment, fragments, sharding, timeline
+from .models import JobCheckpoint, Message, Ticket
+
+CHECKPOINT_NAME = 'maintenance'
+
+
+def get_maintenance_settings():
+    options = {
+        # Через сколько дней простоя закрывать обращение в данном статусе
+        'AUTO_CLOSE_AFTER_DAYS': {'answered': 7},
+        # Сообщения закрытых обращений старше N дней удаляются (None - хранить всегда)
+        'MESSAGE_RETENTION_DAYS': None,
+        # Вложения сообщений старше N дней очищаются (None - хранить всегда)
+        'ATTACHMENT_RETENTION_DAYS': None,
+        'BATCH_SIZE': 500,
+        # Пауза между пачками, секунды
+        'BATCH_PAUSE': 0.1,
+    }
+    options.update(getattr(settings, 'SERVICEDESK_MAINTENANCE', {}))
+    return options
+
+
+class MaintenanceRun:
+    """Один запуск обслуживания; max_batches ограничивает длительность запуска"""
+
+    def __init__(self, batch_size=None, pause=None, max_batches=None, now=None, log=None):
+        self.options = get_maintenance_settings()
+        self.batch_size = batch_size or self.options['BATCH_SIZE']
+        self.pause = self.options['BATCH_PAUSE'] if pause is None else pause
+        self.batches_left = max_batches
+        self.now = now or timezone.now()
+        self.log = log or (lambda message: None)
+        self.checkpoint = JobCheckpoint.load(CHECKPOINT_NAME)
+        self.stats = {'closed': 0, 'messages_deleted': 0, 'attachments_cleared': 0}
+
+    def run(self):
+        for _ in sharding.for_each_shard():
+            self.run_shard()
+        return self.stats
+
+    def run_shard(self):
+        for status, days in self.options['AUTO_CLOSE_AFTER_DAYS'].items():
+            if days is not None and not self.exhausted:
+                self.auto_close(status, self.now - timedelta(days=days))
+        if self.options['MESSAGE_RETENTION_DAYS'] is not None and not self.exhausted:
+            self.purge_messages(self.now - timedelta(days=self.options['MESSAGE_RETENTION_DAYS']))
+        if self.options['ATTACHMENT_RETENTION_DAYS'] is not None and not self.exhausted:
+            self.clear_attachments(self.now - timedelta(days=self.options['ATTACHMENT_RETENTION_DAYS']))
+
+    @property
+    def exhausted(self):
+        return self.batches_left is not None and self.batches_left <= 0
+
+    def iterate(self, step, queryset, process):
+        """
+        Проходит queryset пачками по возрастанию pk начиная с сохраненной позиции.
+        process(pks) обрабатывает пачку в своей транзакции
+        """
+        alias = sharding.current_shard()
+        if alias != DEFAULT_DB_ALIAS:
+            step = f'{step}@{alias}'
+        last_pk = self.checkpoint.position.get(step, 0)
+        while not self.exhausted:
+            pks = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:self.batch_size])
+            if not pks:
+                # Шаг пройден до конца: следующий запуск начнет с начала
+                self.checkpoint.store(**{step: 0})
+                return
+            process(pks)
+            last_pk = pks[-1]
+            self.checkpoint.store(**{step: last_pk})
+            if self.batches_left is not None:
+                self.batches_left -= 1
+            if self.pause:
+                time.sleep(self.pause)
+
+    def auto_close(self, status, idle_before):
+        idle = Ticket.objects.filter(status=status, updated_at__lt=idle_before)
+
+        def close_batch(pks):
+            with sharding.atomic():
+                # Повторная проверка условия под блокировкой: обращение могли обновить
+                tickets = list(
+                    idle.filter(pk__in=pks).select_for_update(skip_locked=True).only(
+                        'pk', 'ticket_id', 'user_id', 'status', 'priority', 'load_weight', 'created_at',
+                        'vk_group_id', 'admin_id'
+                    )
+                )
+                if not tickets:
+                    return
+                load_before = assignment.snapshot(tickets)
+                # update() не трогает auto_now: без updated_at закрытые остались бы на старом месте списка
+                Ticket.objects.filter(pk__in=[ticket.pk for ticket in tickets]).update(
+                    status='closed', closed_at=self.now, updated_at=self.now
+                )
+                for ticket in tickets:
+                    ticket.status = 'closed'
+                    ticket.closed_at = self.now
+                assignment.rebalance(load_before, tickets)
+                analytics.record_resolved(tickets)
+            timeline.tickets_closed(tickets)
+            fragments.touch_tickets([ticket.pk for ticket in tickets])
+            self.stats['closed'] += len(tickets)
+            self.log(f'Закрыто обращений в статусе {status}: {self.stats["closed"]}')
+
+        self.iterate(f'auto_close:{status}', idle, close_batch)
+
+    def purge_messages(self, older_than):
+        old = Message.objects.filter(created_at__lt=older_than, ticket__status='closed')
+
+        def delete_batch(pks):
+            with sharding.atomic():
+                deleted, _ = Message.objects.filter(pk__in=pks).delete()
+            self.stats['messages_deleted'] += deleted
+            self.log(f'Удалено сообщений: {self.stats["messages_deleted"]}')
+
+        self.iterate('purge_messages', old, delete_batch)
+
+    def clear_attachments(self, older_than):
+        old = Message.objects.filter(created_at__lt=older_than).exclude(attachments=[])
+
+        def clear_batch(pks):
+            with sharding.atomic():
+                cleared = Message.objects.filter(pk__in=pks).update(attachments=[])
+            fragments.invalidate_messages(pks)
+            self.stats['attachments_cleared'] += cleared
+            self.log(f'Очищено вложений: {self.stats["attachments_cleared"]}')
+
+        self.iterate('clear_attachments', old, clear_batch)
+
+
+def run_maintenance(**kwargs):
+    """Точка входа для планировщика"""
+    return MaintenanceRun(**kwargs).run()
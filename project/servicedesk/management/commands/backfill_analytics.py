@@ -0,0 +1,117 @@
+from datetime import timedelta
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from project.servicedesk import sharding
+from project.servicedesk.analytics import RollupBatch, get_tag_ids, hour_bucket, ticket_dimensions
+from project.servicedesk.models import Message, StatsRollup, Ticket
+
+TICKET_FIELDS = ('pk', 'created_at', 'closed_at', 'status', 'first_response_at', 'vk_group_id', 'admin_id')
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересчитывает почасовые агрегаты аналитики по истории обращений. "
+        "Обрабатываются события до начала текущего часа, текущий час остается "
+        "за инкрементальными счетчиками. Агрегаты пересчитываются окнами по "
+        "времени: удаление и запись агрегатов окна - одна транзакция, поэтому "
+        "отчеты во время пересчета видят полные данные, а прерванный пересчет "
+        "оставляет непересчитанные окна как были."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Сколько обращений или сообщений обрабатывать за один проход')
+        parser.add_argument('--window-hours', type=int, default=24,
+                            help='Сколько часов агрегатов пересчитывать в одной транзакции')
+
+    def handle(self, *args, **options):
+        self.chunk_size = options['chunk_size']
+        window = timedelta(hours=options['window_hours'])
+        cutoff = hour_bucket(timezone.now())
+
+        starts = []
+        for _ in sharding.for_each_shard():
+            earliest = Ticket.objects.aggregate(earliest=Min('created_at'))['earliest']
+            if earliest is not None:
+                starts.append(hour_bucket(earliest))
+        start = min(starts, default=cutoff)
+
+        # Агрегаты раньше первого обращения остались от удаленных данных
+        deleted, _ = StatsRollup.objects.filter(bucket__lt=start).delete()
+        self.stdout.write(f'Удалено старых агрегатов: {deleted}')
+
+        window_start = start
+        while window_start < cutoff:
+            window_end = min(window_start + window, cutoff)
+            with transaction.atomic():
+                StatsRollup.objects.filter(bucket__gte=window_start, bucket__lt=window_end).delete()
+                batch = RollupBatch()
+                for _ in sharding.for_each_shard():
+                    self.process_window(batch, window_start, window_end)
+                batch.save()
+            self.stdout.write(f'Пересчитаны агрегаты до {window_end:%Y-%m-%d %H:%M}')
+            window_start = window_end
+
+        self.stdout.write(self.style.SUCCESS('Агрегаты пересчитаны'))
+
+    def process_window(self, batch, start, end):
+        """Добавляет в batch события текущего шарда с моментом в [start, end)"""
+        created = Ticket.objects.filter(created_at__gte=start, created_at__lt=end).only(*TICKET_FIELDS)
+        for tickets in chunked(created.order_by('pk').iterator(chunk_size=self.chunk_size), self.chunk_size):
+            tag_ids = get_tag_ids(tickets)
+            for ticket in tickets:
+                batch.add(ticket_dimensions(ticket, tag_ids[ticket.pk]), ticket.created_at, tickets_created=1)
+
+        closed = Ticket.objects.filter(status='closed', closed_at__gte=start, closed_at__lt=end).only(*TICKET_FIELDS)
+        for tickets in chunked(closed.order_by('pk').iterator(chunk_size=self.chunk_size), self.chunk_size):
+            tag_ids = get_tag_ids(tickets)
+            for ticket in tickets:
+                seconds = (ticket.closed_at - ticket.created_at).total_seconds()
+                batch.add(ticket_dimensions(ticket, tag_ids[ticket.pk], ticket.admin_id), ticket.closed_at,
+                          resolved=1, resolution_seconds=int(seconds))
+
+        messages = Message.objects.filter(created_at__gte=start, created_at__lt=end).order_by('pk').values_list(
+            'ticket_id', 'is_admin', 'admin_author_id', 'created_at'
+        )
+        for rows in chunked(messages.iterator(chunk_size=self.chunk_size), self.chunk_size):
+            self.process_messages(batch, rows)
+
+    def process_messages(self, batch, rows):
+        ticket_pks = {row[0] for row in rows}
+        by_pk = Ticket.objects.only(*TICKET_FIELDS).in_bulk(ticket_pks)
+        tag_ids = get_tag_ids(list(by_pk.values()))
+        # Первый ответ обращения - самое раннее сообщение оператора, где бы в истории оно ни было
+        first_replies = dict(
+            Message.objects.filter(ticket_id__in={row[0] for row in rows if row[1]}, is_admin=True)
+            .values('ticket_id').annotate(first=Min('created_at')).values_list('ticket_id', 'first')
+        )
+
+        missing = []
+        for ticket_pk, is_admin, author_id, created_at in rows:
+            ticket = by_pk[ticket_pk]
+            if is_admin:
+                dimensions = ticket_dimensions(ticket, tag_ids[ticket_pk], author_id)
+                batch.add(dimensions, created_at, messages_sent=1)
+                if first_replies.get(ticket_pk) == created_at:
+                    # Одновременные ответы засчитываются первой реакцией один раз
+                    del first_replies[ticket_pk]
+                    seconds = (created_at - ticket.created_at).total_seconds()
+                    batch.add(dimensions, created_at, first_responses=1, first_response_seconds=int(seconds))
+                    if ticket.first_response_at is None:
+                        ticket.first_response_at = created_at
+                        missing.append(ticket)
+            else:
+                dimensions = ticket_dimensions(ticket, tag_ids[ticket_pk], ticket.admin_id)
+                batch.add(dimensions, created_at, messages_received=1)
+        Ticket.objects.bulk_update(missing, ['first_response_at'])
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+
+from project.servicedesk.admission import rejection_counts
+from project.servicedesk.event_queue import PartitionConsumer, get_event_settings, partition_lag, run_pool
+from project.servicedesk.server import shared_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Обрабатывает очередь входящих событий VK (SERVICEDESK_EVENTS['QUEUE']) "
+        "пулом процессов. События одного собеседника обрабатываются по порядку, "
+        "партиции делятся между всеми запущенными обработчиками, в том числе на "
+        "разных серверах. Останавливается по SIGTERM/SIGINT после текущей пачки."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            help='Число процессов (по умолчанию SERVICEDESK_EVENTS["WORKERS"])')
+        parser.add_argument('--once', action='store_true',
+                            help='Один проход по своим партициям в текущем процессе и выход')
+        parser.add_argument('--stats', action='store_true',
+                            help='Показать отставание партиций и отказы callback и выйти')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for row in partition_lag():
+                self.stdout.write(
+                    f"партиция {row['partition']:>3}: событий {row['pending']}, "
+                    f"отставание {row['lag_seconds']:.1f} с, обработчик {row['owner'] or '-'}"
+                )
+            rejected = ', '.join(f'{reason} {count}' for reason, count in rejection_counts().items())
+            self.stdout.write(f"Отклонено callback: {rejected}")
+            return
+
+        if options['once']:
+            consumer = PartitionConsumer()
+            consumer.run_once()
+            self.stdout.write(self.style.SUCCESS(f"Обработано событий: {consumer.stats['processed']}"))
+            return
+
+        workers = options['workers'] or get_event_settings()['WORKERS']
+        if not shared_cache():
+            self.stderr.write(
+                "Кэш default локален для процесса: счетчики флуда у обработчиков и процессов "
+                "callback будут разными. Задайте общий кэш переменной окружения REDIS_URL"
+            )
+        run_pool(workers, log=self.stdout.write)
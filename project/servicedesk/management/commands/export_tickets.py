@@ -0,0 +1,32 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from project.servicedesk.exports import DEFAULT_CHUNK_SIZE, EXPORT_FORMATS, export_tickets_stream
+from project.servicedesk.filters import filter_tickets
+from project.servicedesk.models import Ticket
+
+
+class Command(BaseCommand):
+    help = "Потоковая выгрузка обращений с перепиской в CSV или JSONL с фильтрами списка обращений"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='csv')
+        parser.add_argument('--output', help='Файл для выгрузки (по умолчанию stdout)')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='Сколько обращений читать за один проход курсора')
+        parser.add_argument('--status')
+        parser.add_argument('--priority')
+        parser.add_argument('--assigned', choices=['unassigned'])
+        parser.add_argument('--q', help='Поиск, как на странице списка обращений')
+
+    def handle(self, *args, **options):
+        filters = {name: options[name] or '' for name in ('status', 'priority', 'assigned', 'q')}
+        tickets = filter_tickets(Ticket.objects.all(), filters)
+        stream = export_tickets_stream(tickets, options['format'], options['chunk_size'])
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(stream)
+        else:
+            sys.stdout.writelines(stream)
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from project.servicedesk.importer import HistoryImporter
+from project.servicedesk.models import VKGroup
+
+
+class Command(BaseCommand):
+    help = (
+        "Импортирует существующие диалоги сообщества ВК в обращения. "
+        "Продолжает с сохраненной позиции; для параллельного запуска в нескольких "
+        "процессах используйте --shard i/n. Адрес API (например, локальной заглушки) "
+        "задается в VK_API['API_URL']. Импорт не обновляет сводки пользователей, "
+        "аналитику и нагрузку операторов: после него выполните rebuild_user_summaries, "
+        "backfill_analytics и rebuild_operator_load."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('group_id', type=int, help='ID группы ВК')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Потоков для загрузки истории диалогов')
+        parser.add_argument('--shard', default='0/1',
+                            help='Доля диалогов для этого процесса в виде i/n')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Сообщений в одной вставке')
+        parser.add_argument('--max-pages', type=int,
+                            help='Остановиться после N страниц диалогов')
+        parser.add_argument('--reset', action='store_true', help='Начать импорт с начала')
+
+    def handle(self, *args, **options):
+        try:
+            group = VKGroup.objects.get(group_id=options['group_id'])
+        except VKGroup.DoesNotExist:
+            raise CommandError(f"Группа {options['group_id']} не найдена")
+        try:
+            shard_index, shard_count = (int(part) for part in options['shard'].split('/'))
+        except ValueError:
+            raise CommandError('--shard задается в виде i/n, например 0/4')
+        if not 0 <= shard_index < shard_count:
+            raise CommandError('Номер шарда должен быть от 0 до n-1')
+
+        importer = HistoryImporter(
+            group,
+            workers=options['workers'],
+            shard_index=shard_index,
+            shard_count=shard_count,
+            chunk_size=options['chunk_size'],
+            log=self.stdout.write,
+        )
+        if options['reset']:
+            importer.reset()
+
+        stats = importer.run(max_pages=options['max_pages'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Диалогов: {stats['conversations']}, новых обращений: {stats['tickets']}, "
+            f"сообщений: {stats['messages']}"
+        ))
+        self.stdout.write(
+            'После импорта выполните rebuild_user_summaries, backfill_analytics и rebuild_operator_load'
+        )
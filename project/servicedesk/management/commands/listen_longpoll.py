@@ -0,0 +1,41 @@
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from project.servicedesk.longpoll import DEFAULT_WAIT, LongPollListener
+from project.servicedesk.models import VKGroup
+
+
+class Command(BaseCommand):
+    help = (
+        "Принимает события сообщества ВК через Bots Long Poll API и передает их "
+        "тем же обработчикам, что и Callback API. В настройках сообщества должен "
+        "быть включен Long Poll API с нужными типами событий. Продолжает с "
+        "сохраненного ts; останавливается по SIGTERM/SIGINT."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('group_id', type=int, help='ID группы ВК')
+        parser.add_argument('--wait', type=int, default=DEFAULT_WAIT,
+                            help='Сколько секунд сервер держит запрос без событий')
+        parser.add_argument('--max-polls', type=int, help='Остановиться после N запросов')
+        parser.add_argument('--reset', action='store_true',
+                            help='Забыть сохраненный ts и начать с текущих событий')
+
+    def handle(self, *args, **options):
+        try:
+            group = VKGroup.objects.get(group_id=options['group_id'])
+        except VKGroup.DoesNotExist:
+            raise CommandError(f"Группа {options['group_id']} не найдена")
+
+        listener = LongPollListener(group, wait=options['wait'], log=self.stdout.write)
+        if options['reset']:
+            listener.checkpoint.position.pop('ts', None)
+            listener.checkpoint.store()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *args: listener.stop())
+
+        stats = listener.run(max_polls=options['max_polls'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Запросов: {stats['polls']}, событий: {stats['events']}, подключений: {stats['reconnects']}"
+        ))
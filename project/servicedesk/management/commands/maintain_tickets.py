@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from project.servicedesk.maintenance import CHECKPOINT_NAME, MaintenanceRun
+from project.servicedesk.models import JobCheckpoint
+
+
+class Command(BaseCommand):
+    help = (
+        "Автозакрытие простаивающих обращений и очистка старой переписки "
+        "(настройки SERVICEDESK_MAINTENANCE). Работает короткими пачками и "
+        "продолжает с места остановки; подходит для запуска по расписанию."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Размер пачки')
+        parser.add_argument('--pause', type=float, help='Пауза между пачками, секунды')
+        parser.add_argument('--max-batches', type=int,
+                            help='Остановиться после N пачек (следующий запуск продолжит)')
+        parser.add_argument('--reset', action='store_true', help='Начать все шаги с начала')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            JobCheckpoint.objects.filter(name=CHECKPOINT_NAME).delete()
+
+        run = MaintenanceRun(
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            max_batches=options['max_batches'],
+            log=self.stdout.write,
+        )
+        stats = run.run()
+        self.stdout.write(self.style.SUCCESS(
+            f"Закрыто: {stats['closed']}, удалено сообщений: {stats['messages_deleted']}, "
+            f"очищено вложений: {stats['attachments_cleared']}"
+        ))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from project.servicedesk import sharding
+from project.servicedesk.models import VKGroup
+from project.servicedesk.shard_move import GroupShardMove
+
+
+class Command(BaseCommand):
+    help = (
+        "Переносит обращения сообщества ВК в другой шард (алиас из SERVICEDESK_SHARDS "
+        "или default) без остановки приема сообщений. Прерванный перенос продолжается "
+        "повторным запуском с тем же шардом."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('group_id', type=int, help='ID группы ВК')
+        parser.add_argument('shard', help='Алиас шарда назначения')
+        parser.add_argument('--batch-size', type=int, default=200, help='Обращений в одной пачке')
+        parser.add_argument('--pause', type=float, default=0.1, help='Пауза между пачками, секунды')
+
+    def handle(self, *args, **options):
+        if options['shard'] not in sharding.all_aliases():
+            raise CommandError(
+                f"Шард {options['shard']} не указан в SERVICEDESK_SHARDS (или используйте {DEFAULT_DB_ALIAS})"
+            )
+        try:
+            group = VKGroup.objects.get(group_id=options['group_id'])
+        except VKGroup.DoesNotExist:
+            raise CommandError(f"Группа {options['group_id']} не найдена")
+
+        move = GroupShardMove(
+            group,
+            options['shard'],
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            log=self.stdout.write,
+        )
+        try:
+            stats = move.run()
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"Перенесено обращений: {stats['tickets']}, сообщений: {stats['messages']}"
+        ))
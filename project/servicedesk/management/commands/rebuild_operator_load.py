@@ -0,0 +1,51 @@
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from project.servicedesk import sharding
+from project.servicedesk.assignment import get_assignment_settings
+from project.servicedesk.models import OperatorLoad, Tag, Ticket
+
+
+class Command(BaseCommand):
+    help = (
+        "Создает счетчики нагрузки для активных сотрудников и пересчитывает их "
+        "по открытым обращениям. Нужен после первого развертывания и для "
+        "исправления расхождений."
+    )
+
+    def handle(self, *args, **options):
+        options = get_assignment_settings()
+
+        staff_ids = User.objects.filter(is_staff=True, is_active=True).values_list('pk', flat=True)
+        OperatorLoad.objects.bulk_create(
+            [OperatorLoad(user_id=user_id) for user_id in staff_ids], ignore_conflicts=True
+        )
+
+        # Веса обращений пересчитываются в каждом шарде, нагрузка складывается
+        totals = defaultdict(lambda: [0, 0])
+        for _ in sharding.for_each_shard():
+            with sharding.atomic():
+                open_tickets = Ticket.objects.exclude(status='closed').filter(admin__isnull=False)
+                Ticket.objects.exclude(pk__in=open_tickets.values('pk')).exclude(load_weight=0).update(load_weight=0)
+                open_tickets.update(load_weight=1)
+                for priority, weight in options['PRIORITY_WEIGHTS'].items():
+                    open_tickets.filter(priority=priority).update(load_weight=weight)
+                for tag in Tag.objects.filter(name__in=options['TAG_WEIGHTS']):
+                    open_tickets.filter(tags=tag).update(load_weight=F('load_weight') + options['TAG_WEIGHTS'][tag.name])
+
+                rows = open_tickets.values('admin_id').annotate(count=Count('pk'), weight=Sum('load_weight'))
+                for row in rows:
+                    totals[row['admin_id']][0] += row['count']
+                    totals[row['admin_id']][1] += row['weight'] or 0
+
+        with transaction.atomic():
+            loads = list(OperatorLoad.objects.select_for_update())
+            for load in loads:
+                load.open_tickets, load.weighted_load = totals.get(load.user_id, (0, 0))
+            OperatorLoad.objects.bulk_update(loads, ['open_tickets', 'weighted_load'])
+
+        self.stdout.write(self.style.SUCCESS(f'Пересчитана нагрузка {len(loads)} операторов'))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from project.servicedesk import sharding
+from project.servicedesk.models import Message, Ticket, VKUserSummary
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = (
+        "Пересчитывает сводки пользователей ВК (число обращений, последнее "
+        "сообщение, открытое обращение) по обращениям всех шардов. Нужен после "
+        "первого развертывания, импорта истории и для исправления расхождений."
+    )
+
+    def handle(self, *args, **options):
+        # user_id -> [обращений, имя, создано последнее обращение, открытое обращение, его время, последнее сообщение]
+        users = {}
+        for _ in sharding.for_each_shard():
+            tickets = Ticket.objects.order_by().values_list('user_id', 'user_name', 'ticket_id', 'status', 'created_at')
+            for user_id, user_name, ticket_id, status, created_at in tickets.iterator(chunk_size=BATCH_SIZE):
+                row = users.setdefault(user_id, [0, '', None, '', None, None])
+                row[0] += 1
+                if row[2] is None or created_at > row[2]:
+                    row[1], row[2] = user_name, created_at
+                if status != 'closed' and (row[4] is None or created_at > row[4]):
+                    row[3], row[4] = ticket_id, created_at
+
+            contacts = Message.objects.filter(is_admin=False).values('ticket__user_id').annotate(last=Max('created_at'))
+            for contact in contacts.order_by().iterator(chunk_size=BATCH_SIZE):
+                row = users.get(contact['ticket__user_id'])
+                if row is not None and (row[5] is None or contact['last'] > row[5]):
+                    row[5] = contact['last']
+
+        summaries = [
+            VKUserSummary(
+                user_id=user_id, user_name=name, ticket_count=count, last_contact_at=last_contact_at,
+                open_ticket_id=open_ticket_id,
+            )
+            for user_id, (count, name, _, open_ticket_id, _, last_contact_at) in users.items()
+        ]
+        VKUserSummary.objects.bulk_create(
+            summaries, batch_size=BATCH_SIZE, update_conflicts=True, unique_fields=['user_id'],
+            update_fields=['user_name', 'ticket_count', 'last_contact_at', 'open_ticket_id'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Пересчитаны сводки {len(summaries)} пользователей'))
@@ -0,0 +1,55 @@
+import importlib.util
+
+from django.core.management.base import BaseCommand, CommandError
+
+from project.servicedesk.server import ASGI_WORKER_CLASS, get_server_settings, load_application, run, shared_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Запускает боевой сервер: gunicorn с приложением, загруженным до форка "
+        "воркеров (WSGI project.wsgi или ASGI project.asgi). Воркеры "
+        "перезапускаются после MAX_REQUESTS запросов; SIGHUP плавно заменяет "
+        "воркеры, SIGTERM завершает текущие запросы и останавливает сервер. "
+        "Настройки по умолчанию - SERVICEDESK_SERVER."
+    )
+    # Проверки импортировали бы URLconf до замера холодного старта; они выполняются в CI (manage.py check)
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bind', help='Адрес и порт (по умолчанию SERVICEDESK_SERVER["BIND"])')
+        parser.add_argument('--workers', type=int, help='Число процессов-воркеров')
+        parser.add_argument('--threads', type=int, help='Потоков в WSGI-воркере')
+        parser.add_argument('--asgi', action='store_true', help='Запустить ASGI-приложение')
+        parser.add_argument('--max-requests', type=int, help='Перезапуск воркера после N запросов (0 - нет)')
+        parser.add_argument('--check', action='store_true',
+                            help='Только загрузить приложение, показать время холодного старта и выйти')
+
+    def handle(self, *args, **options):
+        server_options = get_server_settings()
+        for option, key in (('bind', 'BIND'), ('workers', 'WORKERS'), ('threads', 'THREADS'),
+                            ('max_requests', 'MAX_REQUESTS')):
+            if options[option] is not None:
+                server_options[key] = options[option]
+        if options['asgi']:
+            server_options['ASGI'] = True
+
+        if server_options['WORKERS'] > 1 and not shared_cache():
+            self.stderr.write(
+                "Кэш default локален для процесса: сбросы кэша и счетчики не дойдут до остальных "
+                "воркеров. Задайте общий кэш переменной окружения REDIS_URL"
+            )
+
+        required = ['gunicorn'] + (['uvicorn_worker'] if server_options['ASGI'] else [])
+        missing = [name for name in required if importlib.util.find_spec(name) is None]
+        if missing and not options['check']:
+            raise CommandError(f"Не установлены пакеты: {', '.join(missing)} (см. requirements.txt)")
+
+        application, seconds = load_application(asgi=server_options['ASGI'])
+        kind = 'ASGI' if server_options['ASGI'] else 'WSGI'
+        self.stdout.write(f"Приложение {kind} загружено за {seconds:.2f} с")
+        if options['check']:
+            return
+        if server_options['ASGI']:
+            self.stdout.write(f"Воркеры {ASGI_WORKER_CLASS}")
+        run(application, server_options)
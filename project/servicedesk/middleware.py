@@ -0,0 +1,81 @@
+"""Middleware службы поддержки"""
+import math
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+from . import profiling
+from .routers import get_replica_settings, routing
+
+# Cookie с моментом, до которого пользователь читает из основной базы
+PRIMARY_COOKIE = 'db_primary_until'
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def replicas_allowed(request):
+    """Чтения с реплик разрешены для запросов на чтение без недавней записи"""
+    if request.method not in READ_METHODS:
+        return False
+    try:
+        primary_until = float(request.COOKIES.get(PRIMARY_COOKIE, 0))
+    except ValueError:
+        primary_until = 0
+    return primary_until <= time.time()
+
+
+def remember_write(response, state):
+    """После записи закрепляет пользователя за основной базой на STICKY_SECONDS"""
+    if state.wrote:
+        sticky = get_replica_settings()['STICKY_SECONDS']
+        response.set_cookie(
+            PRIMARY_COOKIE, f'{time.time() + sticky:.3f}',
+            max_age=math.ceil(sticky), httponly=True, samesite='Lax',
+        )
+    return response
+
+
+@sync_and_async_middleware
+def ReplicaRoutingMiddleware(get_response):
+    """Разрешает чтения с реплик на время запроса; без настроенных реплик ничего не делает"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            if not get_replica_settings()['ALIASES']:
+                return await get_response(request)
+            with routing(replicas_allowed(request)) as state:
+                response = await get_response(request)
+            return remember_write(response, state)
+    else:
+        def middleware(request):
+            if not get_replica_settings()['ALIASES']:
+                return get_response(request)
+            with routing(replicas_allowed(request)) as state:
+                response = get_response(request)
+            return remember_write(response, state)
+    return middleware
+
+
+@sync_and_async_middleware
+def ProfilingMiddleware(get_response):
+    """
+    Профилирует выборку запросов и запросы сотрудников с заголовком (см. profiling);
+    ставится после AuthenticationMiddleware
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            force = await profiling.arequested(request, profiling.get_profiling_settings())
+            # В цикле событий cProfile смешал бы чужие корутины: снимок только с SQL и временем
+            with profiling.capture('request', request.path, force=force, functions=False) as profile:
+                response = await get_response(request)
+                if profile is not None:
+                    profile.update(method=request.method, status=response.status_code)
+            return response
+    else:
+        def middleware(request):
+            force = profiling.requested(request, profiling.get_profiling_settings())
+            with profiling.capture('request', request.path, force=force) as profile:
+                response = get_response(request)
+                if profile is not None:
+                    profile.update(method=request.method, status=response.status_code)
+            return response
+    return middleware
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.9 on 2026-10-18 22:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicedesk', '0003_alter_ticket_user_photo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='first_response_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Первый ответ'),
+        ),
+        migrations.CreateModel(
+            name='StatsRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('all', 'Вся поддержка'), ('group', 'Группа ВК'), ('operator', 'Оператор'), ('tag', 'Тег')], max_length=10, verbose_name='Срез')),
+                ('dimension_id', models.BigIntegerField(default=0, verbose_name='ID в срезе')),
+                ('bucket', models.DateTimeField(verbose_name='Час')),
+                ('tickets_created', models.IntegerField(default=0, verbose_name='Создано обращений')),
+                ('messages_received', models.IntegerField(default=0, verbose_name='Получено сообщений')),
+                ('messages_sent', models.IntegerField(default=0, verbose_name='Отправлено ответов')),
+                ('first_responses', models.IntegerField(default=0, verbose_name='Первых ответов')),
+                ('first_response_seconds', models.BigIntegerField(default=0, verbose_name='Суммарное время первого ответа, с')),
+                ('resolved', models.IntegerField(default=0, verbose_name='Закрыто обращений')),
+                ('resolution_seconds', models.BigIntegerField(default=0, verbose_name='Суммарное время решения, с')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('dimension', 'dimension_id', 'bucket'), name='stats_rollup_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.9 on 2026-10-18 22:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicedesk', '0004_ticket_first_response_at_statsrollup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='load_weight',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Вес в нагрузке ответственного'),
+        ),
+        migrations.CreateModel(
+            name='OperatorLoad',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_available', models.BooleanField(default=True, verbose_name='Принимает обращения')),
+                ('open_tickets', models.IntegerField(default=0, verbose_name='Открытых обращений')),
+                ('weighted_load', models.IntegerField(default=0, verbose_name='Взвешенная нагрузка')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='load', to=settings.AUTH_USER_MODEL, verbose_name='Оператор')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['is_available', 'weighted_load'], name='servicedesk_is_avai_24d84f_idx')],
+            },
+        ),
+    ]
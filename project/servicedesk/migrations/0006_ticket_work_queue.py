@@ -0,0 +1,44 @@
+# Generated by Django 5.2.9 on 2026-10-18 22:48
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+PRIORITY_RANKS = {'low': 1, 'medium': 2, 'high': 3, 'critical': 4}
+
+
+def fill_queue_fields(apps, schema_editor):
+    Ticket = apps.get_model('servicedesk', 'Ticket')
+    for priority, rank in PRIORITY_RANKS.items():
+        Ticket.objects.filter(priority=priority).exclude(priority_rank=rank).update(priority_rank=rank)
+    # Для уже ожидающих обращений точного момента нет, берем время последнего изменения
+    Ticket.objects.filter(status__in=['open', 'waiting'], waiting_since__isnull=True).update(
+        waiting_since=F('updated_at')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicedesk', '0005_ticket_load_weight_operatorload'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='priority_rank',
+            field=models.PositiveSmallIntegerField(default=2, editable=False, verbose_name='Вес приоритета'),
+        ),
+        migrations.AddField(
+            model_name='ticket',
+            name='waiting_since',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Ожидает ответа с'),
+        ),
+        migrations.RunPython(fill_queue_fields, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(condition=models.Q(('status__in', ['open', 'waiting'])), fields=['-priority_rank', 'waiting_since', 'id'], name='ticket_work_queue'),
+        ),
+    ]
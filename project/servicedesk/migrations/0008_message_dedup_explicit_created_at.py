@@ -0,0 +1,44 @@
+# Generated by Django 5.2.9 on 2026-10-18 22:52
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_messages(apps, schema_editor):
+    """Перед добавлением ограничения оставляем по одной копии каждого сообщения ВК"""
+    Message = apps.get_model('servicedesk', 'Message')
+    duplicates = Message.objects.filter(message_id__isnull=False).values('ticket_id', 'message_id').annotate(
+        keep=Min('pk'), copies=Count('pk')
+    ).filter(copies__gt=1)
+    for row in list(duplicates):
+        Message.objects.filter(ticket_id=row['ticket_id'], message_id=row['message_id']).exclude(
+            pk=row['keep']
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicedesk', '0007_jobcheckpoint'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Создано'),
+        ),
+        migrations.AlterField(
+            model_name='ticket',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Создано'),
+        ),
+        migrations.RunPython(remove_duplicate_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('message_id__isnull', False)), fields=('ticket', 'message_id'), name='message_vk_id_unique'),
+        ),
+    ]
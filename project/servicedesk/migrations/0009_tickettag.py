@@ -0,0 +1,40 @@
+# Generated by Django 5.2.9 on 2026-10-18 23:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicedesk', '0008_message_dedup_explicit_created_at'),
+    ]
+
+    operations = [
+        # Явная модель связи поверх существующей таблицы: в базе ничего не меняется
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='TicketTag',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='servicedesk.tag')),
+                        ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='servicedesk.ticket')),
+                    ],
+                    options={
+                        'db_table': 'servicedesk_ticket_tags',
+                        'unique_together': {('ticket', 'tag')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='ticket',
+                    name='tags',
+                    field=models.ManyToManyField(blank=True, through='servicedesk.TicketTag', to='servicedesk.tag', verbose_name='Теги'),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='tickettag',
+            index=models.Index(fields=['tag', 'ticket'], name='ticket_tag_by_tag'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.9 on 2026-10-18 23:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicedesk', '0009_tickettag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vkgroup',
+            name='shard',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='Шард'),
+        ),
+        migrations.AddField(
+            model_name='vkgroup',
+            name='shard_moving_from',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64, verbose_name='Переносится из шарда'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.9 on 2026-10-18 23:17
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicedesk', '0010_vkgroup_shard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventConsumer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='Обработчик')),
+                ('heartbeat_at', models.DateTimeField(verbose_name='Последний отклик')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EventPartition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('partition', models.PositiveSmallIntegerField(unique=True, verbose_name='Партиция')),
+                ('owner', models.CharField(blank=True, max_length=100, verbose_name='Обработчик')),
+                ('lease_until', models.DateTimeField(blank=True, null=True, verbose_name='Аренда до')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Последняя обработка')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InboundEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('partition', models.PositiveSmallIntegerField(verbose_name='Партиция')),
+                ('event_type', models.CharField(max_length=50, verbose_name='Тип события')),
+                ('payload', models.JSONField(verbose_name='Событие')),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Получено')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток обработки')),
+                ('last_error', models.TextField(blank=True, verbose_name='Последняя ошибка')),
+                ('failed', models.BooleanField(default=False, verbose_name='Не обработано')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('failed', False)), fields=['partition', 'id'], name='inbound_event_queue')],
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+from django.db import migrations
+
+# Индексы подсказок поиска (filters.ticket_typeahead). В PostgreSQL - GIN
+# pg_trgm для поиска по подстроке: по UPPER(user_name), как строит icontains
+# Django, и по ticket_id для contains. В остальных базах - обычный индекс
+# для поиска по началу имени (номер уже покрыт уникальным индексом).
+POSTGRES_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ticket_user_name_trgm ON servicedesk_ticket "
+    "USING gin (UPPER(user_name::text) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ticket_id_trgm ON servicedesk_ticket USING gin (ticket_id gin_trgm_ops)",
+]
+
+
+def create_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for sql in POSTGRES_INDEXES:
+            schema_editor.execute(sql)
+    elif vendor == 'sqlite':
+        # LIKE в SQLite не учитывает регистр и использует только индекс с NOCASE
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS ticket_user_name_prefix ON servicedesk_ticket (user_name COLLATE NOCASE)"
+        )
+    else:
+        schema_editor.execute("CREATE INDEX ticket_user_name_prefix ON servicedesk_ticket (user_name)")
+
+
+def drop_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS ticket_user_name_trgm")
+        schema_editor.execute("DROP INDEX IF EXISTS ticket_id_trgm")
+    elif vendor == 'sqlite':
+        schema_editor.execute("DROP INDEX IF EXISTS ticket_user_name_prefix")
+    else:
+        schema_editor.execute("DROP INDEX ticket_user_name_prefix ON servicedesk_ticket")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicedesk', '0011_inbound_event_queue'),
+    ]
+
+    operations = [
+        # hints: индексы создаются и в шардах, где лежат обращения
+        migrations.RunPython(create_indexes, drop_indexes, hints={'model_name': 'ticket'}),
+    ]
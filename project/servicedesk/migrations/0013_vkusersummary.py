@@ -0,0 +1,24 @@
+# Generated by Django 5.2.9 on 2026-10-18 23:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicedesk', '0012_ticket_typeahead_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VKUserSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField(unique=True, verbose_name='ID пользователя ВК')),
+                ('user_name', models.CharField(max_length=255, verbose_name='Имя пользователя')),
+                ('ticket_count', models.PositiveIntegerField(default=0, verbose_name='Обращений')),
+                ('last_contact_at', models.DateTimeField(blank=True, null=True, verbose_name='Последнее сообщение')),
+                ('open_ticket_id', models.CharField(blank=True, max_length=20, verbose_name='Открытое обращение')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-19 00:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('servicedesk', '0014_ticketcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboundevent',
+            name='available_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Обработать не раньше'),
+        ),
+    ]
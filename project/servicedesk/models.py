@@ -1,7 +1,10 @@
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, models, transaction
 from django.contrib.auth.models import User
+from django.db.models.functions import Length
 from django.utils import timezone
 
+from . import sharding
+
 
 class VKGroup(models.Model):
     group_id = models.IntegerField(unique=True, verbose_name="ID группы")
@@ -9,6 +12,11 @@ class VKGroup(models.Model):
     access_token = models.CharField(max_length=255, verbose_name="Токен доступа")
     secret_key = models.CharField(max_length=50, blank=True, verbose_name="Секретный ключ")
     is_active = models.BooleanField(default=True, verbose_name="Активна")
+    # Алиас базы с обращениями группы (см. sharding); пусто - default
+    shard = models.CharField(max_length=64, blank=True, default='', verbose_name="Шард")
+    # Заполнено, пока move_group_shard переносит обращения из этого шарда
+    shard_moving_from = models.CharField(max_length=64, blank=True, default='', editable=False,
+                                         verbose_name="Переносится из шарда")
 
     def __str__(self):
         return f"{self.name} (id{self.group_id})"
@@ -29,6 +37,12 @@ class Ticket(models.Model):
         ('critical', 'Критический'),
     ]
 
+    # Числовой вес приоритета: сортировка по строке дала бы алфавитный порядок
+    PRIORITY_RANKS = {'low': 1, 'medium': 2, 'high': 3, 'critical': 4}
+
+    # Статусы, в которых обращение ждет реакции оператора
+    QUEUE_STATUSES = ['open', 'waiting']
+
     ticket_id = models.CharField(max_length=20, unique=True, verbose_name="Номер обращения")
     user_id = models.IntegerField(verbose_name="ID пользователя ВК")
     user_name = models.CharField(max_length=255, verbose_name="Имя пользователя")
@@ -36,19 +50,29 @@ class Ticket(models.Model):
     subject = models.CharField(max_length=255, default="Без темы", verbose_name="Тема обращения")
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='open')
     priority = models.CharField(max_length=20, choices=PRIORITY_CHOICES, default='medium')
-    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создано")
+    priority_rank = models.PositiveSmallIntegerField(default=2, editable=False, verbose_name="Вес приоритета")
+    waiting_since = models.DateTimeField(null=True, blank=True, verbose_name="Ожидает ответа с")
+    created_at = models.DateTimeField(default=timezone.now, editable=False, verbose_name="Создано")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
     closed_at = models.DateTimeField(null=True, blank=True, verbose_name="Закрыто")
+    first_response_at = models.DateTimeField(null=True, blank=True, verbose_name="Первый ответ")
     admin = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
                               related_name='assigned_tickets', verbose_name="Ответственный")
     vk_group = models.ForeignKey(VKGroup, on_delete=models.CASCADE, verbose_name="Группа ВК")
-    tags = models.ManyToManyField('Tag', blank=True, verbose_name="Теги")
+    tags = models.ManyToManyField('Tag', through='TicketTag', blank=True, verbose_name="Теги")
+    load_weight = models.PositiveSmallIntegerField(default=0, verbose_name="Вес в нагрузке ответственного")
 
     class Meta:
         ordering = ['-updated_at']
         indexes = [
             models.Index(fields=['status', 'priority']),
             models.Index(fields=['user_id', 'created_at']),
+            # Очередь работы: самые срочные, затем дольше всех ждущие
+            models.Index(
+                fields=['-priority_rank', 'waiting_since', 'id'],
+                condition=models.Q(status__in=['open', 'waiting']),
+                name='ticket_work_queue',
+            ),
         ]
 
     def __str__(self):
@@ -57,16 +81,46 @@ class Ticket(models.Model):
     def save(self, *args, **kwargs):
         if not self.ticket_id:
             # Генерация уникального номера обращения
-            date_prefix = timezone.now().strftime('%Y%m%d')
-            last_ticket = Ticket.objects.filter(ticket_id__startswith=date_prefix).order_by('ticket_id').last()
-            if last_ticket:
-                last_num = int(last_ticket.ticket_id.split('-')[1])
-                new_num = last_num + 1
-            else:
-                new_num = 1
-            self.ticket_id = f"{date_prefix}-{new_num:04d}"
+            self.ticket_id = Ticket.allocate_ticket_ids(1)[0]
+        self.priority_rank = self.PRIORITY_RANKS.get(self.priority, 0)
         super().save(*args, **kwargs)
 
+    @classmethod
+    def allocate_ticket_ids(cls, count):
+        """
+        Следующие count номеров обращений за сегодня; нумерация общая для всех шардов.
+        Номера выдает счетчик дня TicketCounter под блокировкой строки, поэтому
+        параллельные импорт и прием сообщений не получают одинаковых номеров
+        """
+        date_prefix = timezone.now().strftime('%Y%m%d')
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            counter = TicketCounter.objects.select_for_update().filter(day=date_prefix).first()
+            if counter is None:
+                try:
+                    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                        TicketCounter.objects.create(day=date_prefix, last_number=cls.last_ticket_number(date_prefix))
+                except IntegrityError:
+                    # Счетчик дня успел создать параллельный процесс
+                    pass
+                counter = TicketCounter.objects.select_for_update().get(day=date_prefix)
+            new_num = counter.last_number + 1
+            counter.last_number += count
+            counter.save(update_fields=['last_number'])
+        return [f"{date_prefix}-{num:04d}" for num in range(new_num, new_num + count)]
+
+    @classmethod
+    def last_ticket_number(cls, date_prefix):
+        """Наибольший номер за день среди обращений всех шардов; начальное значение счетчика дня"""
+        last_num = 0
+        for alias in sharding.all_aliases():
+            # Сначала по длине: после 9999 номер становится пятизначным
+            last_ticket = cls.objects.using(alias).filter(ticket_id__startswith=date_prefix).order_by(
+                Length('ticket_id').desc(), '-ticket_id'
+            ).values_list('ticket_id', flat=True).first()
+            if last_ticket:
+                last_num = max(last_num, int(last_ticket.split('-')[1]))
+        return last_num
+
     def get_unread_messages_count(self):
         return self.messages.filter(is_read=False).exclude(is_admin=True).count()
 
@@ -81,12 +135,20 @@ class Message(models.Model):
     attachments = models.JSONField(default=list, blank=True, verbose_name="Вложения")
     is_admin = models.BooleanField(default=False, verbose_name="От администратора")
     is_read = models.BooleanField(default=False, verbose_name="Прочитано")
-    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создано")
+    created_at = models.DateTimeField(default=timezone.now, editable=False, verbose_name="Создано")
     admin_author = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
                                      verbose_name="Автор (админ)")
 
     class Meta:
         ordering = ['created_at']
+        constraints = [
+            # Повторная доставка или импорт одного сообщения ВК не создает дубль
+            models.UniqueConstraint(
+                fields=['ticket', 'message_id'],
+                condition=models.Q(message_id__isnull=False),
+                name='message_vk_id_unique',
+            ),
+        ]
 
     def __str__(self):
         author = "Админ" if self.is_admin else "Пользователь"
@@ -98,4 +160,149 @@ class Tag(models.Model):
     color = models.CharField(max_length=7, default='#6c757d', verbose_name="Цвет (HEX)")
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+
+class TicketTag(models.Model):
+    """Связь обращения с тегом; таблица та же, что у автоматической связи Ticket.tags"""
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE)
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+
+    class Meta:
+        db_table = 'servicedesk_ticket_tags'
+        unique_together = [('ticket', 'tag')]
+        indexes = [
+            # Фильтр по тегам и подсчет фасетов: от тега к обращениям без чтения строк таблицы
+            models.Index(fields=['tag', 'ticket'], name='ticket_tag_by_tag'),
+        ]
+
+
+class StatsRollup(models.Model):
+    """Почасовые счетчики нагрузки и SLA в разрезе группы, оператора и тега"""
+    ALL = 'all'
+    GROUP = 'group'
+    OPERATOR = 'operator'
+    TAG = 'tag'
+
+    DIMENSION_CHOICES = [
+        (ALL, 'Вся поддержка'),
+        (GROUP, 'Группа ВК'),
+        (OPERATOR, 'Оператор'),
+        (TAG, 'Тег'),
+    ]
+
+    dimension = models.CharField(max_length=10, choices=DIMENSION_CHOICES, verbose_name="Срез")
+    dimension_id = models.BigIntegerField(default=0, verbose_name="ID в срезе")
+    bucket = models.DateTimeField(verbose_name="Час")
+    tickets_created = models.IntegerField(default=0, verbose_name="Создано обращений")
+    messages_received = models.IntegerField(default=0, verbose_name="Получено сообщений")
+    messages_sent = models.IntegerField(default=0, verbose_name="Отправлено ответов")
+    first_responses = models.IntegerField(default=0, verbose_name="Первых ответов")
+    first_response_seconds = models.BigIntegerField(default=0, verbose_name="Суммарное время первого ответа, с")
+    resolved = models.IntegerField(default=0, verbose_name="Закрыто обращений")
+    resolution_seconds = models.BigIntegerField(default=0, verbose_name="Суммарное время решения, с")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dimension', 'dimension_id', 'bucket'], name='stats_rollup_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_dimension_display()} {self.dimension_id} @ {self.bucket:%Y-%m-%d %H:00}"
+
+
+class OperatorLoad(models.Model):
+    """Счетчики открытых обращений оператора для автоматического распределения"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='load', verbose_name="Оператор")
+    is_available = models.BooleanField(default=True, verbose_name="Принимает обращения")
+    open_tickets = models.IntegerField(default=0, verbose_name="Открытых обращений")
+    weighted_load = models.IntegerField(default=0, verbose_name="Взвешенная нагрузка")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_available', 'weighted_load']),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.open_tickets} ({self.weighted_load})"
+
+
+class VKUserSummary(models.Model):
+    """
+    Сводка по пользователю ВК во всех группах и шардах; обновляется при приеме
+    сообщений (timeline.record_contact) и закрытии обращений
+    """
+    user_id = models.IntegerField(unique=True, verbose_name="ID пользователя ВК")
+    user_name = models.CharField(max_length=255, verbose_name="Имя пользователя")
+    ticket_count = models.PositiveIntegerField(default=0, verbose_name="Обращений")
+    last_contact_at = models.DateTimeField(null=True, blank=True, verbose_name="Последнее сообщение")
+    # Номер, а не ссылка: обращение может лежать в любом шарде
+    open_ticket_id = models.CharField(max_length=20, blank=True, verbose_name="Открытое обращение")
+
+    def __str__(self):
+        return f"{self.user_name} ({self.user_id})"
+
+
+class TicketCounter(models.Model):
+    """Последний выданный номер обращения за день (Ticket.allocate_ticket_ids)"""
+    day = models.CharField(max_length=8, unique=True, verbose_name="День")
+    last_number = models.PositiveIntegerField(default=0, verbose_name="Последний номер")
+
+    def __str__(self):
+        return f"{self.day}: {self.last_number}"
+
+
+class JobCheckpoint(models.Model):
+    """Позиция длительной фоновой задачи, чтобы продолжить ее после перезапуска"""
+    name = models.CharField(max_length=100, unique=True, verbose_name="Задача")
+    position = models.JSONField(default=dict, blank=True, verbose_name="Позиция")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def load(cls, name):
+        return cls.objects.get_or_create(name=name)[0]
+
+    def store(self, **position):
+        self.position.update(position)
+        self.save(update_fields=['position', 'updated_at'])
+
+
+class InboundEvent(models.Model):
+    """
+    Событие VK в очереди обработки (см. event_queue). События одного
+    собеседника попадают в одну партицию и обрабатываются по порядку id
+    """
+    partition = models.PositiveSmallIntegerField(verbose_name="Партиция")
+    event_type = models.CharField(max_length=50, verbose_name="Тип события")
+    payload = models.JSONField(verbose_name="Событие")
+    received_at = models.DateTimeField(default=timezone.now, verbose_name="Получено")
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="Попыток обработки")
+    last_error = models.TextField(blank=True, verbose_name="Последняя ошибка")
+    # Событие, не обработанное за MAX_ATTEMPTS попыток, откладывается и не блокирует партицию
+    failed = models.BooleanField(default=False, verbose_name="Не обработано")
+    # Сообщения сверх лимита флуда откладываются до этого момента, не блокируя партицию
+    available_at = models.DateTimeField(null=True, blank=True, verbose_name="Обработать не раньше")
+
+    class Meta:
+        indexes = [
+            # Выборка головы очереди партиции
+            models.Index(fields=['partition', 'id'], name='inbound_event_queue',
+                         condition=models.Q(failed=False)),
+        ]
+
+
+class EventConsumer(models.Model):
+    """Живой процесс-обработчик очереди событий; по числу живых делятся партиции"""
+    name = models.CharField(max_length=100, unique=True, verbose_name="Обработчик")
+    heartbeat_at = models.DateTimeField(verbose_name="Последний отклик")
+
+
+class EventPartition(models.Model):
+    """Аренда партиции очереди событий обработчиком: у партиции один владелец"""
+    partition = models.PositiveSmallIntegerField(unique=True, verbose_name="Партиция")
+    owner = models.CharField(max_length=100, blank=True, verbose_name="Обработчик")
+    lease_until = models.DateTimeField(null=True, blank=True, verbose_name="Аренда до")
+    processed_at = models.DateTimeField(null=True, blank=True, verbose_name="Последняя обработка")
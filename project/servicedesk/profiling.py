@@ -0,0 +1,208 @@
+"""
+Профилирование живых запросов и обработки событий по требованию.
+
+Профилируется доля SAMPLE_RATE запросов и событий очереди, а также любой
+запрос сотрудника с заголовком HEADER. Снимок - cProfile и все выполненные
+SQL-запросы с временем - сводится к топу функций и запросов и пишется
+JSON-файлом в DIRECTORY; хранятся последние MAX_PROFILES снимков, старые
+удаляются (кольцевой буфер на диске, общий для процессов). Самые медленные
+снимки показывает страница profiles для сотрудников.
+
+У асинхронных запросов (ASGI) снимок содержит только SQL-запросы и время:
+cProfile в цикле событий учитывал бы чужие корутины, поэтому топа функций
+у них нет.
+"""
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def get_profiling_settings():
+    options = {
+        # Доля профилируемых запросов и событий (0 - только по заголовку)
+        'SAMPLE_RATE': 0,
+        # Заголовок, включающий профилирование запроса сотрудника
+        'HEADER': 'X-Servicedesk-Profile',
+        # Каталог кольцевого буфера снимков
+        'DIRECTORY': os.path.join(tempfile.gettempdir(), 'servicedesk-profiles'),
+        # Сколько снимков хранить
+        'MAX_PROFILES': 200,
+        # Сколько функций и запросов сохранять в снимке
+        'TOP_FUNCTIONS': 25,
+        'TOP_QUERIES': 25,
+    }
+    options.update(getattr(settings, 'SERVICEDESK_PROFILING', {}))
+    return options
+
+
+# Идет ли уже профилирование в этом контексте: cProfile не допускает вложенных профилировщиков
+_active = contextvars.ContextVar('servicedesk_profiling', default=False)
+
+# Журнал SQL профилируемого блока. Контекст копируется и в потоки sync_to_async,
+# поэтому под ASGI учитываются и запросы синхронных view из других потоков
+_query_log = contextvars.ContextVar('servicedesk_query_log', default=None)
+
+
+class QueryLog:
+    """execute_wrapper, запоминающий SQL и время каждого запроса"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - started))
+
+    def top(self, limit):
+        """Одинаковые запросы складываются; первыми - с наибольшим суммарным временем"""
+        grouped = defaultdict(lambda: {'count': 0, 'seconds': 0.0})
+        for sql, seconds in self.queries:
+            grouped[sql]['count'] += 1
+            grouped[sql]['seconds'] += seconds
+        rows = [{'sql': sql, **row} for sql, row in grouped.items()]
+        return sorted(rows, key=lambda row: row['seconds'], reverse=True)[:limit]
+
+
+def log_queries(execute, sql, params, many, context):
+    """execute_wrapper всех соединений: пишет в журнал, только пока идет профилирование"""
+    query_log = _query_log.get()
+    if query_log is None:
+        return execute(sql, params, many, context)
+    return query_log(execute, sql, params, many, context)
+
+
+def install_query_log(connection):
+    """Подключает log_queries к соединению (при его открытии и перед профилированием)"""
+    if log_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(log_queries)
+
+
+def top_functions(profiler, limit):
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+        rows.append({
+            'function': f'{filename}:{line}({function})',
+            'calls': calls,
+            'total': total,
+            'cumulative': cumulative,
+        })
+    return sorted(rows, key=lambda row: row['cumulative'], reverse=True)[:limit]
+
+
+def sampled(options):
+    rate = options['SAMPLE_RATE']
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+@contextmanager
+def capture(kind, name, force=False, functions=True):
+    """
+    Профилирует тело блока, если выпала выборка или force; kind - request или event,
+    name - путь запроса или тип события; functions=False - без cProfile, только
+    SQL и время. Возвращает dict, в который можно добавить поля снимка, или None,
+    если профилирования нет
+    """
+    options = get_profiling_settings()
+    if _active.get() or not (force or sampled(options)):
+        yield None
+        return
+
+    extra = {}
+    query_log = QueryLog()
+    profiler = cProfile.Profile() if functions else None
+    # Соединения, открытые до подключения обработчика connection_created
+    for connection in connections.all():
+        install_query_log(connection)
+    token = _active.set(True)
+    log_token = _query_log.set(query_log)
+    started_at = timezone.now()
+    started = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield extra
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    finally:
+        _query_log.reset(log_token)
+        _active.reset(token)
+        duration = time.perf_counter() - started
+        try:
+            save({
+                'kind': kind,
+                'name': name,
+                'started_at': started_at.isoformat(),
+                'duration': duration,
+                'query_count': len(query_log.queries),
+                'query_seconds': sum(seconds for _, seconds in query_log.queries),
+                'functions': top_functions(profiler, options['TOP_FUNCTIONS']) if profiler is not None else [],
+                'queries': query_log.top(options['TOP_QUERIES']),
+                **extra,
+            }, options)
+        except (OSError, TypeError, ValueError):
+            # Сбой записи снимка не должен ломать запрос
+            logger.exception("Error saving profile", extra={'profile_kind': kind})
+
+
+def save(profile, options):
+    """Пишет снимок атомарно и удаляет самые старые сверх MAX_PROFILES"""
+    directory = Path(options['DIRECTORY'])
+    directory.mkdir(parents=True, exist_ok=True)
+    # Имя по времени: сортировка имен дает порядок записи во всех процессах
+    name = f'{time.time_ns():020d}-{os.getpid()}'
+    temporary = directory / f'.{name}.tmp'
+    temporary.write_text(json.dumps({'id': name, **profile}, ensure_ascii=False, default=str), encoding='utf-8')
+    os.replace(temporary, directory / f'{name}.json')
+
+    for stale in sorted(directory.glob('*.json'))[:-options['MAX_PROFILES']]:
+        stale.unlink(missing_ok=True)
+
+
+def load_profiles(options=None):
+    """Все сохраненные снимки, от медленных к быстрым"""
+    options = options or get_profiling_settings()
+    profiles = []
+    for path in Path(options['DIRECTORY']).glob('*.json'):
+        try:
+            profiles.append(json.loads(path.read_text(encoding='utf-8')))
+        except (OSError, ValueError):
+            # Файл удален другим процессом при ротации
+            continue
+    return sorted(profiles, key=lambda profile: profile['duration'], reverse=True)
+
+
+def requested(request, options):
+    """Профилирование по заголовку разрешено только сотрудникам"""
+    header = options['HEADER']
+    user = getattr(request, 'user', None)
+    return bool(header and request.headers.get(header)) and user is not None and user.is_staff
+
+
+async def arequested(request, options):
+    """requested для асинхронных запросов: пользователь загружается, только если заголовок передан"""
+    header = options['HEADER']
+    if not (header and request.headers.get(header)) or not hasattr(request, 'auser'):
+        return False
+    user = await request.auser()
+    return user.is_staff
@@ -0,0 +1,136 @@
+"""
+Маршрутизация запросов между основной базой и репликами для чтения.
+
+Записи всегда идут в основную базу. Чтения уходят на реплику, только если
+это разрешено для текущего контекста: ReplicaRoutingMiddleware разрешает
+их в запросах на чтение пользователя, который недавно ничего не записывал.
+Вне запроса (команды, обработчики событий) и после первой записи в запросе
+все чтения идут в основную базу - так пользователь всегда видит свои записи.
+Реплики, отстающие больше MAX_LAG_SECONDS, временно исключаются.
+"""
+import contextvars
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger(__name__)
+
+
+def get_replica_settings():
+    options = {
+        # Алиасы реплик из DATABASES; пустой список - все запросы к основной базе
+        'ALIASES': [],
+        # Сколько секунд после записи пользователь читает из основной базы
+        'STICKY_SECONDS': 5,
+        # Реплики с большим отставанием не используются (None - не проверять)
+        'MAX_LAG_SECONDS': 10,
+        # Как часто перепроверять отставание реплики, секунды
+        'LAG_CHECK_INTERVAL': 5,
+    }
+    options.update(getattr(settings, 'SERVICEDESK_REPLICAS', {}))
+    return options
+
+
+class RoutingState:
+    """Состояние маршрутизации одного запроса"""
+
+    def __init__(self, replicas_allowed):
+        self.replicas_allowed = replicas_allowed
+        self.wrote = False
+
+
+_state = contextvars.ContextVar('servicedesk_routing_state', default=None)
+
+
+@contextmanager
+def routing(replicas_allowed):
+    """Контекст запроса: разрешены ли чтения с реплик; возвращает RoutingState"""
+    state = RoutingState(replicas_allowed)
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+# {alias: (время проверки, отставание в секундах или None при ошибке)}
+_lag_cache = {}
+
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+
+def measure_lag(alias):
+    """Отставание реплики в секундах; для баз кроме PostgreSQL считается нулевым"""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(LAG_SQL)
+        return float(cursor.fetchone()[0] or 0)
+
+
+def replica_lag(alias, check_interval):
+    """Отставание с кэшированием на check_interval секунд; None, если реплика недоступна"""
+    checked_at, lag = _lag_cache.get(alias, (None, None))
+    now = time.monotonic()
+    if checked_at is None or now - checked_at >= check_interval:
+        try:
+            lag = measure_lag(alias)
+        except Exception:
+            logger.warning("Replica lag check failed", extra={'db_alias': alias}, exc_info=True)
+            lag = None
+        _lag_cache[alias] = (now, lag)
+    return lag
+
+
+def healthy_replicas():
+    options = get_replica_settings()
+    max_lag = options['MAX_LAG_SECONDS']
+    replicas = []
+    for alias in options['ALIASES']:
+        if max_lag is None:
+            replicas.append(alias)
+            continue
+        lag = replica_lag(alias, options['LAG_CHECK_INTERVAL'])
+        if lag is not None and lag <= max_lag:
+            replicas.append(alias)
+    return replicas
+
+
+class ReplicaRouter:
+    """Роутер Django: записи - в основную базу, разрешенные чтения - на случайную здоровую реплику"""
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.replicas_allowed or state.wrote:
+            return DEFAULT_DB_ALIAS
+        replicas = healthy_replicas()
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            # После записи запрос до конца читает из основной базы
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, *get_replica_settings()['ALIASES']}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Схема реплик повторяет основную базу через репликацию
+        if db in get_replica_settings()['ALIASES']:
+            return False
+        return None
@@ -1,6 +1,8 @@
 from django.contrib.auth.models import Group, User
 from rest_framework import serializers
 
+from .models import Message, Ticket, VKUserSummary
+
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
@@ -12,3 +14,35 @@ class GroupSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Group
         fields = ["url", "name"]
+
+
+class TicketSerializer(serializers.ModelSerializer):
+    admin = serializers.CharField(source='admin.username', default=None, read_only=True)
+
+    class Meta:
+        model = Ticket
+        fields = [
+            "ticket_id", "user_id", "user_name", "subject", "status", "priority",
+            "priority_rank", "waiting_since", "admin", "vk_group", "created_at", "updated_at",
+        ]
+
+
+class MessageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Message
+        fields = ["message_id", "text", "is_admin", "created_at"]
+
+
+class TimelineTicketSerializer(TicketSerializer):
+    """Обращение истории пользователя с последними сообщениями (timeline.attach_recent_messages)"""
+    vk_group_name = serializers.CharField(source='vk_group.name', read_only=True)
+    messages = MessageSerializer(source='recent_messages', many=True, read_only=True)
+
+    class Meta(TicketSerializer.Meta):
+        fields = TicketSerializer.Meta.fields + ["vk_group_name", "closed_at", "messages"]
+
+
+class VKUserSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = VKUserSummary
+        fields = ["user_id", "user_name", "ticket_count", "last_contact_at", "open_ticket_id"]
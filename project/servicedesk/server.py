@@ -0,0 +1,130 @@
+"""
+Боевой сервер приложения (команда serve): gunicorn с предзагрузкой.
+
+Мастер-процесс один раз импортирует приложение (WSGI или ASGI), URLconf
+со всеми view, шаблоны и прогревает справочники в кэше процесса, затем
+закрывает соединения с базой, замораживает сборщик мусора (gc.freeze - GC
+не трогает унаследованные объекты, и их страницы остаются общими) и
+форкает воркеры. Каждый воркер перезапускается после MAX_REQUESTS
+запросов (+ случайный JITTER, чтобы не все сразу). SIGHUP плавно меняет
+воркеры на новые с тем же кодом; для нового кода нужен перезапуск мастера.
+"""
+import gc
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.template.loader import get_template
+from django.urls import get_resolver
+
+logger = logging.getLogger(__name__)
+
+# Шаблоны, которые компилируются до форка
+WARM_TEMPLATES = ['support/ticket_list.html', 'support/ticket_detail.html', 'support/work_queue.html']
+
+# Класс воркера gunicorn для ASGI из пакета uvicorn-worker
+ASGI_WORKER_CLASS = 'uvicorn_worker.UvicornWorker'
+
+# Бэкенды кэша, которые видит только свой процесс
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def get_server_settings():
+    options = {
+        'BIND': '0.0.0.0:8000',
+        # Число процессов-воркеров
+        'WORKERS': (os.cpu_count() or 1) * 2 + 1,
+        # Потоков в WSGI-воркере (больше 1 - воркер gthread)
+        'THREADS': 1,
+        # ASGI (project.asgi) вместо WSGI (project.wsgi)
+        'ASGI': False,
+        # Перезапуск воркера после стольких запросов (0 - не перезапускать) со случайной добавкой
+        'MAX_REQUESTS': 1000,
+        'MAX_REQUESTS_JITTER': 100,
+        # Воркер, молчащий дольше TIMEOUT секунд, перезапускается; на завершение запросов - GRACEFUL_TIMEOUT
+        'TIMEOUT': 30,
+        'GRACEFUL_TIMEOUT': 30,
+        'KEEPALIVE': 5,
+    }
+    options.update(getattr(settings, 'SERVICEDESK_SERVER', {}))
+    return options
+
+
+def shared_cache():
+    """
+    Общий ли кэш default для воркеров: сброс фрагментов сигналами, счетчики
+    флуда и отказов должны видеть все процессы
+    """
+    return settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_CACHES
+
+
+def warm_caches():
+    """Справочники в кэше процесса: воркеры получат их готовыми через fork"""
+    from . import admission, fragments
+    try:
+        fragments.cached_tags()
+        admission.known_group(None, admission.get_admission_settings()['GROUPS_REFRESH_INTERVAL'])
+    except DatabaseError:
+        # Воркеры заполнят кэши сами, когда база станет доступна
+        logger.warning("Cache warm-up skipped: database unavailable", exc_info=True)
+
+
+def load_application(asgi=False):
+    """Импортирует и прогревает приложение до форка; возвращает (application, секунды загрузки)"""
+    started = time.perf_counter()
+    if asgi:
+        from project.asgi import application
+    else:
+        from project.wsgi import application
+    # URLconf импортирует все view (DRF, клиенты VK) сейчас, а не на первом запросе каждого воркера
+    get_resolver().url_patterns
+    for name in WARM_TEMPLATES:
+        get_template(name)
+    warm_caches()
+    # Соединение, открытое до форка, оказалось бы общим для всех воркеров
+    connections.close_all()
+    gc.collect()
+    gc.freeze()
+    return application, time.perf_counter() - started
+
+
+def gunicorn_options(options):
+    """Настройки gunicorn из SERVICEDESK_SERVER"""
+    if options['ASGI']:
+        worker_class = ASGI_WORKER_CLASS
+    else:
+        worker_class = 'gthread' if options['THREADS'] > 1 else 'sync'
+    return {
+        'bind': options['BIND'],
+        'workers': options['WORKERS'],
+        'threads': options['THREADS'],
+        'worker_class': worker_class,
+        'preload_app': True,
+        'max_requests': options['MAX_REQUESTS'],
+        'max_requests_jitter': options['MAX_REQUESTS_JITTER'],
+        'timeout': options['TIMEOUT'],
+        'graceful_timeout': options['GRACEFUL_TIMEOUT'],
+        'keepalive': options['KEEPALIVE'],
+        'accesslog': '-',
+    }
+
+
+def run(application, options):
+    """Запускает мастер gunicorn с уже загруженным приложением; возвращается после остановки"""
+    # gunicorn нужен только боевому серверу, остальным командам его импорт ни к чему
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in gunicorn_options(options).items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return application
+
+    Server().run()
@@ -0,0 +1,149 @@
+"""
+Перенос обращений сообщества в другой шард без остановки приема сообщений.
+
+Сначала группа переключается на новый шард с отметкой shard_moving_from:
+новые обращения сразу создаются в новом шарде, а сообщения в еще не
+перенесенные активные обращения дописываются в старый (event_handlers).
+Затем обращения переносятся пачками: пачка блокируется в исходном шарде,
+копируется с сообщениями и тегами в новый и удаляется из исходного - в двух
+транзакциях, новый шард фиксируется первым. Обращения, уже скопированные
+прерванным запуском, не копируются повторно: копия обновляется из исходного
+шарда и дополняется сообщениями и тегами, которые появились там после
+копирования, поэтому перенос можно перезапустить без потерь. После последней
+пачки отметка снимается.
+"""
+import time
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from . import fragments, sharding
+from .models import Message, Ticket, TicketTag, VKGroup
+
+
+class GroupShardMove:
+    """Перенос обращений группы group в шард target (алиас из DATABASES)"""
+
+    def __init__(self, group, target, batch_size=200, pause=0.1, log=None):
+        self.group = group
+        self.target = target or DEFAULT_DB_ALIAS
+        self.batch_size = batch_size
+        self.pause = pause
+        self.log = log or (lambda message: None)
+        self.stats = {'tickets': 0, 'messages': 0}
+
+    def run(self):
+        group = self.group
+        if group.shard_moving_from:
+            # Продолжение прерванного переноса
+            if sharding.group_shard(group) != self.target:
+                raise ValueError(
+                    f'Группа уже переносится в шард {sharding.group_shard(group)}'
+                )
+            self.source = group.shard_moving_from
+        else:
+            self.source = sharding.group_shard(group)
+            if self.source == self.target:
+                return self.stats
+            group.shard = '' if self.target == DEFAULT_DB_ALIAS else self.target
+            group.shard_moving_from = self.source
+            VKGroup.objects.filter(pk=group.pk).update(shard=group.shard, shard_moving_from=group.shard_moving_from)
+
+        while self.move_batch():
+            self.log(f"Перенесено обращений: {self.stats['tickets']}, сообщений: {self.stats['messages']}")
+            if self.pause:
+                time.sleep(self.pause)
+
+        group.shard_moving_from = ''
+        VKGroup.objects.filter(pk=group.pk).update(shard_moving_from='')
+        return self.stats
+
+    def move_batch(self):
+        """Переносит очередную пачку; False, когда в исходном шарде не осталось обращений группы"""
+        source, target = self.source, self.target
+        with transaction.atomic(using=source), transaction.atomic(using=target):
+            tickets = list(
+                Ticket.objects.using(source).filter(vk_group=self.group).select_for_update().order_by('pk')[
+                    :self.batch_size
+                ]
+            )
+            if not tickets:
+                return False
+            old_pks = [ticket.pk for ticket in tickets]
+            copied = dict(Ticket.objects.using(target).filter(
+                ticket_id__in=[ticket.ticket_id for ticket in tickets]
+            ).values_list('ticket_id', 'pk'))
+            copies = [ticket for ticket in tickets if ticket.ticket_id not in copied]
+            # Скопированы прерванным запуском; после этого в исходный шард могли дописать сообщения
+            resumed = [ticket for ticket in tickets if ticket.ticket_id in copied]
+
+            new_pks = self.copy_tickets(copies)
+            resumed_pks = self.refresh_tickets(resumed, copied)
+            pks = {**new_pks, **resumed_pks}
+            messages = self.copy_messages(pks, resumed_pks)
+            links = [
+                TicketTag(ticket_id=pks[ticket_pk], tag_id=tag_id)
+                for ticket_pk, tag_id in TicketTag.objects.using(source).filter(
+                    ticket_id__in=pks
+                ).values_list('ticket_id', 'tag_id')
+            ]
+            # Связи уже скопированных обращений повторно не вставляются
+            TicketTag.objects.using(target).bulk_create(links, ignore_conflicts=True)
+
+            Ticket.objects.using(source).filter(pk__in=old_pks).delete()
+
+        fragments.touch_tickets(pks.values(), target)
+        self.stats['tickets'] += len(copies)
+        self.stats['messages'] += len(messages)
+        return True
+
+    def refresh_tickets(self, tickets, copied):
+        """Переписывает копии обращений полями из исходного шарда, возвращает {старый pk: новый pk}"""
+        pks = {ticket.pk: copied[ticket.ticket_id] for ticket in tickets}
+        fields = [field for field in Ticket._meta.concrete_fields if not field.primary_key]
+        refreshed = [
+            Ticket(pk=pks[ticket.pk], **{field.attname: getattr(ticket, field.attname) for field in fields})
+            for ticket in tickets
+        ]
+        Ticket.objects.using(self.target).bulk_update(refreshed, [field.name for field in fields])
+        return pks
+
+    def copy_messages(self, pks, resumed_pks):
+        """
+        Копирует сообщения обращений pks ({старый pk: новый pk}); у уже скопированных
+        обращений (resumed_pks) - только те, которых нет в новом шарде
+        """
+        messages = list(Message.objects.using(self.source).filter(ticket_id__in=pks))
+        present = {
+            message_key(*row) for row in Message.objects.using(self.target).filter(
+                ticket_id__in=resumed_pks.values()
+            ).values_list('ticket_id', 'message_id', 'created_at', 'is_admin')
+        }
+        missing = []
+        for message in messages:
+            message.pk = None
+            message.ticket_id = pks[message.ticket_id]
+            key = message_key(message.ticket_id, message.message_id, message.created_at, message.is_admin)
+            if key not in present:
+                missing.append(message)
+        Message.objects.using(self.target).bulk_create(missing)
+        return missing
+
+    def copy_tickets(self, tickets):
+        """Создает копии обращений в новом шарде, возвращает {старый pk: новый pk}"""
+        old_pks = [ticket.pk for ticket in tickets]
+        # bulk_create проставляет updated_at (auto_now) - исходные значения возвращаем отдельно
+        updated = [ticket.updated_at for ticket in tickets]
+        for ticket in tickets:
+            ticket.pk = None
+        Ticket.objects.using(self.target).bulk_create(tickets)
+        for ticket, updated_at in zip(tickets, updated):
+            ticket.updated_at = updated_at
+        Ticket.objects.using(self.target).bulk_update(tickets, ['updated_at'])
+        return {old_pk: ticket.pk for old_pk, ticket in zip(old_pks, tickets)}
+
+
+def message_key(ticket_pk, message_id, created_at, is_admin):
+    """Одно и то же сообщение в двух шардах: по ID сообщения ВК, у ответов без него - по времени и автору"""
+    if message_id is not None:
+        return ticket_pk, message_id
+    return ticket_pk, None, created_at, is_admin
@@ -0,0 +1,178 @@
+"""
+Шардирование обращений по сообществам.
+
+Обращения, сообщения и связи с тегами сообщества хранятся в базе VKGroup.shard
+(алиас из SERVICEDESK_SHARDS; пусто - default). Код, работающий с одной группой
+или одним обращением, выполняется в контексте use_shard(alias): ShardRouter
+направляет туда все запросы к этим моделям, а atomic() открывает транзакцию
+в той же базе. Списки и счетчики по всем сообществам собираются со всех шардов
+(for_each_shard). Остальные таблицы (группы, пользователи, теги, агрегаты,
+нагрузка) живут в default, и шард должен видеть их для JOIN: удобнее всего
+делать шард схемой PostgreSQL той же базы с search_path=<схема>,public.
+
+Без настроенных шардов все работает как раньше - с одной базой default.
+"""
+import contextvars
+import heapq
+from contextlib import contextmanager
+from functools import wraps
+from itertools import islice
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+SHARDED_MODELS = ('servicedesk.ticket', 'servicedesk.message', 'servicedesk.tickettag')
+
+# Глубина слияния выборок шардов: срез [start:stop] читает stop строк из каждого
+# шарда, поэтому дальние страницы недоступны - их нужно сужать фильтрами
+MAX_MERGED_ROWS = 1000
+
+
+def get_shard_aliases():
+    """Алиасы DATABASES, выделенные под шарды (кроме default)"""
+    return list(getattr(settings, 'SERVICEDESK_SHARDS', []))
+
+
+def all_aliases():
+    return [DEFAULT_DB_ALIAS, *get_shard_aliases()]
+
+
+def is_sharded():
+    return bool(get_shard_aliases())
+
+
+_current = contextvars.ContextVar('servicedesk_shard', default=None)
+
+
+@contextmanager
+def use_shard(alias):
+    """Направляет запросы к обращениям, сообщениям и связям с тегами в шард alias"""
+    token = _current.set(alias or DEFAULT_DB_ALIAS)
+    try:
+        yield alias
+    finally:
+        _current.reset(token)
+
+
+def current_shard():
+    return _current.get() or DEFAULT_DB_ALIAS
+
+
+def instance_shard(instance):
+    """Шард, из которого загружен объект (чтение с реплики относится к default)"""
+    alias = instance._state.db
+    return alias if alias in get_shard_aliases() else DEFAULT_DB_ALIAS
+
+
+def atomic(**kwargs):
+    """transaction.atomic в базе текущего шарда"""
+    return transaction.atomic(using=current_shard(), **kwargs)
+
+
+def group_shard(group):
+    """Шард, в котором создаются новые обращения группы"""
+    return group.shard or DEFAULT_DB_ALIAS
+
+
+def for_each_shard():
+    """Перебирает шарды; тело цикла выполняется в контексте очередного шарда"""
+    for alias in all_aliases():
+        with use_shard(alias):
+            yield alias
+
+
+def find_ticket_shard(ticket_id):
+    """Шард, в котором лежит обращение с номером ticket_id (по запросу на шард)"""
+    if not is_sharded():
+        return DEFAULT_DB_ALIAS
+    from .models import Ticket
+    for alias in all_aliases():
+        if Ticket.objects.using(alias).filter(ticket_id=ticket_id).exists():
+            return alias
+    return DEFAULT_DB_ALIAS
+
+
+def ticket_shard_view(view):
+    """Декоратор view с параметром ticket_id: view выполняется в шарде этого обращения"""
+    @wraps(view)
+    def wrapper(request, ticket_id, *args, **kwargs):
+        with use_shard(find_ticket_shard(ticket_id)):
+            return view(request, ticket_id, *args, **kwargs)
+    return wrapper
+
+
+def spread(queryset):
+    """
+    Копии queryset для всех шардов. Копия для default не привязывается
+    к базе, чтобы чтение могло уйти на реплику
+    """
+    return [queryset] + [queryset.using(alias) for alias in get_shard_aliases()]
+
+
+class ShardedList:
+    """
+    Отсортированная выборка со всех шардов для Paginator и срезов: count()
+    суммирует счетчики шардов, срез [start:stop] берет первые stop строк
+    каждого шарда и сливает их по key. Доступны только первые MAX_MERGED_ROWS
+    строк: count() не больше этого числа, срезы за ним пусты
+    """
+
+    def __init__(self, querysets, key, reverse=False):
+        self.querysets = querysets
+        self.key = key
+        self.reverse = reverse
+
+    def count(self):
+        return min(sum(queryset.count() for queryset in self.querysets), MAX_MERGED_ROWS)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        start = item.start or 0
+        stop = MAX_MERGED_ROWS if item.stop is None else min(item.stop, MAX_MERGED_ROWS)
+        parts = [queryset[:stop] for queryset in self.querysets]
+        merged = heapq.merge(*parts, key=self.key, reverse=self.reverse)
+        return list(islice(merged, start, stop))
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+def merged(queryset, key, reverse=False):
+    """queryset, отсортированный так же, как key; с шардами - ShardedList по всем шардам"""
+    if not is_sharded():
+        return queryset
+    return ShardedList(spread(queryset), key, reverse)
+
+
+class ShardRouter:
+    """
+    Роутер Django для моделей шарда: объект остается в базе, из которой загружен,
+    остальные запросы идут в текущий шард. Для default решение принимают
+    следующие роутеры (реплики для чтения)
+    """
+
+    def route(self, model, hints):
+        if model._meta.label_lower not in SHARDED_MODELS:
+            return None
+        shards = get_shard_aliases()
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in shards:
+            return instance._state.db
+        alias = _current.get()
+        return alias if alias in shards else None
+
+    def db_for_read(self, model, **hints):
+        return self.route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # В шардах создаются только таблицы шардируемых моделей
+        if db in get_shard_aliases():
+            return f'{app_label}.{model_name}' in SHARDED_MODELS
+        return None
@@ -0,0 +1,59 @@
+"""
+Сброс кэшированных фрагментов при сохранении и удалении моделей, счетчики
+нагрузки для сотрудников и журнал SQL профилирования на новых соединениях.
+Массовые update() и bulk_create() сигналов не вызывают - там кэш
+сбрасывается явно через функции fragments. На удаление Message обработчик
+не подписан, чтобы очистка старой переписки оставалась одним DELETE
+без загрузки строк: удаленные сообщения и так больше не рендерятся.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import admission, fragments, profiling, sharding
+from .models import Message, OperatorLoad, Tag, Ticket, VKGroup
+
+
+@receiver(post_save, sender=Ticket)
+def ticket_saved(sender, instance, **kwargs):
+    fragments.touch_tickets([instance.pk], sharding.instance_shard(instance))
+
+
+@receiver(post_save, sender=Message)
+def message_changed(sender, instance, **kwargs):
+    # Новое или прочитанное сообщение меняет счетчик непрочитанных в строке обращения
+    shard = sharding.instance_shard(instance)
+    fragments.touch_tickets([instance.ticket_id], shard)
+    fragments.invalidate_messages([instance.pk], shard)
+
+
+@receiver([post_save, post_delete], sender=Tag)
+def tag_changed(sender, instance, **kwargs):
+    fragments.invalidate_tags()
+
+
+@receiver([post_save, post_delete], sender=VKGroup)
+def group_changed(sender, instance, **kwargs):
+    # Callback от новой группы принимается сразу во всех процессах, а не после
+    # перечитывания списка: этот процесс сбрасывает свой список, остальные видят
+    # новую версию в общем кэше. Повтор после коммита - чтобы процесс, успевший
+    # перечитать список до коммита, не остался со старым
+    admission.forget_groups()
+    transaction.on_commit(admission.forget_groups)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, **kwargs):
+    # Новый сотрудник сразу участвует в распределении, бывший - больше нет
+    if instance.is_staff:
+        OperatorLoad.objects.get_or_create(user=instance)
+    else:
+        OperatorLoad.objects.filter(user=instance).delete()
+
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    # Запросы под профилированием учитываются в любом потоке, в том числе из sync_to_async
+    profiling.install_query_log(connection)
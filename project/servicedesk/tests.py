@@ -1,12 +1,52 @@
+import asyncio
+import csv
 import json
+import logging
+import logging.handlers
+import re
+import tempfile
+import threading
+import time
 from datetime import datetime, timedelta
+from io import StringIO
+from unittest import skipUnless
 from unittest.mock import patch, Mock
-from django.test import TestCase, Client
+import httpx
+from django.http import HttpResponse, QueryDict
+from django.test import (AsyncClient, RequestFactory, TestCase, TransactionTestCase, Client, override_settings,
+                         skipUnlessDBFeature)
 from django.urls import reverse
+from django.utils.html import escape
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.cache import cache
-from .models import Ticket, Message, Tag, VKGroup
+from django.conf import settings
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections, router
+from django.test.utils import CaptureQueriesContext
+from . import (admission, analytics, assignment, event_queue, fragments, maintenance, profiling, routers,
+               server, sharding, timeline, work_queue)
+from .admin import EstimatedCountPaginator
+from .event_handlers import ahandle_message_new, handle_message_new
+from .exports import export_tickets_stream
+from .filters import filter_tickets, get_ticket_filters, tag_facets, ticket_typeahead, typeahead_tickets
+from .importer import HistoryImporter, message_time
+from .longpoll import LongPollListener
+from .logutils import BackgroundQueueHandler, EventSamplingFilter, JsonFormatter
+from .middleware import PRIMARY_COOKIE, ReplicaRoutingMiddleware
+from .models import (Ticket, Message, Tag, VKGroup, StatsRollup, OperatorLoad, JobCheckpoint, InboundEvent,
+                     EventPartition, TicketTag, VKUserSummary)
+from .shard_move import GroupShardMove
+from .views import parse_vk_callback
+from .vk_api import API_URL, AsyncVKClient, RateLimiter, VKAPIError, VKClient, get_call_window
+
+
+def parse_execute_code(code):
+    """Вызовы [(method, params)] из кода execute, собранного execute_code"""
+    return [
+        (method, json.loads(params))
+        for method, params in re.findall(r'API\.([\w.]+)\((\{.*?\})\)(?=[,\]])', code)
+    ]
 
 
 class SupportAppTests(TestCase):
@@ -154,6 +194,12 @@ class ModelTests(SupportAppTests):
         tickets_with_same_id = Ticket.objects.filter(ticket_id=new_ticket.ticket_id)
         self.assertEqual(tickets_with_same_id.count(), 1)
 
+    def test_allocations_do_not_overlap_before_insert(self):
+        """Номера, выданные до вставки обращений, не выдаются повторно"""
+        first = Ticket.allocate_ticket_ids(2)
+        second = Ticket.allocate_ticket_ids(2)
+        self.assertFalse(set(first) & set(second))
+
     def test_ticket_unread_messages_count(self):
         """Тест подсчета непрочитанных сообщений"""
         # У ticket1 есть одно непрочитанное сообщение от пользователя
@@ -211,6 +257,31 @@ class ModelTests(SupportAppTests):
         self.assertEqual(self.ticket1.get_priority_display(), 'Критический')
 
 
+class TicketNumberingTests(TransactionTestCase):
+    """Параллельная выдача номеров обращений"""
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_allocations_get_distinct_numbers(self):
+        """Два процесса, одновременно берущие номера, получают разные"""
+        start = threading.Barrier(2)
+        results = []
+
+        def allocate():
+            try:
+                start.wait()
+                results.extend(Ticket.allocate_ticket_ids(50))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=allocate) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 100)
+        self.assertEqual(len(set(results)), 100)
+
+
 class ViewTests(SupportAppTests):
     """Тесты представлений"""
 
@@ -316,3 +387,1754 @@ class ViewTests(SupportAppTests):
         self.assertEqual(self.ticket2.tags.count(), 2)
         self.assertIn(self.tag_urgent, self.ticket2.tags.all())
         self.assertIn(self.tag_feature, self.ticket2.tags.all())
+
+
+class QueryBudgetTests(TestCase):
+    """Бюджет SQL-запросов: число запросов не должно расти вместе с объемом данных"""
+
+    SMALL_VOLUME = 5
+    LARGE_VOLUME = 300
+    MESSAGES_PER_TICKET = 10
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_user(
+            username='budget_admin',
+            password='testpass123',
+            is_staff=True
+        )
+        cls.vk_group = VKGroup.objects.create(
+            group_id=555,
+            name='Budget Group',
+            access_token='token'
+        )
+        cls.tags = Tag.objects.bulk_create([Tag(name=f'budget-{i}') for i in range(5)])
+        cls.seeded = 0
+
+    def setUp(self):
+        self.client.login(username='budget_admin', password='testpass123')
+
+    def seed(self, total):
+        """Доводит количество обращений до total, у каждого MESSAGES_PER_TICKET сообщений"""
+        if total <= self.seeded:
+            return
+        tickets = Ticket.objects.bulk_create([
+            Ticket(
+                ticket_id=f'19990101-{num:04d}',
+                user_id=10000 + num,
+                user_name=f'Пользователь {num}',
+                status=Ticket.STATUS_CHOICES[num % 4][0],
+                priority=Ticket.PRIORITY_CHOICES[num % 4][0],
+                vk_group=self.vk_group,
+                admin=self.admin_user if num % 2 else None,
+                waiting_since=timezone.now(),
+            )
+            for num in range(self.seeded, total)
+        ])
+        Message.objects.bulk_create([
+            Message(
+                ticket=ticket,
+                message_id=ticket.user_id * 100 + i,
+                text=f'Сообщение {i}',
+                is_admin=bool(i % 3 == 0),
+                admin_author=self.admin_user if i % 3 == 0 else None,
+                attachments=[{'type': 'doc', 'doc': {'title': 'file', 'ext': 'pdf'}}] if i == 1 else [],
+            )
+            for ticket in tickets
+            for i in range(self.MESSAGES_PER_TICKET)
+        ])
+        TicketTags = Ticket.tags.through
+        TicketTags.objects.bulk_create([
+            TicketTags(ticket_id=ticket.pk, tag_id=self.tags[i % len(self.tags)].pk)
+            for i, ticket in enumerate(tickets)
+        ])
+        self.seeded = total
+
+    def assertQueryBudget(self, budget, action, label):
+        """Выполняет action и падает со списком SQL, если запросов больше бюджета"""
+        with CaptureQueriesContext(connection) as queries:
+            action()
+        if len(queries) > budget:
+            sql = '\n'.join(f'{i}. {query["sql"]}' for i, query in enumerate(queries.captured_queries, 1))
+            self.fail(f'{label}: {len(queries)} запросов при бюджете {budget}\n{sql}')
+        return len(queries)
+
+    def assertFlatBudget(self, budget, action, label):
+        """
+        Проверяет бюджет на малом и большом объеме данных и что число запросов не изменилось.
+        Кэш очищается перед каждым замером: считается худший случай
+        """
+        self.seed(self.SMALL_VOLUME)
+        cache.clear()
+        small = self.assertQueryBudget(budget, action, f'{label} ({self.SMALL_VOLUME} обращений)')
+        self.seed(self.LARGE_VOLUME)
+        cache.clear()
+        large = self.assertQueryBudget(budget, action, f'{label} ({self.LARGE_VOLUME} обращений)')
+        self.assertEqual(small, large, f'{label}: число запросов растет с объемом данных ({small} -> {large})')
+
+    def test_ticket_list_budget(self):
+        """Список обращений: сессия, пользователь, счетчики, count, страница, теги"""
+        def action():
+            response = self.client.get(reverse('ticket_list'))
+            self.assertEqual(response.status_code, 200)
+
+        self.assertFlatBudget(8, action, 'ticket_list')
+
+    def test_ticket_list_search_budget(self):
+        """Поиск по тексту сообщений не добавляет запросов на строку"""
+        def action():
+            response = self.client.get(reverse('ticket_list') + '?q=Сообщение&status=open')
+            self.assertEqual(response.status_code, 200)
+
+        self.assertFlatBudget(8, action, 'ticket_list search')
+
+    def test_ticket_detail_budget(self):
+        """Карточка обращения: один запрос на переписку независимо от ее длины"""
+        def action():
+            response = self.client.get(reverse('ticket_detail', args=['19990101-0001']))
+            self.assertEqual(response.status_code, 200)
+
+        self.MESSAGES_PER_TICKET = 2
+        self.seed(2)
+        self.MESSAGES_PER_TICKET = 200
+        self.assertFlatBudget(7, action, 'ticket_detail')
+
+    def assertBulkActionBudget(self, **action_data):
+        """Массовое действие над всеми обращениями выполняется фиксированным числом запросов"""
+        def action():
+            ticket_ids = list(Ticket.objects.values_list('ticket_id', flat=True))
+            self.client.post(reverse('bulk_action'), {'ticket_ids': ticket_ids, **action_data})
+
+        # Бюджет включает запрос списка ticket_id внутри action и пересчет нагрузки операторов
+        self.assertFlatBudget(11, action, f'bulk_action {action_data["action"]}')
+
+    def test_bulk_assign_budget(self):
+        self.assertBulkActionBudget(action='assign_to_me')
+
+    def test_bulk_change_status_budget(self):
+        self.assertBulkActionBudget(action='change_status', new_status='closed')
+
+    def test_bulk_add_tag_budget(self):
+        self.assertBulkActionBudget(action='add_tag', tag_id=self.tags[0].pk)
+
+    @patch('project.servicedesk.event_handlers.get_vk_user_info')
+    def test_handle_message_new_budget(self, mock_user_info):
+        """Прием сообщения: группа, активное обращение, номер, назначение оператора, вставки, агрегаты, сводка пользователя"""
+        mock_user_info.return_value = {'name': 'Новый Пользователь', 'photo': ''}
+        counter = iter(range(1, 10000))
+
+        def new_ticket():
+            num = next(counter)
+            handle_message_new(vk_event(self.vk_group.group_id, 90000 + num, num))
+
+        def existing_ticket():
+            num = next(counter)
+            handle_message_new(vk_event(self.vk_group.group_id, 10000, num))
+
+        # Сотрудник budget_admin получает счетчик нагрузки при создании, назначение включено в бюджет.
+        # Счетчик номеров дня уже создан: первый номер за день дороже на начальное значение
+        Ticket.allocate_ticket_ids(0)
+        self.assertFlatBudget(17, new_ticket, 'handle_message_new (новое обращение)')
+        self.assertFlatBudget(8, existing_ticket, 'handle_message_new (существующее обращение)')
+
+
+def vk_event(group_id, from_id, message_id, text='Здравствуйте'):
+    """Событие message_new в формате Callback API"""
+    return {
+        'type': 'message_new',
+        'group_id': group_id,
+        'object': {'message': {'id': message_id, 'from_id': from_id, 'text': text}},
+        'secret': settings.VK_CALLBACK_API['SECRET_KEY'],
+    }
+
+
+class LoggingTests(TestCase):
+    """Тесты структурированного логирования"""
+
+    def make_record(self, level=logging.INFO, **extra):
+        record = logging.LogRecord('project.servicedesk', level, __file__, 1, 'VK callback', (), None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_formatter_truncates_payload(self):
+        """Большой payload обрезается, структура записи сохраняется"""
+        formatter = JsonFormatter(max_length=50)
+        record = self.make_record(event_type='message_new', payload={'text': 'x' * 500})
+
+        entry = json.loads(formatter.format(record))
+
+        self.assertEqual(entry['message'], 'VK callback')
+        self.assertEqual(entry['event_type'], 'message_new')
+        self.assertLess(len(entry['payload']), 100)
+        self.assertIn('...(+', entry['payload'])
+
+    def test_sampling_filter(self):
+        """Выборка по типу события, ошибки проходят всегда"""
+        sampling = EventSamplingFilter(rates={'message_new': 0}, default_rate=1.0)
+
+        self.assertFalse(sampling.filter(self.make_record(event_type='message_new')))
+        self.assertTrue(sampling.filter(self.make_record(event_type='confirmation')))
+        self.assertTrue(sampling.filter(self.make_record()))
+        self.assertTrue(sampling.filter(self.make_record(logging.ERROR, event_type='message_new')))
+
+    def test_background_handler_drops_on_overflow(self):
+        """Переполненная очередь не блокирует вызывающий поток"""
+        target = logging.handlers.BufferingHandler(capacity=100)
+        handler = BackgroundQueueHandler(target, maxsize=1)
+        handler.listener.stop()
+        for _ in range(5):
+            handler.handle(self.make_record())
+        self.assertEqual(handler.dropped, 4)
+
+        # После запуска фоновый поток дописывает то, что успело попасть в очередь
+        handler.listener.start()
+        handler.listener.stop()
+        self.assertEqual(len(target.buffer), 1)
+        handler.close()
+
+
+class AsyncVKTests(TestCase):
+    """Тесты асинхронного пути приема сообщений"""
+
+    def setUp(self):
+        self.vk_group = VKGroup.objects.create(group_id=777, name='Async Group', access_token='token')
+
+    def mock_http_client(self, handler):
+        return httpx.AsyncClient(base_url=API_URL, transport=httpx.MockTransport(handler))
+
+    @override_settings(VK_API={'RATE_LIMIT': 0, 'AUTO_BATCH': False})
+    async def test_async_client_keeps_calls_in_flight(self):
+        """Сотни вызовов выполняются одновременно, а не по очереди (лимит частоты и склейка отключены)"""
+        in_flight = 0
+        max_in_flight = 0
+
+        async def handler(request):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return httpx.Response(200, json={'response': [{'first_name': 'A', 'last_name': 'B'}]})
+
+        client = AsyncVKClient('token', http_client=self.mock_http_client(handler))
+        results = await asyncio.gather(*(client.call('users.get', user_ids=i) for i in range(300)))
+
+        self.assertEqual(len(results), 300)
+        self.assertGreaterEqual(max_in_flight, 100)
+
+    @override_settings(VK_API={'RATE_LIMIT': 0})
+    async def test_concurrent_calls_coalesce_into_execute(self):
+        """Одновременные вызовы склеиваются в execute по 25, ошибки доходят до своих вызывающих"""
+        requests_seen = []
+
+        def handler(request):
+            requests_seen.append(request.url.path)
+            calls = parse_execute_code(dict(httpx.QueryParams(request.content.decode()))['code'])
+            response, errors = [], []
+            for method, params in calls:
+                if params['user_ids'] == 13:
+                    response.append(False)
+                    errors.append({'method': method, 'error_code': 18, 'error_msg': 'User was deleted'})
+                else:
+                    response.append([{'id': params['user_ids']}])
+            return httpx.Response(200, json={'response': response, 'execute_errors': errors})
+
+        client = AsyncVKClient('batch-token', http_client=self.mock_http_client(handler))
+        results = await asyncio.gather(
+            *(client.call('users.get', user_ids=i) for i in range(60)), return_exceptions=True
+        )
+
+        self.assertEqual(requests_seen, ['/method/execute'] * 3)
+        self.assertEqual(results[5], [{'id': 5}])
+        self.assertIsInstance(results[13], VKAPIError)
+        self.assertEqual(results[13].code, 18)
+
+    @override_settings(VK_API={'RATE_LIMIT': 0})
+    async def test_windows_keep_tokens_apart(self):
+        """Одновременные вызовы разных токенов уходят разными запросами, каждый со своим токеном"""
+        tokens = []
+
+        def handler(request):
+            data = dict(httpx.QueryParams(request.content.decode()))
+            tokens.append(data['access_token'])
+            return httpx.Response(200, json={'response': [[{'id': 1}]] * len(parse_execute_code(data['code']))})
+
+        http_client = self.mock_http_client(handler)
+        first = AsyncVKClient('first-token', http_client=http_client)
+        second = AsyncVKClient('second-token', http_client=http_client)
+        await asyncio.gather(*(client.call('users.get', user_ids=i) for i in range(3) for client in (first, second)))
+
+        self.assertEqual(sorted(tokens), ['first-token', 'second-token'])
+
+    @override_settings(VK_API={'RATE_LIMIT': 0})
+    def test_sync_window_sends_lone_call_and_joins_waiting_ones(self):
+        """Одиночный вызов уходит сразу, вызовы во время запроса - следующей пачкой"""
+        release = threading.Event()
+        methods = []
+
+        def post(url, data, timeout):
+            method = url.rsplit('/', 1)[1]
+            methods.append(method)
+            if len(methods) == 1:
+                release.wait(5)
+            count = len(parse_execute_code(data['code'])) if method == 'execute' else 1
+            response = Mock()
+            response.json.return_value = {'response': [[{'id': 1}]] * count if method == 'execute' else [{'id': 1}]}
+            return response
+
+        def wait_for(condition):
+            deadline = time.monotonic() + 5
+            while not condition() and time.monotonic() < deadline:
+                time.sleep(0.001)
+
+        session = Mock()
+        session.post.side_effect = post
+        client = VKClient('window-token', session=session)
+        window = get_call_window(client)
+        results = []
+        threads = [
+            threading.Thread(target=lambda i=i: results.append(client.call('users.get', user_ids=i)))
+            for i in range(4)
+        ]
+        threads[0].start()
+        wait_for(lambda: methods)
+        for thread in threads[1:]:
+            thread.start()
+        wait_for(lambda: len(window.pending) == 3)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(methods, ['users.get', 'execute'])
+        self.assertEqual(len(results), 4)
+
+    def test_explicit_batch_routes_results(self):
+        """Пачка VKClient.batch() - один запрос execute, результат на каждый вызов"""
+        session = Mock()
+        session.post.return_value.json.return_value = {
+            'response': [[{'id': 1}], False],
+            'execute_errors': [{'method': 'users.get', 'error_code': 113, 'error_msg': 'Invalid user id'}],
+        }
+        client = VKClient('token', session=session)
+
+        with client.batch() as batch:
+            first = batch.call('users.get', user_ids=1)
+            second = batch.call('users.get', user_ids='bad')
+
+        self.assertEqual(session.post.call_count, 1)
+        self.assertTrue(session.post.call_args.args[0].endswith('/execute'))
+        self.assertEqual(first.result(), [{'id': 1}])
+        with self.assertRaises(VKAPIError):
+            second.result()
+
+    def test_rate_limiter_spaces_calls(self):
+        """Ограничитель выдает слоты с интервалом 1/rate"""
+        limiter = RateLimiter(rate=10)
+        delays = [limiter.reserve() for _ in range(5)]
+
+        self.assertLessEqual(delays[0], 0)
+        self.assertAlmostEqual(delays[4], 0.4, delta=0.05)
+
+    async def test_async_client_raises_api_error(self):
+        """Ошибка VK API превращается в VKAPIError"""
+        def handler(request):
+            return httpx.Response(200, json={'error': {'error_code': 5, 'error_msg': 'auth failed'}})
+
+        client = AsyncVKClient('token', http_client=self.mock_http_client(handler))
+        with self.assertRaises(VKAPIError) as ctx:
+            await client.call('users.get', user_ids=1)
+        self.assertEqual(ctx.exception.code, 5)
+
+    @patch('project.servicedesk.event_handlers.aget_vk_user_info')
+    async def test_async_handler_creates_ticket(self, mock_user_info):
+        """Асинхронный обработчик создает обращение и сообщение"""
+        mock_user_info.return_value = {'name': 'Асинхронный Пользователь', 'photo': ''}
+
+        await ahandle_message_new(vk_event(777, 4242, 1, 'Первая строка\nвторая'))
+
+        ticket = await Ticket.objects.aget(user_id=4242)
+        self.assertEqual(ticket.user_name, 'Асинхронный Пользователь')
+        self.assertEqual(ticket.subject, 'Первая строка')
+        self.assertEqual(await ticket.messages.acount(), 1)
+
+    @patch('project.servicedesk.event_handlers.aget_vk_user_info')
+    def test_async_callback_view(self, mock_user_info):
+        """Асинхронный view принимает событие и отвечает ok"""
+        mock_user_info.return_value = {'name': 'Пользователь', 'photo': ''}
+
+        response = self.client.post(
+            reverse('vk_callback_async'),
+            data=json.dumps(vk_event(777, 4343, 2)),
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.content, b'ok')
+        self.assertTrue(Ticket.objects.filter(user_id=4343).exists())
+
+
+class AnalyticsTests(SupportAppTests):
+    """Тесты почасовых агрегатов аналитики"""
+
+    def rollup_totals(self, dimension=StatsRollup.ALL, dimension_id=0):
+        start = timezone.now() - timedelta(days=365)
+        end = timezone.now() + timedelta(days=1)
+        rows = analytics.report(dimension, start, end, dimension_id)
+        return rows[0] if rows else {}
+
+    @patch('project.servicedesk.event_handlers.get_vk_user_info')
+    def test_ingestion_updates_rollups(self, mock_user_info):
+        """Прием сообщений увеличивает счетчики по всей поддержке и по группе"""
+        mock_user_info.return_value = {'name': 'Новый', 'photo': ''}
+
+        handle_message_new(vk_event(self.vk_group.group_id, 5001, 100))
+        handle_message_new(vk_event(self.vk_group.group_id, 5001, 101))
+
+        for dimension, dimension_id in ((StatsRollup.ALL, 0), (StatsRollup.GROUP, self.vk_group.pk)):
+            totals = self.rollup_totals(dimension, dimension_id)
+            self.assertEqual(totals['tickets_created'], 1)
+            self.assertEqual(totals['messages_received'], 2)
+
+    @patch('project.servicedesk.views.send_vk_message', return_value=True)
+    def test_first_response_counted_once(self, mock_send):
+        """Время первой реакции учитывается только по первому ответу"""
+        self.client.login(username='admin', password='testpass123')
+        url = reverse('ticket_detail', args=[self.ticket2.ticket_id])
+
+        self.client.post(url, {'response': 'Первый ответ'})
+        self.client.post(url, {'response': 'Второй ответ'})
+
+        self.ticket2.refresh_from_db()
+        self.assertIsNotNone(self.ticket2.first_response_at)
+        totals = self.rollup_totals(StatsRollup.OPERATOR, self.admin_user.pk)
+        self.assertEqual(totals['messages_sent'], 2)
+        self.assertEqual(totals['first_responses'], 1)
+
+    def test_bulk_close_counts_resolved_with_tags(self):
+        """Массовое закрытие попадает в срезы тегов"""
+        self.client.login(username='admin', password='testpass123')
+        self.client.post(reverse('bulk_action'), {
+            'ticket_ids': [self.ticket1.ticket_id, self.ticket2.ticket_id, self.ticket3.ticket_id],
+            'action': 'change_status',
+            'new_status': 'closed',
+        })
+
+        # ticket3 уже был закрыт и повторно не учитывается
+        self.assertEqual(self.rollup_totals()['resolved'], 2)
+        self.assertEqual(self.rollup_totals(StatsRollup.TAG, self.tag_bug.pk)['resolved'], 1)
+
+    def test_backfill_rebuilds_history(self):
+        """Пересчет по истории учитывает обращения, сообщения и первые ответы"""
+        last_week = timezone.now() - timedelta(days=7)
+        Ticket.objects.update(created_at=last_week)
+        Message.objects.update(created_at=last_week + timedelta(hours=1))
+        Ticket.objects.filter(pk=self.ticket3.pk).update(closed_at=last_week + timedelta(hours=2))
+
+        call_command('backfill_analytics', chunk_size=2, stdout=StringIO())
+
+        totals = self.rollup_totals()
+        self.assertEqual(totals['tickets_created'], 3)
+        self.assertEqual(totals['messages_received'], 2)
+        self.assertEqual(totals['messages_sent'], 1)
+        self.assertEqual(totals['first_responses'], 1)
+        self.assertEqual(totals['first_response_seconds'], 3600)
+        self.assertEqual(totals['resolved'], 1)
+        self.ticket1.refresh_from_db()
+        self.assertIsNotNone(self.ticket1.first_response_at)
+
+        # Сбой посреди пересчета откатывает только текущее окно, агрегаты не пропадают
+        with patch('project.servicedesk.analytics.RollupBatch.save', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                call_command('backfill_analytics', stdout=StringIO())
+        self.assertEqual(self.rollup_totals(), totals)
+
+    def test_report_api(self):
+        """API отчета доступно только персоналу"""
+        response = self.client.get(reverse('analytics_report'))
+        self.assertEqual(response.status_code, 403)
+
+        self.client.login(username='admin', password='testpass123')
+        response = self.client.get(reverse('analytics_report'), {'dimension': 'group'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['dimension'], 'group')
+
+        response = self.client.get(reverse('analytics_report'), {'dimension': 'unknown'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(reverse('analytics_report'), {'dimension': 'group', 'dimension_id': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+
+class AssignmentTests(SupportAppTests):
+    """Тесты автоматического распределения обращений"""
+
+    def setUp(self):
+        super().setUp()
+        self.operator = User.objects.create_user(username='operator', password='testpass123', is_staff=True)
+        call_command('rebuild_operator_load', stdout=StringIO())
+
+    def load_of(self, user):
+        return OperatorLoad.objects.get(user=user)
+
+    def test_rebuild_counts_open_tickets(self):
+        """Пересчет учитывает только открытые назначенные обращения с весом приоритета"""
+        load = self.load_of(self.admin_user)
+        self.assertEqual(load.open_tickets, 1)
+        self.assertEqual(load.weighted_load, 3)
+        self.assertEqual(self.load_of(self.operator).open_tickets, 0)
+
+    @patch('project.servicedesk.event_handlers.get_vk_user_info')
+    def test_new_tickets_go_to_least_loaded(self, mock_user_info):
+        """Новые обращения получает наименее загруженный оператор, без COUNT-запросов"""
+        mock_user_info.return_value = {'name': 'Пользователь', 'photo': ''}
+
+        with CaptureQueriesContext(connection) as queries:
+            handle_message_new(vk_event(self.vk_group.group_id, 7001, 1))
+        self.assertFalse([q for q in queries.captured_queries if 'COUNT(' in q['sql'].upper()])
+
+        handle_message_new(vk_event(self.vk_group.group_id, 7002, 2))
+        handle_message_new(vk_event(self.vk_group.group_id, 7003, 3))
+
+        owners = list(Ticket.objects.filter(user_id__in=[7001, 7002, 7003]).order_by('user_id')
+                      .values_list('admin__username', flat=True))
+        # У admin уже есть обращение с весом 3, operator свободен
+        self.assertEqual(owners, ['operator', 'operator', 'admin'])
+        self.assertEqual(self.load_of(self.operator).weighted_load, 4)
+        self.assertEqual(self.load_of(self.admin_user).weighted_load, 5)
+
+    def test_staff_changes_update_operator_rows(self):
+        """Новый сотрудник получает счетчик нагрузки без пересчета, снятый с должности - теряет"""
+        newcomer = User.objects.create_user(username='newcomer', password='testpass123', is_staff=True)
+        self.assertEqual(self.load_of(newcomer).open_tickets, 0)
+
+        newcomer.is_staff = False
+        newcomer.save()
+        self.assertFalse(OperatorLoad.objects.filter(user=newcomer).exists())
+
+    def test_unavailable_operator_skipped(self):
+        """Оператор, который не принимает обращения, не получает новые"""
+        OperatorLoad.objects.filter(user=self.operator).update(is_available=False)
+        ticket = Ticket.objects.create(user_id=7100, user_name='Пользователь', vk_group=self.vk_group)
+
+        self.assertEqual(assignment.assign_ticket(ticket), self.admin_user.pk)
+
+    def test_close_and_reassign_update_load(self):
+        """Закрытие освобождает нагрузку, переназначение переносит ее"""
+        self.client.login(username='operator', password='testpass123')
+        self.client.post(reverse('ticket_detail', args=[self.ticket1.ticket_id]), {'assign_to_me': 'true'})
+
+        self.assertEqual(self.load_of(self.admin_user).open_tickets, 0)
+        self.assertEqual(self.load_of(self.operator).weighted_load, 3)
+
+        self.client.post(reverse('bulk_action'), {
+            'ticket_ids': [self.ticket1.ticket_id],
+            'action': 'change_status',
+            'new_status': 'closed',
+        })
+        load = self.load_of(self.operator)
+        self.assertEqual((load.open_tickets, load.weighted_load), (0, 0))
+        self.ticket1.refresh_from_db()
+        self.assertEqual(self.ticket1.load_weight, 0)
+
+
+class WorkQueueTests(SupportAppTests):
+    """Тесты очереди работы"""
+
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        self.critical_new = Ticket.objects.create(
+            user_id=8001, user_name='Критичный', priority='critical', status='open',
+            vk_group=self.vk_group, waiting_since=now
+        )
+        self.critical_old = Ticket.objects.create(
+            user_id=8002, user_name='Давно ждет', priority='critical', status='waiting',
+            vk_group=self.vk_group, waiting_since=now - timedelta(hours=3)
+        )
+        Ticket.objects.filter(pk=self.ticket1.pk).update(waiting_since=now - timedelta(days=1))
+        self.client.login(username='admin', password='testpass123')
+
+    def test_priority_rank_follows_priority(self):
+        """Числовой вес приоритета пересчитывается при сохранении"""
+        self.assertEqual(self.critical_new.priority_rank, 4)
+        self.ticket2.priority = 'low'
+        self.ticket2.save()
+        self.assertEqual(self.ticket2.priority_rank, 1)
+
+    def test_queue_order(self):
+        """Сначала вес приоритета, затем время ожидания; отвеченные и закрытые не попадают"""
+        response = self.client.get(reverse('work_queue_api'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [row['ticket_id'] for row in response.json()],
+            [self.critical_old.ticket_id, self.critical_new.ticket_id, self.ticket1.ticket_id]
+        )
+
+    def test_pull_next_assigns_ticket(self):
+        """Следующее обращение назначается на оператора и учитывается в его нагрузке"""
+        response = self.client.post(reverse('work_queue_next_api'))
+
+        self.assertEqual(response.json()['ticket_id'], self.critical_old.ticket_id)
+        self.critical_old.refresh_from_db()
+        self.assertEqual(self.critical_old.admin, self.admin_user)
+        self.assertEqual(OperatorLoad.objects.get(user=self.admin_user).weighted_load, 5)
+
+    def test_work_queue_page(self):
+        """Страница очереди и кнопка «Взять следующее»"""
+        response = self.client.get(reverse('work_queue'))
+        self.assertContains(response, self.critical_old.ticket_id)
+
+        response = self.client.post(reverse('work_queue'))
+        self.assertRedirects(response, reverse('ticket_detail', args=[self.critical_old.ticket_id]))
+
+    @patch('project.servicedesk.views.send_vk_message', return_value=True)
+    def test_reply_leaves_queue(self, mock_send):
+        """Ответ оператора убирает обращение из очереди"""
+        self.client.post(reverse('ticket_detail', args=[self.critical_old.ticket_id]), {'response': 'Ответ'})
+
+        self.assertNotIn(self.critical_old, work_queue.queue_tickets())
+
+    def test_reopened_tickets_queued_by_reopen_time(self):
+        """Вручную возвращенное в очередь обращение встает по времени возврата, а не в конец"""
+        closed = [
+            Ticket.objects.create(user_id=user_id, user_name='Закрыт', priority='critical', status='closed',
+                                  vk_group=self.vk_group, closed_at=timezone.now())
+            for user_id in (8003, 8004)
+        ]
+        self.client.post(reverse('ticket_detail', args=[closed[0].ticket_id]), {'status': 'open'})
+        self.client.post(reverse('bulk_action'), {
+            'ticket_ids': [closed[1].ticket_id], 'action': 'change_status', 'new_status': 'waiting',
+        })
+        later = Ticket.objects.create(user_id=8005, user_name='Позже', priority='critical', status='open',
+                                      vk_group=self.vk_group, waiting_since=timezone.now())
+        self.assertEqual(
+            [ticket.pk for ticket in work_queue.queue_tickets()][:5],
+            [self.critical_old.pk, self.critical_new.pk, closed[0].pk, closed[1].pk, later.pk]
+        )
+
+        # Уход из очереди снимает время ожидания
+        self.client.post(reverse('ticket_detail', args=[closed[0].ticket_id]), {'status': 'answered'})
+        closed[0].refresh_from_db()
+        self.assertIsNone(closed[0].waiting_since)
+
+
+@override_settings(SERVICEDESK_MAINTENANCE={
+    'AUTO_CLOSE_AFTER_DAYS': {'answered': 7},
+    'MESSAGE_RETENTION_DAYS': 30,
+    'ATTACHMENT_RETENTION_DAYS': 10,
+    'BATCH_PAUSE': 0,
+})
+class MaintenanceTests(SupportAppTests):
+    """Тесты автозакрытия и политики хранения"""
+
+    def setUp(self):
+        super().setUp()
+        self.long_ago = timezone.now() - timedelta(days=60)
+        self.idle = []
+        for num in range(5):
+            ticket = Ticket.objects.create(
+                user_id=9100 + num, user_name=f'Молчун {num}', status='answered', vk_group=self.vk_group
+            )
+            self.idle.append(ticket)
+        Ticket.objects.filter(pk__in=[t.pk for t in self.idle]).update(updated_at=self.long_ago)
+
+    def test_idle_tickets_closed_in_batches(self):
+        """Простаивающие отвеченные обращения закрываются, свежие не трогаются"""
+        call_command('maintain_tickets', batch_size=2, stdout=StringIO())
+
+        self.assertEqual(Ticket.objects.filter(pk__in=[t.pk for t in self.idle], status='closed').count(), 5)
+        self.assertFalse(Ticket.objects.filter(pk__in=[t.pk for t in self.idle], closed_at__isnull=True).exists())
+        # Закрытые поднимаются в списке, отсортированном по времени изменения
+        self.assertFalse(Ticket.objects.filter(pk__in=[t.pk for t in self.idle], updated_at=self.long_ago).exists())
+        self.ticket2.refresh_from_db()
+        self.assertEqual(self.ticket2.status, 'answered')
+        self.assertEqual(analytics.report(StatsRollup.ALL, self.long_ago, timezone.now() + timedelta(hours=1))[0]['resolved'], 5)
+
+    def test_resume_from_checkpoint(self):
+        """Прерванный запуск продолжается с сохраненной позиции"""
+        call_command('maintain_tickets', batch_size=2, max_batches=1, stdout=StringIO())
+        self.assertEqual(Ticket.objects.filter(status='closed', pk__in=[t.pk for t in self.idle]).count(), 2)
+        position = JobCheckpoint.objects.get(name='maintenance').position
+        self.assertEqual(position['auto_close:answered'], self.idle[1].pk)
+
+        call_command('maintain_tickets', batch_size=2, stdout=StringIO())
+        self.assertEqual(Ticket.objects.filter(status='closed', pk__in=[t.pk for t in self.idle]).count(), 5)
+
+    def test_retention_policy(self):
+        """Старые сообщения закрытых обращений удаляются, старые вложения очищаются"""
+        old_closed = Message.objects.create(ticket=self.ticket3, text='Старое')
+        old_open = Message.objects.create(
+            ticket=self.ticket1, text='Старое с вложением', attachments=[{'type': 'doc', 'doc': {'title': 'a'}}]
+        )
+        Message.objects.filter(pk__in=[old_closed.pk, old_open.pk]).update(created_at=self.long_ago)
+
+        maintenance.run_maintenance(batch_size=1)
+
+        self.assertFalse(Message.objects.filter(pk=old_closed.pk).exists())
+        old_open.refresh_from_db()
+        self.assertEqual(old_open.attachments, [])
+
+
+class ExportTests(SupportAppTests):
+    """Тесты потоковой выгрузки"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='admin', password='testpass123')
+
+    def test_csv_export_streams_filtered_tickets(self):
+        """CSV содержит строку на каждое сообщение и учитывает фильтры списка"""
+        response = self.client.get(reverse('export_tickets'), {'format': 'csv', 'status': 'open'})
+
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(StringIO(b''.join(response.streaming_content).decode('utf-8-sig'))))
+        self.assertEqual(rows[0][0], 'ticket_id')
+        self.assertEqual({row[0] for row in rows[1:]}, {self.ticket1.ticket_id})
+        self.assertEqual(len(rows), 3)
+
+    def test_csv_export_escapes_formulas(self):
+        """Текст пользователя, похожий на формулу, в CSV экранируется, в JSONL остается как есть"""
+        Ticket.objects.filter(pk=self.ticket1.pk).update(user_name='=HYPERLINK("http://evil")', subject='@SUM(A1)')
+        Message.objects.filter(ticket=self.ticket1).update(text='+cmd|calc')
+
+        response = self.client.get(reverse('export_tickets'), {'format': 'csv', 'status': 'open'})
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode('utf-8-sig'))))
+        self.assertEqual(rows[0]['user_name'], '\'=HYPERLINK("http://evil")')
+        self.assertEqual(rows[0]['subject'], "'@SUM(A1)")
+        self.assertEqual({row['message_text'] for row in rows}, {"'+cmd|calc"})
+
+        response = self.client.get(reverse('export_tickets'), {'format': 'jsonl', 'status': 'open'})
+        line = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(line['user_name'], '=HYPERLINK("http://evil")')
+        self.assertEqual(line['messages'][0]['text'], '+cmd|calc')
+
+    def test_jsonl_export(self):
+        """JSONL: обращение с массивом сообщений на строку, обращения без сообщений тоже выгружаются"""
+        response = self.client.get(reverse('export_tickets'), {'format': 'jsonl'})
+
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        by_id = {line['ticket_id']: line for line in lines}
+        self.assertEqual(len(by_id[self.ticket1.ticket_id]['messages']), 2)
+        self.assertEqual(by_id[self.ticket3.ticket_id]['messages'], [])
+
+    def test_export_queries_per_chunk(self):
+        """Сообщения подгружаются одним запросом на пачку обращений"""
+        tickets = filter_tickets(Ticket.objects.all(), {})
+        with CaptureQueriesContext(connection) as queries:
+            list(export_tickets_stream(tickets, 'jsonl', chunk_size=1))
+        # По два запроса (обращения и сообщения) на каждую из трех пачек
+        self.assertLessEqual(len(queries), 7)
+
+    def test_export_command(self):
+        """Команда выгрузки пишет в stdout"""
+        out = StringIO()
+        with patch('sys.stdout', out):
+            call_command('export_tickets', format='jsonl', q='оплате')
+        self.assertEqual(len(out.getvalue().splitlines()), 1)
+
+
+class FakeVKClient:
+    """Заглушка VK API с диалогами сообщества для тестов импорта"""
+
+    def __init__(self, histories, group_id):
+        self.histories = histories
+        self.group_id = group_id
+        self.calls = []
+
+    def call(self, method, **params):
+        self.calls.append(method)
+        if method == 'messages.getConversations':
+            # Диалоги идут от последнего сообщения к более старым
+            order = sorted(self.histories, key=lambda peer: self.histories[peer][-1]['date'], reverse=True)
+            peers = order[params['offset']:params['offset'] + params['count']]
+            return {'count': len(self.histories), 'items': [
+                {'conversation': {'peer': {'id': peer, 'type': 'user'}}, 'last_message': self.histories[peer][-1]}
+                for peer in peers
+            ]}
+        if method == 'messages.getHistory':
+            items = self.histories[params['peer_id']]
+            return {'count': len(items), 'items': items[params['offset']:params['offset'] + params['count']]}
+        if method == 'users.get':
+            return [{'id': int(user_id), 'first_name': 'Имя', 'last_name': user_id}
+                    for user_id in params['user_ids'].split(',')]
+        raise AssertionError(f'Unexpected method {method}')
+
+
+class HistoryImportTests(SupportAppTests):
+    """Тесты импорта истории диалогов"""
+
+    def make_history(self, peer, count, last_from_user=True):
+        base = int((timezone.now() - timedelta(days=30)).timestamp())
+        items = []
+        for i in range(count):
+            # Сообщения чередуются, последнее - от пользователя или от сообщества
+            from_user = (count - 1 - i) % 2 == (0 if last_from_user else 1)
+            items.append({
+                'id': peer * 1000 + i,
+                'from_id': peer if from_user else -self.vk_group.group_id,
+                'date': base + i * 60,
+                'text': f'Сообщение {i}',
+            })
+        return items
+
+    def setUp(self):
+        super().setUp()
+        self.histories = {
+            2001: self.make_history(2001, 450),
+            2002: self.make_history(2002, 3, last_from_user=False),
+            # У пользователя 1001 уже есть обращение ticket1
+            1001: self.make_history(1001, 2),
+        }
+        self.fake = FakeVKClient(self.histories, self.vk_group.group_id)
+
+    def test_import_creates_tickets_and_messages(self):
+        """Обращения создаются пачкой, история идет в существующее обращение, даты сохраняются"""
+        stats = HistoryImporter(self.vk_group, client=self.fake, chunk_size=100).run()
+
+        self.assertEqual(stats['tickets'], 2)
+        self.assertEqual(stats['messages'], 455)
+        ticket = Ticket.objects.get(user_id=2001)
+        self.assertEqual(ticket.status, 'open')
+        self.assertEqual(ticket.messages.count(), 450)
+        self.assertEqual(ticket.created_at, message_time(self.histories[2001][0]))
+        self.assertEqual(Ticket.objects.get(user_id=2002).status, 'closed')
+        self.assertEqual(self.ticket1.messages.count(), 4)
+        # Профили запрашиваются одним вызовом на страницу диалогов
+        self.assertEqual(self.fake.calls.count('users.get'), 1)
+
+    def test_reimport_skips_existing_messages(self):
+        """Повторный импорт не создает дублей"""
+        HistoryImporter(self.vk_group, client=self.fake).run()
+        JobCheckpoint.objects.update(position={})
+
+        stats = HistoryImporter(self.vk_group, client=self.fake).run()
+
+        self.assertEqual(stats['messages'], 0)
+        self.assertEqual(Ticket.objects.filter(user_id=2001).count(), 1)
+
+    def test_resume_and_shards(self):
+        """Импорт продолжается с сохраненной страницы, шарды делят диалоги по peer_id"""
+        with patch('project.servicedesk.importer.CONVERSATIONS_PAGE', 1):
+            HistoryImporter(self.vk_group, client=self.fake, shard_index=1, shard_count=2).run(max_pages=1)
+            self.assertTrue(Ticket.objects.filter(user_id=2001).exists())
+
+            HistoryImporter(self.vk_group, client=self.fake, shard_index=1, shard_count=2).run()
+            self.assertEqual(self.ticket1.messages.count(), 4)
+            # Четный peer_id относится к другому шарду
+            self.assertFalse(Ticket.objects.filter(user_id=2002).exists())
+
+
+    def test_conversation_moving_ahead_is_not_skipped(self):
+        """Диалог, получивший сообщение во время импорта, переезжает в начало списка, но импортируется"""
+        def new_message(peer):
+            self.histories[peer].append({'id': peer * 1000 + 999, 'from_id': peer,
+                                         'date': int(time.time()) + 1, 'text': 'Новое'})
+
+        fake_call = self.fake.call
+
+        def call(method, **params):
+            # Пока читается список, диалог с конца получает сообщение
+            if method == 'messages.getConversations' and params['offset'] == 1 and 1001 not in moved:
+                moved.append(1001)
+                new_message(1001)
+            return fake_call(method, **params)
+
+        moved = []
+
+        self.fake.call = call
+        with patch('project.servicedesk.importer.CONVERSATIONS_PAGE', 1):
+            HistoryImporter(self.vk_group, client=self.fake).run(max_pages=1)
+            self.assertEqual(sorted(JobCheckpoint.objects.get().position['peers']), [1001, 2001, 2002])
+            # Между запусками в начало уходит еще не импортированный диалог
+            new_message(2002)
+            HistoryImporter(self.vk_group, client=self.fake).run()
+        self.assertEqual(Ticket.objects.get(user_id=2002).messages.count(), 4)
+        self.assertEqual(self.ticket1.messages.count(), 5)
+
+
+class BulkReplyTests(SupportAppTests):
+    """Тесты массового ответа"""
+
+    def fake_request(self, method, params):
+        """execute из вызовов messages.send с peer_ids: получатель 3007 запретил сообщения"""
+        self.assertEqual(method, 'execute')
+        return {'response': [self.fake_send(*call) for call in parse_execute_code(params['code'])]}
+
+    def fake_send(self, method, params):
+        self.assertEqual(method, 'messages.send')
+        peer_ids = [int(peer_id) for peer_id in params['peer_ids'].split(',')]
+        self.assertLessEqual(len(peer_ids), 100)
+        return [
+            {'peer_id': peer_id, 'error': {'code': 901, 'description': 'Can\'t send messages'}}
+            if peer_id == 3007 else {'peer_id': peer_id, 'message_id': peer_id * 10}
+            for peer_id in peer_ids
+        ]
+
+    def test_bulk_reply_sends_in_batches(self):
+        """Ответ на 150 обращений - один execute из двух messages.send, сообщения и статусы сохраняются пачкой"""
+        Ticket.objects.bulk_create([
+            Ticket(ticket_id=f'BULK-{i}', user_id=3000 + i, user_name=f'Пользователь {i}',
+                   subject='Сбой', status='open', vk_group=self.vk_group)
+            for i in range(150)
+        ])
+        call_command('rebuild_operator_load', stdout=StringIO())
+        self.client.login(username='admin', password='testpass123')
+
+        with patch('project.servicedesk.vk_api.VKClient.request', side_effect=self.fake_request) as mock_request:
+            response = self.client.post(reverse('bulk_action'), {
+                'ticket_ids': [f'BULK-{i}' for i in range(150)],
+                'action': 'reply',
+                'reply_text': 'Сбой устранен',
+            })
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(mock_request.call_count, 1)
+        answered = Ticket.objects.filter(ticket_id__startswith='BULK-', status='answered')
+        self.assertEqual(answered.count(), 149)
+        self.assertFalse(answered.filter(admin__isnull=True).exists())
+        self.assertEqual(Ticket.objects.get(user_id=3007).status, 'open')
+
+        reply = Message.objects.get(ticket__user_id=3001)
+        self.assertEqual(reply.message_id, 30010)
+        self.assertEqual(reply.admin_author, self.admin_user)
+        self.assertTrue(reply.is_admin)
+
+        start = timezone.now() - timedelta(days=1)
+        totals = analytics.report(StatsRollup.OPERATOR, start, timezone.now() + timedelta(days=1),
+                                  self.admin_user.pk)[0]
+        self.assertEqual(totals['messages_sent'], 149)
+        self.assertEqual(totals['first_responses'], 149)
+        # Отвеченные обращения перешли на оператора и учтены в его нагрузке
+        self.assertEqual(OperatorLoad.objects.get(user=self.admin_user).open_tickets, 150)
+
+
+class FragmentCacheTests(SupportAppTests):
+    """Тесты кэширования фрагментов шаблонов"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='admin', password='testpass123')
+
+    def list_page(self):
+        return self.client.get(reverse('ticket_list')).content.decode()
+
+    def test_ticket_row_cached_until_save(self):
+        """Строка обращения берется из кэша, пока обращение не сохранят"""
+        self.list_page()
+        Ticket.objects.filter(pk=self.ticket1.pk).update(user_name='Без сигнала')
+        self.assertNotIn('Без сигнала', self.list_page())
+
+        self.ticket1.user_name = 'Новое имя'
+        self.ticket1.save()
+        self.assertIn('Новое имя', self.list_page())
+
+    def test_bulk_update_touches_rows(self):
+        """Массовая смена статуса через UPDATE сбрасывает строки явно"""
+        self.list_page()
+        self.client.post(reverse('bulk_action'), {
+            'ticket_ids': [self.ticket1.ticket_id],
+            'action': 'change_status',
+            'new_status': 'waiting',
+        })
+
+        page = self.list_page()
+        row = page[page.index(self.ticket1.ticket_id):]
+        self.assertIn('Ожидание', row[:row.index('</tr>')])
+
+    def test_new_message_updates_unread_count_and_bubble(self):
+        """Новое сообщение сбрасывает строку, сохранение сообщения - его пузырь"""
+        self.list_page()
+        Message.objects.create(ticket=self.ticket2, text='Еще вопрос', is_admin=False)
+        unread = Message.objects.filter(ticket=self.ticket2, is_admin=False, is_read=False).count()
+        self.assertIn(f'<span class="badge bg-danger">{unread}</span>', self.list_page())
+
+        url = reverse('ticket_detail', args=[self.ticket2.ticket_id])
+        message = self.ticket2.messages.first()
+        self.client.get(url)
+        message.text = 'Исправленный текст'
+        message.save()
+        self.assertIn('Исправленный текст', self.client.get(url).content.decode())
+
+    def test_tags_cached(self):
+        """Справочник тегов читается из кэша и сбрасывается при изменении тега"""
+        self.list_page()
+        with CaptureQueriesContext(connection) as queries:
+            self.list_page()
+        self.assertFalse([q for q in queries.captured_queries if 'servicedesk_tag"' in q['sql'].split('FROM')[-1]])
+
+        Tag.objects.create(name='Новый тег')
+        self.assertIn('Новый тег', self.list_page())
+
+
+class TagFilterTests(SupportAppTests):
+    """Тесты фильтра по тегам и счетчиков по тегам"""
+
+    def setUp(self):
+        super().setUp()
+        self.ticket2.tags.add(self.tag_bug)
+
+    def filtered(self, tags, mode=''):
+        filters = {'tag': [tag.pk for tag in tags], 'tag_mode': mode}
+        return set(filter_tickets(Ticket.objects.all(), filters).values_list('pk', flat=True))
+
+    def test_any_and_all_modes(self):
+        """any - хотя бы один из тегов, all - все теги сразу"""
+        self.assertEqual(self.filtered([self.tag_urgent, self.tag_bug]), {self.ticket1.pk, self.ticket2.pk})
+        self.assertEqual(self.filtered([self.tag_urgent, self.tag_bug], 'all'), {self.ticket1.pk})
+        self.assertEqual(self.filtered([self.tag_bug, self.tag_feature], 'all'), set())
+
+    def test_facets_follow_filters_in_one_query(self):
+        """Счетчики по тегам учитывают фильтры, считаются одним запросом и кэшируются"""
+        filters = get_ticket_filters(QueryDict('status=open'))
+        with self.assertNumQueries(1):
+            counts = tag_facets(filters)
+        self.assertEqual(counts, {self.tag_urgent.pk: 1, self.tag_bug.pk: 1})
+
+        with self.assertNumQueries(0):
+            self.assertEqual(tag_facets(filters), counts)
+        self.assertEqual(tag_facets(get_ticket_filters(QueryDict('')))[self.tag_bug.pk], 2)
+
+    def test_list_page_and_api(self):
+        """Страница списка и API фильтруют по нескольким тегам"""
+        self.client.login(username='admin', password='testpass123')
+        query = f'tag={self.tag_urgent.pk}&tag={self.tag_bug.pk}&tag_mode=all'
+
+        response = self.client.get(reverse('ticket_list') + '?' + query)
+        self.assertEqual([ticket.pk for ticket in response.context['page_obj']], [self.ticket1.pk])
+
+        data = self.client.get(reverse('ticket_list_api') + '?' + query).json()
+        self.assertEqual([row['ticket_id'] for row in data['results']], [self.ticket1.ticket_id])
+        counts = {row['name']: row['count'] for row in data['tags']}
+        self.assertEqual(counts, {'Срочно': 1, 'Баг': 1, 'Функционал': 0})
+
+
+class AdminTests(SupportAppTests):
+    """Тесты админки больших таблиц"""
+
+    def test_changelists_use_constant_queries(self):
+        """Число запросов списка не зависит от числа строк: связи подгружаются JOIN"""
+        self.client.login(username='admin', password='testpass123')
+        url = reverse('admin:servicedesk_message_changelist')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url)
+        Message.objects.bulk_create([
+            Message(ticket=self.ticket2, text=f'Сообщение {num}', is_admin=True, admin_author=self.admin_user)
+            for num in range(20)
+        ])
+        with self.assertNumQueries(len(before)):
+            response = self.client.get(url)
+        self.assertContains(response, 'Сообщение 19')
+
+        for name in ('ticket', 'vkgroup'):
+            self.assertEqual(self.client.get(reverse(f'admin:servicedesk_{name}_changelist')).status_code, 200)
+
+    def test_paginator_estimates_only_large_postgres_tables(self):
+        """Оценка по статистике берется для больших выборок PostgreSQL, иначе точный счет"""
+        queryset = Message.objects.all()
+        self.assertEqual(EstimatedCountPaginator(queryset, 50).count, queryset.count())
+        with patch.object(connection, 'vendor', 'postgresql'), \
+                patch('project.servicedesk.admin.estimated_count', return_value=2_000_000):
+            self.assertEqual(EstimatedCountPaginator(queryset, 50).count, 2_000_000)
+
+
+class ProfilingTests(SupportAppTests):
+    """Тесты профилирования по требованию"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.options = {'DIRECTORY': directory.name, 'MAX_PROFILES': 2}
+
+    def test_staff_header_profiles_request(self):
+        """Заголовок сотрудника включает профиль с SQL; буфер хранит последние MAX_PROFILES снимков"""
+        with override_settings(SERVICEDESK_PROFILING=self.options):
+            self.client.login(username='user', password='testpass123')
+            self.client.get(reverse('ticket_list'), HTTP_X_SERVICEDESK_PROFILE='1')
+            self.assertEqual(profiling.load_profiles(), [])
+
+            self.client.login(username='admin', password='testpass123')
+            for _ in range(3):
+                self.client.get(reverse('ticket_detail', args=[self.ticket1.ticket_id]),
+                                HTTP_X_SERVICEDESK_PROFILE='1')
+            profiles = profiling.load_profiles()
+            self.assertEqual(len(profiles), 2)
+            self.assertEqual(profiles[0]['name'], reverse('ticket_detail', args=[self.ticket1.ticket_id]))
+            self.assertEqual(profiles[0]['status'], 200)
+            self.assertGreater(profiles[0]['query_count'], 0)
+            self.assertTrue(profiles[0]['functions'])
+
+            response = self.client.get(reverse('profiles'))
+        self.assertContains(response, escape(profiles[0]['queries'][0]['sql'][:40]))
+
+    async def test_async_request_profiled_without_functions(self):
+        """Под ASGI запрос сотрудника с заголовком тоже профилируется: SQL и время без топа функций"""
+        client = AsyncClient()
+        await client.aforce_login(self.admin_user)
+        url = reverse('ticket_detail', args=[self.ticket1.ticket_id])
+        with override_settings(SERVICEDESK_PROFILING=self.options):
+            response = await client.get(url, headers={'X-Servicedesk-Profile': '1'})
+            profile, = profiling.load_profiles()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((profile['name'], profile['status']), (url, 200))
+        self.assertGreater(profile['query_count'], 0)
+        self.assertEqual(profile['functions'], [])
+
+    def test_sampled_event_processing(self):
+        """Выборка профилирует и обработку событий очереди"""
+        event_queue.enqueue(vk_event(1, 500, 1))
+        consumer = event_queue.PartitionConsumer(name='worker-1', handlers={'message_new': lambda data: None})
+        with override_settings(SERVICEDESK_PROFILING={**self.options, 'SAMPLE_RATE': 1}):
+            consumer.run_once()
+            profile, = profiling.load_profiles()
+        self.assertEqual((profile['kind'], profile['name'], profile['events']), ('event', 'message_new', 1))
+
+
+class ServerTests(TestCase):
+    """Тесты боевого сервера и проверки живости"""
+
+    def test_health_reports_database_state(self):
+        """health отвечает 200, пока база доступна, и 503, когда нет"""
+        self.assertEqual(Client().get(reverse('health')).json(), {'status': 'ok'})
+        with patch.object(connection, 'cursor', side_effect=DatabaseError('down')), \
+                self.assertLogs('project.servicedesk.views', 'ERROR'):
+            self.assertEqual(Client().get(reverse('health')).status_code, 503)
+
+    def test_gunicorn_options_from_settings(self):
+        """Воркеры форкаются из предзагруженного приложения; класс воркера зависит от WSGI/ASGI"""
+        options = server.get_server_settings()
+        config = server.gunicorn_options({**options, 'THREADS': 1})
+        self.assertTrue(config['preload_app'])
+        self.assertEqual(config['worker_class'], 'sync')
+        self.assertEqual(config['max_requests'], options['MAX_REQUESTS'])
+        self.assertEqual(server.gunicorn_options({**options, 'THREADS': 4})['worker_class'], 'gthread')
+        self.assertEqual(server.gunicorn_options({**options, 'ASGI': True})['worker_class'],
+                         server.ASGI_WORKER_CLASS)
+
+    def test_serve_warns_about_process_local_cache(self):
+        """serve с несколькими воркерами предупреждает, что кэш в памяти процесса не общий"""
+        stderr = StringIO()
+        call_command('serve', '--check', '--workers', '4', stdout=StringIO(), stderr=stderr)
+        self.assertIn('REDIS_URL', stderr.getvalue())
+
+        redis = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                             'LOCATION': 'redis://localhost:6379/0'}}
+        with override_settings(CACHES=redis):
+            self.assertTrue(server.shared_cache())
+
+
+    def test_admin_static_served_after_collectstatic(self):
+        """Собранная статика админки отдается воркерами сервера, без runserver"""
+        with tempfile.TemporaryDirectory() as root, override_settings(STATIC_ROOT=root):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            response = Client().get('/static/admin/css/base.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/css; charset="utf-8"')
+
+
+class TypeaheadTests(SupportAppTests):
+    """Тесты подсказок поиска"""
+
+    def test_typeahead_matches_name_and_number_and_caches(self):
+        """Подсказки ищут по началу имени и номера; повторный запрос берется из кэша"""
+        self.client.login(username='admin', password='testpass123')
+        url = reverse('ticket_typeahead_api')
+        data = self.client.get(url, {'q': 'Ива'}).json()
+        self.assertEqual([row['ticket_id'] for row in data['results']], [self.ticket1.ticket_id])
+
+        numbers = [row['ticket_id'] for row in ticket_typeahead('20231201-000')]
+        self.assertEqual(sorted(numbers), sorted(Ticket.objects.values_list('ticket_id', flat=True)))
+        with self.assertNumQueries(0):
+            ticket_typeahead('20231201-000')
+        self.assertEqual(ticket_typeahead('2'), [])
+
+    def test_typeahead_needs_three_characters_on_postgresql(self):
+        """В PostgreSQL подсказки ищутся с трех символов: для более коротких подстрок pg_trgm не работает"""
+        self.assertEqual([row['ticket_id'] for row in ticket_typeahead('Ив')], [self.ticket1.ticket_id])
+        cache.clear()
+        with patch.object(connection, 'vendor', 'postgresql'):
+            self.assertEqual(ticket_typeahead('Ив'), [])
+            self.assertEqual([row['ticket_id'] for row in ticket_typeahead('Ива')], [self.ticket1.ticket_id])
+
+    @skipUnless(connection.vendor == 'postgresql', 'план запроса проверяется только в PostgreSQL')
+    def test_typeahead_plan_avoids_backward_pk_scan(self):
+        """Подсказки не идут обратным проходом по первичному ключу"""
+        plan = typeahead_tickets('Ива', connection.vendor).explain()
+        self.assertNotIn('Backward', plan)
+        self.assertNotIn('pkey', plan)
+
+
+class UserTimelineTests(SupportAppTests):
+    """Тесты истории пользователя ВК"""
+
+    @patch('project.servicedesk.event_handlers.get_vk_user_info')
+    def test_ingestion_and_closing_update_summary(self, mock_user_info):
+        """Прием сообщений ведет сводку, закрытие снимает открытое обращение"""
+        mock_user_info.return_value = {'name': 'Новый', 'photo': ''}
+        handle_message_new(vk_event(self.vk_group.group_id, 5001, 100))
+        handle_message_new(vk_event(self.vk_group.group_id, 5001, 101))
+
+        ticket = Ticket.objects.get(user_id=5001)
+        summary = VKUserSummary.objects.get(user_id=5001)
+        self.assertEqual((summary.user_name, summary.ticket_count, summary.open_ticket_id),
+                         ('Новый', 1, ticket.ticket_id))
+        self.assertEqual(summary.last_contact_at, Message.objects.get(message_id=101).created_at)
+
+        self.client.login(username='admin', password='testpass123')
+        self.client.post(reverse('bulk_action'), {
+            'ticket_ids': [ticket.ticket_id], 'action': 'change_status', 'new_status': 'closed',
+        })
+        summary.refresh_from_db()
+        self.assertEqual(summary.open_ticket_id, '')
+
+        # Сообщение после закрытия открывает новое обращение
+        handle_message_new(vk_event(self.vk_group.group_id, 5001, 102))
+        summary.refresh_from_db()
+        self.assertEqual(summary.ticket_count, 2)
+        self.assertEqual(summary.open_ticket_id, Ticket.objects.exclude(pk=ticket.pk).get(user_id=5001).ticket_id)
+
+    def test_timeline_pages_by_cursor(self):
+        """История листается курсором; страница - сводка, обращения и сообщения тремя запросами"""
+        for number in range(4, 7):
+            Ticket.objects.create(
+                ticket_id=f'20231201-000{number}', user_id=1001, user_name='Иван Иванов', subject='Еще вопрос',
+                vk_group=self.vk_group, created_at=timezone.now() - timedelta(days=number),
+            )
+        call_command('rebuild_user_summaries', stdout=StringIO())
+        self.assertEqual(VKUserSummary.objects.get(user_id=1001).ticket_count, 4)
+
+        older = Ticket.objects.get(ticket_id='20231201-0004')
+        for number in range(1, 4):
+            Message.objects.create(ticket=older, message_id=100 + number, text=f'Сообщение {number}',
+                                   created_at=older.created_at + timedelta(minutes=number))
+
+        # Лимит сообщений - на каждое обращение, а не на всю страницу
+        with self.assertNumQueries(3), patch.object(timeline, 'RECENT_MESSAGES', 2):
+            page = timeline.user_timeline(1001, limit=3)
+        self.assertEqual([ticket.ticket_id for ticket in page['tickets']],
+                         ['20231201-0001', '20231201-0004', '20231201-0005'])
+        self.assertEqual(len(page['tickets'][0].recent_messages), 2)
+        self.assertEqual([message.message_id for message in page['tickets'][1].recent_messages], [102, 103])
+        self.assertEqual(page['tickets'][2].recent_messages, [])
+
+        self.client.login(username='admin', password='testpass123')
+        data = self.client.get(
+            reverse('user_timeline_api', args=[1001]), {'before': page['next'], 'limit': 3}
+        ).json()
+        self.assertEqual([ticket['ticket_id'] for ticket in data['results']], ['20231201-0006'])
+        self.assertIsNone(data['next'])
+        self.assertEqual(data['summary']['open_ticket_id'], '20231201-0001')
+
+        response = self.client.get(reverse('user_timeline', args=[1001]))
+        self.assertContains(response, '20231201-0005')
+        self.assertEqual(
+            self.client.get(reverse('user_timeline_api', args=[1001]), {'before': 'мусор'}).status_code, 400
+        )
+
+
+@override_settings(SERVICEDESK_REPLICAS={'ALIASES': ['replica'], 'STICKY_SECONDS': 5, 'MAX_LAG_SECONDS': 10})
+class ReplicaRoutingTests(TestCase):
+    """Тесты маршрутизации чтений на реплики"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        routers._lag_cache.clear()
+        lag = patch('project.servicedesk.routers.measure_lag', return_value=0)
+        lag.start()
+        self.addCleanup(lag.stop)
+
+    def run_request(self, request, write=False):
+        """Прогоняет запрос через middleware, возвращает (база чтения до и после записи, ответ)"""
+        seen = []
+
+        def view(request):
+            seen.append(Ticket.objects.all().db)
+            if write:
+                router.db_for_write(Ticket)
+                seen.append(Ticket.objects.all().db)
+            return HttpResponse('ok')
+
+        response = ReplicaRoutingMiddleware(view)(request)
+        return seen, response
+
+    def test_reads_go_to_replica_outside_requests_to_primary(self):
+        """Запрос на чтение читает с реплики, код вне запроса - из основной базы"""
+        seen, response = self.run_request(self.factory.get('/'))
+        self.assertEqual(seen, ['replica'])
+        self.assertNotIn(PRIMARY_COOKIE, response.cookies)
+        self.assertEqual(Ticket.objects.all().db, 'default')
+
+    def test_write_sticks_user_to_primary(self):
+        """После записи запрос и следующие запросы в окне читают из основной базы"""
+        seen, response = self.run_request(self.factory.get('/'), write=True)
+        self.assertEqual(seen, ['replica', 'default'])
+        cookie = response.cookies[PRIMARY_COOKIE]
+
+        request = self.factory.get('/')
+        request.COOKIES[PRIMARY_COOKIE] = cookie.value
+        self.assertEqual(self.run_request(request)[0], ['default'])
+
+        seen, _ = self.run_request(self.factory.post('/'))
+        self.assertEqual(seen, ['default'])
+
+    def test_lagging_replica_skipped(self):
+        """Реплика с отставанием больше MAX_LAG_SECONDS не используется"""
+        with patch('project.servicedesk.routers.measure_lag', return_value=60):
+            self.assertEqual(self.run_request(self.factory.get('/'))[0], ['default'])
+
+
+@override_settings(SERVICEDESK_SHARDS=['big_group'])
+class ShardingTests(TestCase):
+    """Тесты маршрутизации обращений по шардам и слияния выборок"""
+
+    def setUp(self):
+        self.group = VKGroup.objects.create(group_id=1, name='Группа', access_token='token')
+
+    def test_router_follows_shard_context(self):
+        """Модели обращений идут в текущий шард, общие таблицы - в default"""
+        self.assertEqual(Ticket.objects.all().db, 'default')
+        with sharding.use_shard('big_group'):
+            self.assertEqual(Ticket.objects.all().db, 'big_group')
+            self.assertEqual(Message.objects.all().db, 'big_group')
+            self.assertEqual(router.db_for_write(Ticket), 'big_group')
+            self.assertEqual(VKGroup.objects.all().db, 'default')
+            self.assertEqual(Tag.objects.all().db, 'default')
+        self.assertFalse(router.allow_migrate('big_group', 'servicedesk', model_name='vkgroup'))
+        self.assertTrue(router.allow_migrate('big_group', 'servicedesk', model_name='ticket'))
+
+    def test_loaded_instance_stays_in_its_shard(self):
+        """Объект, загруженный из шарда, пишется туда же и вне контекста шарда"""
+        ticket = Ticket(ticket_id='20240101-0001', user_id=1, user_name='User', vk_group=self.group)
+        ticket._state.db = 'big_group'
+        self.assertEqual(router.db_for_write(Ticket, instance=ticket), 'big_group')
+        self.assertEqual(sharding.instance_shard(ticket), 'big_group')
+        self.assertNotEqual(
+            fragments.version_key(ticket.pk, 'big_group'), fragments.version_key(ticket.pk, 'default')
+        )
+
+    def test_sharded_list_merges_and_pages(self):
+        """ShardedList сливает отсортированные выборки и считает их вместе"""
+        now = timezone.now()
+        for index in range(6):
+            Ticket.objects.create(
+                ticket_id=f'20240101-{index:04d}', user_id=index, user_name='User', vk_group=self.group,
+                status='open' if index % 2 else 'closed', waiting_since=now - timedelta(minutes=index),
+            )
+        tickets = Ticket.objects.order_by('-waiting_since')
+        merged = sharding.ShardedList(
+            [tickets.filter(status='open'), tickets.filter(status='closed')],
+            key=lambda ticket: ticket.waiting_since, reverse=True,
+        )
+        self.assertEqual(merged.count(), 6)
+        self.assertEqual([ticket.user_id for ticket in merged[1:4]], [1, 2, 3])
+        self.assertEqual(merged[5].user_id, 5)
+
+        # Дальние строки не читаются из шардов
+        with patch('project.servicedesk.sharding.MAX_MERGED_ROWS', 4):
+            self.assertEqual(merged.count(), 4)
+            self.assertEqual(len(merged[2:10]), 2)
+            with self.assertRaises(IndexError):
+                merged[5]
+
+    def test_api_offset_capped_with_shards(self):
+        """API списка не листает слияние шардов дальше MAX_MERGED_ROWS"""
+        User.objects.create_user(username='staff', password='testpass123', is_staff=True)
+        self.client.login(username='staff', password='testpass123')
+        response = self.client.get(reverse('ticket_list_api'), {'offset': sharding.MAX_MERGED_ROWS})
+        self.assertEqual(response.status_code, 400)
+
+
+@skipUnless('big_group' in settings.DATABASES, 'нужна база шарда big_group в DATABASES')
+@override_settings(SERVICEDESK_SHARDS=['big_group'])
+class ShardMoveTests(TestCase):
+    """Тесты переноса обращений группы в другой шард"""
+    # Раннер создает тестовые базы всех классов, в том числе пропущенных
+    databases = {'default', 'big_group'} & set(settings.DATABASES)
+
+    def setUp(self):
+        self.group = VKGroup.objects.create(group_id=321, name='Переезд', access_token='token')
+        self.tag = Tag.objects.create(name='Переезд')
+        self.ticket = Ticket.objects.create(user_id=4001, user_name='Пользователь', vk_group=self.group)
+        self.ticket.tags.add(self.tag)
+        Message.objects.create(ticket=self.ticket, message_id=1, text='Первое')
+        Message.objects.create(ticket=self.ticket, text='Ответ', is_admin=True)
+
+    @patch('project.servicedesk.event_handlers.get_vk_user_info', return_value={'name': 'Пользователь'})
+    def test_resume_copies_messages_written_after_first_copy(self, mock_user_info):
+        """Сообщение, дописанное в исходный шард после копирования, переносится при продолжении"""
+        # Прерванный запуск: копия в новом шарде зафиксирована, исходный шард не очищен
+        move = GroupShardMove(self.group, 'big_group')
+        move.source = 'default'
+        VKGroup.objects.filter(pk=self.group.pk).update(shard='big_group', shard_moving_from='default')
+        pks = move.copy_tickets(list(Ticket.objects.using('default').filter(vk_group=self.group)))
+        move.copy_messages(pks, {})
+
+        # Активное обращение еще в исходном шарде - новое сообщение пишется туда
+        self.group.refresh_from_db()
+        handle_message_new(vk_event(self.group.group_id, 4001, 2, 'После копирования'))
+        self.assertEqual(Message.objects.using('default').filter(ticket__vk_group=self.group).count(), 3)
+
+        call_command('move_group_shard', self.group.group_id, 'big_group', stdout=StringIO())
+
+        self.assertFalse(Ticket.objects.using('default').filter(vk_group=self.group).exists())
+        moved = Ticket.objects.using('big_group').get(ticket_id=self.ticket.ticket_id)
+        self.assertEqual(
+            sorted(moved.messages.values_list('text', flat=True)), ['Ответ', 'Первое', 'После копирования']
+        )
+        links = TicketTag.objects.using('big_group').filter(ticket=moved)
+        self.assertEqual(list(links.values_list('tag_id', flat=True)), [self.tag.pk])
+
+
+@override_settings(SERVICEDESK_EVENTS={'QUEUE': True, 'PARTITIONS': 4, 'MAX_ATTEMPTS': 2})
+class EventQueueTests(TestCase):
+    """Тесты очереди событий и обработчиков по партициям"""
+
+    def setUp(self):
+        self.handled = []
+        self.failing = set()
+
+        def handler(data):
+            message = data['object']['message']
+            if message['id'] in self.failing:
+                raise RuntimeError('temporary failure')
+            self.handled.append(message['id'])
+
+        self.handlers = {'message_new': handler}
+
+    def consumer(self, name='worker-1'):
+        return event_queue.PartitionConsumer(name=name, handlers=self.handlers)
+
+    def test_callback_enqueues_event(self):
+        """При QUEUE=True callback только сохраняет событие в партицию собеседника"""
+        VKGroup.objects.create(group_id=1, name='Группа', access_token='token')
+        with patch('project.servicedesk.event_handlers.get_vk_user_info') as user_info:
+            response = Client().post(
+                reverse('vk_callback'), json.dumps(vk_event(1, 500, 1)), content_type='application/json'
+            )
+        self.assertEqual(response.content, b'ok')
+        user_info.assert_not_called()
+        event = InboundEvent.objects.get()
+        self.assertEqual(event.partition, event_queue.partition_for(vk_event(1, 500, 2)))
+
+    def test_partition_processed_in_order_and_failures_block_it(self):
+        """События собеседника идут по порядку; упавшее событие задерживает только свою партицию"""
+        for message_id in range(1, 4):
+            event_queue.enqueue(vk_event(1, 500, message_id))
+        other = next(user for user in range(501, 600)
+                     if event_queue.partition_for(vk_event(1, user, 0)) != event_queue.partition_for(vk_event(1, 500, 0)))
+        event_queue.enqueue(vk_event(1, other, 10))
+        self.failing.add(2)
+
+        consumer = self.consumer()
+        with self.assertLogs('project.servicedesk.event_queue', 'ERROR'):
+            consumer.run_once()
+        self.assertEqual(sorted(self.handled), [1, 10])
+        self.assertEqual(InboundEvent.objects.get(payload__object__message__id=2).attempts, 1)
+
+        # Вторая неудача откладывает событие, следующее за ним обрабатывается
+        consumer.retry_at.clear()
+        with self.assertLogs('project.servicedesk.event_queue', 'ERROR'):
+            consumer.run_once()
+        self.assertEqual(sorted(self.handled), [1, 3, 10])
+        self.assertTrue(InboundEvent.objects.get().failed)
+        self.assertEqual(event_queue.partition_lag(), [])
+
+    def test_rapid_messages_coalesced_into_one_write(self):
+        """Подряд пришедшие сообщения собеседника записываются одной пачкой с одним запросом профиля"""
+        VKGroup.objects.create(group_id=1, name='Группа', access_token='token')
+        for message_id in range(1, 4):
+            event_queue.enqueue(vk_event(1, 500, message_id))
+        consumer = event_queue.PartitionConsumer(
+            name='worker-1', options={**event_queue.get_event_settings(), 'COALESCE_WINDOW': 0}
+        )
+        with patch('project.servicedesk.event_handlers.get_vk_user_info',
+                   return_value={'name': 'Иван', 'photo': ''}) as user_info:
+            self.assertEqual(consumer.run_once(), 3)
+        user_info.assert_called_once()
+        ticket = Ticket.objects.get()
+        self.assertEqual(ticket.messages.count(), 3)
+        self.assertEqual(ticket.status, 'open')
+        self.assertFalse(InboundEvent.objects.exists())
+
+    def test_coalesce_window_and_flood_limit(self):
+        """Молодые сообщения ждут окна склейки; сообщения сверх лимита откладываются до конца периода"""
+        cache.clear()
+        batches = []
+        for message_id in range(1, 5):
+            event_queue.enqueue(vk_event(1, 500, message_id))
+        other = next(user for user in range(501, 600)
+                     if event_queue.partition_for(vk_event(1, user, 0)) == event_queue.partition_for(vk_event(1, 500, 0)))
+        options = {**event_queue.get_event_settings(), 'COALESCE_WINDOW': 60, 'FLOOD_LIMIT': 3}
+        consumer = event_queue.PartitionConsumer(
+            name='worker-1', handlers=self.handlers, options=options,
+            batch_handlers={'message_new': lambda events: batches.append(
+                [data['object']['message']['id'] for data in events])},
+        )
+        self.assertEqual(consumer.run_once(), 0)
+        self.assertEqual(InboundEvent.objects.count(), 4)
+
+        options['COALESCE_WINDOW'] = 0
+        consumer.retry_at.clear()
+        with self.assertLogs('project.servicedesk.event_queue', 'WARNING'):
+            consumer.run_once()
+        self.assertEqual(batches, [[1, 2, 3]])
+        self.assertEqual(consumer.stats['flooded'], 1)
+        deferred = InboundEvent.objects.get()
+        self.assertGreater(deferred.available_at, timezone.now())
+
+        # Пока период не кончился, новые сообщения собеседника ждут вместе с отложенным,
+        # а сообщения других собеседников той же партиции обрабатываются. Отложенность
+        # видна и обработчику, к которому партиция переехала, без общего кэша
+        event_queue.enqueue(vk_event(1, 500, 5))
+        event_queue.enqueue(vk_event(1, other, 6))
+        cache.clear()
+        consumer = event_queue.PartitionConsumer(
+            name='worker-2', handlers=self.handlers, options=options, batch_handlers=consumer.batch_handlers,
+        )
+        with self.assertLogs('project.servicedesk.event_queue', 'WARNING'):
+            consumer.run_once()
+        self.assertEqual(self.handled, [6])
+        self.assertEqual(InboundEvent.objects.count(), 2)
+
+        # После периода отложенные сообщения обрабатываются по порядку
+        cache.clear()
+        InboundEvent.objects.update(available_at=timezone.now() - timedelta(seconds=1))
+        consumer.run_once()
+        self.assertEqual(batches, [[1, 2, 3], [4, 5]])
+        self.assertFalse(InboundEvent.objects.exists())
+
+    def test_failed_messages_not_counted_towards_flood_limit(self):
+        """В лимит флуда идут только обработанные сообщения: повтор упавшей пачки не откладывается"""
+        cache.clear()
+        for message_id in range(1, 4):
+            event_queue.enqueue(vk_event(1, 500, message_id))
+        attempts = []
+
+        def batch_handler(events):
+            attempts.append(len(events))
+            if len(attempts) == 1:
+                raise RuntimeError('temporary failure')
+
+        options = {**event_queue.get_event_settings(), 'COALESCE_WINDOW': 0, 'FLOOD_LIMIT': 3}
+        consumer = event_queue.PartitionConsumer(
+            name='worker-1', handlers=self.handlers, options=options, batch_handlers={'message_new': batch_handler},
+        )
+        with self.assertLogs('project.servicedesk.event_queue', 'ERROR'):
+            consumer.run_once()
+        consumer.retry_at.clear()
+        self.assertEqual(consumer.run_once(), 3)
+        self.assertEqual(attempts, [3, 3])
+        self.assertEqual(consumer.stats['flooded'], 0)
+
+    @override_settings(SERVICEDESK_EVENTS={'PARTITIONS': 1, 'LEASE_SECONDS': 0.4})
+    def test_lease_renewed_during_slow_batch(self):
+        """Пачка дольше аренды продлевает ее между прогонами и останавливается, если партицию забрали"""
+        leased = []
+
+        def slow_handler(data):
+            partition = EventPartition.objects.get(partition=0)
+            leased.append(partition.owner == 'worker-1' and partition.lease_until > timezone.now())
+            time.sleep(0.25)
+            if data['object']['message']['id'] == 3:
+                # Пока идет прогон, аренду забирает другой обработчик
+                EventPartition.objects.filter(partition=0).update(owner='worker-2')
+
+        for message_id in range(1, 5):
+            event_queue.enqueue(vk_event(1, 500, message_id))
+        consumer = event_queue.PartitionConsumer(name='worker-1', handlers={'message_new': slow_handler})
+        self.assertEqual(consumer.run_once(), 3)
+        self.assertEqual(leased, [True, True, True])
+        self.assertEqual(list(InboundEvent.objects.values_list('payload__object__message__id', flat=True)), [4])
+
+    def test_partitions_rebalanced_between_consumers(self):
+        """Живые обработчики делят партиции поровну, остановленный отдает свои"""
+        event_queue.ensure_partitions(4)
+        first, second = self.consumer('worker-1'), self.consumer('worker-2')
+        first.heartbeat()
+        first.rebalance()
+        self.assertEqual(first.partitions, [0, 1, 2, 3])
+
+        second.heartbeat()
+        first.rebalance()
+        second.rebalance()
+        self.assertEqual(len(first.partitions), 2)
+        self.assertEqual(sorted(first.partitions + second.partitions), [0, 1, 2, 3])
+
+        first.release()
+        second.rebalance()
+        self.assertEqual(second.partitions, [0, 1, 2, 3])
+        self.assertEqual(EventPartition.objects.filter(owner='worker-2').count(), 4)
+
+
+class CallbackAdmissionTests(TestCase):
+    """Тесты допуска запросов Callback API"""
+
+    def setUp(self):
+        cache.clear()
+        VKGroup.objects.create(group_id=1, name='Группа', access_token='token')
+
+    def post(self, data, **extra):
+        body = data if isinstance(data, str) else json.dumps(data)
+        return Client().post(reverse('vk_callback'), body, content_type='application/json', **extra)
+
+    def test_junk_rejected_before_processing(self):
+        """Большие, чужие и неподписанные запросы отклоняются и учитываются по причинам"""
+        with patch('project.servicedesk.event_handlers.get_vk_user_info') as user_info, \
+                self.assertNumQueries(1):
+            self.assertEqual(self.post('x' * 70000).status_code, 413)
+            self.assertEqual(self.post('{not json').status_code, 400)
+            self.assertEqual(self.post(vk_event(999, 500, 1)).status_code, 403)
+            self.assertEqual(self.post({**vk_event(1, 500, 1), 'secret': 'wrong'}).status_code, 403)
+        user_info.assert_not_called()
+        self.assertEqual(admission.rejection_counts(), {
+            'no_length': 0, 'too_large': 1, 'invalid_json': 1, 'unknown_group': 1, 'invalid_secret': 1, 'shed': 0,
+        })
+
+    def test_body_without_content_length_not_read(self):
+        """Запрос без Content-Length отклоняется, тело неизвестной длины не читается"""
+        request = RequestFactory().post(reverse('vk_callback'), json.dumps(vk_event(1, 500, 1)),
+                                        content_type='application/json')
+        del request.META['CONTENT_LENGTH']
+        with patch.object(request, 'read', side_effect=AssertionError('body read')):
+            response = parse_vk_callback(request)[1]
+        self.assertEqual(response.status_code, 411)
+        self.assertEqual(admission.rejection_counts()['no_length'], 1)
+
+    def test_new_group_accepted_by_other_processes(self):
+        """Новая группа принимается и процессами, которые уже прочитали список групп"""
+        self.assertFalse(admission.known_group(2, 60))
+        stale = dict(admission._groups)
+        with self.captureOnCommitCallbacks(execute=True):
+            VKGroup.objects.create(group_id=2, name='Новая', access_token='token')
+        # Список другого процесса прочитан до изменения
+        admission._groups.update(stale)
+        self.assertTrue(admission.known_group(2, 60))
+
+    @override_settings(
+        SERVICEDESK_EVENTS={'QUEUE': True},
+        SERVICEDESK_ADMISSION={'SHED_QUEUE_DEPTH': 1, 'LOAD_CHECK_INTERVAL': 0},
+    )
+    def test_low_value_events_shed_under_load(self):
+        """При глубокой очереди второстепенные события подтверждаются без обработки, сообщения принимаются"""
+        for message_id in range(1, 3):
+            event_queue.enqueue(vk_event(1, 500, message_id))
+        reply = {**vk_event(1, 500, 3), 'type': 'message_reply'}
+        self.assertEqual(self.post(reply).content, b'ok')
+        self.assertEqual(self.post(vk_event(1, 500, 4)).content, b'ok')
+        self.assertEqual(InboundEvent.objects.count(), 3)
+        self.assertEqual(admission.rejection_counts()['shed'], 1)
+
+
+class FakeLongPollServer:
+    """Заглушка Bots Long Poll: groups.getLongPollServer и a_check с заранее заданными ответами"""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.servers = 0
+        self.checks = []
+
+    def call(self, method, **params):
+        assert method == 'groups.getLongPollServer'
+        self.servers += 1
+        return {'server': 'https://lp.vk.test/check', 'key': f'key{self.servers}', 'ts': '100'}
+
+    def get(self, url, params, timeout):
+        self.checks.append((params['key'], params['ts']))
+        return Mock(json=Mock(return_value=self.answers.pop(0)), raise_for_status=Mock())
+
+
+class LongPollTests(TestCase):
+    """Тесты приема событий через Long Poll"""
+
+    def setUp(self):
+        self.group = VKGroup.objects.create(group_id=7, name='Группа', access_token='token')
+        self.handled = []
+        self.handlers = {'message_new': lambda data: self.handled.append(data['object']['message']['id'])}
+
+    def listener(self, server):
+        return LongPollListener(self.group, client=server, session=server, handlers=self.handlers)
+
+    def test_batches_delivered_and_ts_persisted(self):
+        """События пачки идут в обработчики, ts сохраняется и используется после перезапуска"""
+        server = FakeLongPollServer([
+            {'ts': '102', 'updates': [vk_event(7, 1, 1), vk_event(7, 2, 2)]},
+            {'ts': '103', 'updates': [vk_event(7, 1, 3)]},
+            {'ts': '103', 'updates': []},
+        ])
+        stats = self.listener(server).run(max_polls=2)
+        self.assertEqual(self.handled, [1, 2, 3])
+        self.assertEqual(stats['events'], 3)
+        self.assertEqual(server.checks, [('key1', '100'), ('key1', '102')])
+
+        self.listener(server).run(max_polls=1)
+        self.assertEqual(server.checks[-1], ('key2', '103'))
+
+    def test_failed_codes_reconnect(self):
+        """failed=1 - новый ts, failed=2 - новый ключ со старым ts, failed=3 - новые ключ и ts"""
+        server = FakeLongPollServer([
+            {'failed': 1, 'ts': '150'},
+            {'failed': 2},
+            {'failed': 3},
+            {'ts': '101', 'updates': []},
+        ])
+        with self.assertLogs('project.servicedesk.longpoll', 'WARNING'):
+            self.listener(server).run(max_polls=4)
+        self.assertEqual(server.checks, [('key1', '100'), ('key1', '150'), ('key2', '150'), ('key3', '100')])
+        self.assertEqual(JobCheckpoint.objects.get(name='vk_longpoll:7').position['ts'], '101')
+
+    def test_handler_failure_repolls_from_saved_ts(self):
+        """Упавший обработчик не сдвигает ts: после паузы пачка запрашивается и обрабатывается заново"""
+        failures = [2]
+
+        def handler(data):
+            message_id = data['object']['message']['id']
+            if message_id in failures:
+                failures.remove(message_id)
+                raise RuntimeError('temporary failure')
+            self.handled.append(message_id)
+
+        batch = {'ts': '102', 'updates': [vk_event(7, 1, 1), vk_event(7, 2, 2)]}
+        server = FakeLongPollServer([batch, batch])
+        listener = LongPollListener(self.group, client=server, session=server, handlers={'message_new': handler})
+        with patch('project.servicedesk.longpoll.time.sleep') as sleep, \
+                self.assertLogs('project.servicedesk.longpoll', 'ERROR'):
+            stats = listener.run(max_polls=2)
+        sleep.assert_called_once_with(1)
+        self.assertEqual(server.checks, [('key1', '100'), ('key1', '100')])
+        self.assertEqual(self.handled, [1, 1, 2])
+        self.assertEqual(stats['events'], 2)
+        self.assertEqual(JobCheckpoint.objects.get(name='vk_longpoll:7').position['ts'], '102')
+
+    @override_settings(SERVICEDESK_EVENTS={'MAX_ATTEMPTS': 3})
+    def test_failing_event_set_aside_after_max_attempts(self):
+        """Событие, которое падает всегда, после MAX_ATTEMPTS попыток откладывается, прием идет дальше"""
+        def handler(data):
+            message_id = data['object']['message']['id']
+            if message_id == 2:
+                raise RuntimeError('permanent failure')
+            self.handled.append(message_id)
+
+        batch = {'ts': '102', 'updates': [vk_event(7, 1, 1), vk_event(7, 2, 2)]}
+        server = FakeLongPollServer([batch, batch, batch, {'ts': '103', 'updates': [vk_event(7, 1, 3)]}])
+        listener = LongPollListener(self.group, client=server, session=server, handlers={'message_new': handler})
+        with patch('project.servicedesk.longpoll.time.sleep'), \
+                self.assertLogs('project.servicedesk.longpoll', 'ERROR'):
+            listener.run(max_polls=4)
+        self.assertEqual([ts for _, ts in server.checks], ['100', '100', '100', '102'])
+        self.assertEqual(self.handled, [1, 1, 1, 3])
+        event = InboundEvent.objects.get()
+        self.assertTrue(event.failed)
+        self.assertEqual((event.payload['object']['message']['id'], event.attempts), (2, 3))
+        self.assertEqual(JobCheckpoint.objects.get(name='vk_longpoll:7').position, {'ts': '103', 'attempts': 0})
+
+    @override_settings(SERVICEDESK_EVENTS={'QUEUE': True})
+    def test_batch_enqueued_with_one_insert(self):
+        """При очереди событий пачка сохраняется одной вставкой"""
+        server = FakeLongPollServer([{'ts': '101', 'updates': [vk_event(7, user, user) for user in range(1, 6)]}])
+        listener = self.listener(server)
+        listener.connect()
+        with self.assertNumQueries(2):
+            listener.poll()
+        self.assertEqual(InboundEvent.objects.count(), 5)
+        self.assertEqual(self.handled, [])
@@ -0,0 +1,121 @@
+"""
+История обращений пользователя ВК во всех группах и шардах.
+
+Сводка VKUserSummary - одна строка на пользователя: число обращений,
+последнее сообщение и открытое обращение. Ее обновляют прием сообщений
+(record_contact) и закрытие обращений (tickets_closed), поэтому шапка
+истории читается по уникальному индексу без подсчетов. Обращения
+выбираются по индексу (user_id, created_at) страницами по ключу
+(created_at, ticket_id) без OFFSET, последние сообщения страницы - одним
+запросом по индексу внешнего ключа, не больше RECENT_MESSAGES на обращение.
+"""
+from collections import defaultdict
+from operator import attrgetter
+
+from django.db import connections, router
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils.dateparse import parse_datetime
+
+from . import sharding
+from .models import Message, Ticket, VKUserSummary
+
+TIMELINE_PAGE_SIZE = 20
+# Сколько последних сообщений показывать у каждого обращения страницы
+RECENT_MESSAGES = 5
+
+
+def record_contact(ticket, contact_at, ticket_created=False):
+    """
+    Учитывает сообщение пользователя в обращении ticket (ticket_created - обращение
+    новое) одним INSERT ... ON CONFLICT DO UPDATE по уникальному user_id
+    """
+    using = router.db_for_write(VKUserSummary)
+    connection = connections[using]
+    meta = VKUserSummary._meta
+    quote = connection.ops.quote_name
+    table = quote(meta.db_table)
+    names = ('user_id', 'user_name', 'ticket_count', 'last_contact_at', 'open_ticket_id')
+    columns = [quote(meta.get_field(name).column) for name in names]
+    params = [
+        ticket.user_id,
+        ticket.user_name,
+        1 if ticket_created else 0,
+        meta.get_field('last_contact_at').get_db_prep_save(contact_at, connection),
+        ticket.ticket_id,
+    ]
+    count = quote('ticket_count')
+    updates = ', '.join(
+        [f'{column} = excluded.{column}' for column in map(quote, ('user_name', 'last_contact_at', 'open_ticket_id'))]
+        + [f'{count} = {table}.{count} + excluded.{count}']
+    )
+    sql = (
+        f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join(["%s"] * len(columns))}) '
+        f'ON CONFLICT ({columns[0]}) DO UPDATE SET {updates}'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def tickets_closed(tickets):
+    """Снимает отметку открытого обращения со сводок пользователей закрытых обращений"""
+    VKUserSummary.objects.filter(
+        user_id__in={ticket.user_id for ticket in tickets},
+        open_ticket_id__in=[ticket.ticket_id for ticket in tickets],
+    ).update(open_ticket_id='')
+
+
+def encode_cursor(ticket):
+    return f'{ticket.created_at.isoformat()}|{ticket.ticket_id}'
+
+
+def decode_cursor(value):
+    """(created_at, ticket_id) из параметра before; ValueError, если он испорчен"""
+    created, _, ticket_id = value.partition('|')
+    created_at = parse_datetime(created)
+    if created_at is None or not ticket_id:
+        raise ValueError(f'Invalid cursor: {value}')
+    return created_at, ticket_id
+
+
+def attach_recent_messages(tickets):
+    """
+    Последние RECENT_MESSAGES сообщений каждого обращения страницы в ticket.recent_messages,
+    по одному запросу на шард: ROW_NUMBER() OVER (PARTITION BY ticket_id), чтобы обращение
+    с длинной перепиской не вытесняло сообщения остальных
+    """
+    by_shard = defaultdict(list)
+    for ticket in tickets:
+        ticket.recent_messages = []
+        by_shard[sharding.instance_shard(ticket)].append(ticket)
+    for alias, shard_tickets in by_shard.items():
+        by_pk = {ticket.pk: ticket for ticket in shard_tickets}
+        with sharding.use_shard(alias):
+            recent = Message.objects.filter(ticket_id__in=list(by_pk)).annotate(
+                position=Window(RowNumber(), partition_by=F('ticket_id'),
+                                order_by=[F('created_at').desc(), F('pk').desc()])
+            ).filter(position__lte=RECENT_MESSAGES).order_by('created_at', 'pk')
+            for message in recent:
+                by_pk[message.ticket_id].recent_messages.append(message)
+
+
+def user_timeline(user_id, before=None, limit=TIMELINE_PAGE_SIZE):
+    """
+    Страница истории пользователя: {'summary', 'tickets', 'next'}; обращения - новые
+    первыми, с recent_messages; next - курсор следующей страницы или None
+    """
+    tickets = Ticket.objects.filter(user_id=user_id).select_related('vk_group', 'admin').order_by(
+        '-created_at', '-ticket_id'
+    )
+    if before:
+        created_at, ticket_id = decode_cursor(before)
+        tickets = tickets.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, ticket_id__lt=ticket_id))
+    page = list(sharding.merged(tickets, key=attrgetter('created_at', 'ticket_id'), reverse=True)[:limit + 1])
+    has_next = len(page) > limit
+    page = page[:limit]
+    attach_recent_messages(page)
+    return {
+        'summary': VKUserSummary.objects.filter(user_id=user_id).first(),
+        'tickets': page,
+        'next': encode_cursor(page[-1]) if has_next else None,
+    }
@@ -1,16 +1,28 @@
+import hmac
 import json
-
-from django.http import HttpResponse, JsonResponse
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from operator import attrgetter
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.conf import settings
+from django.db import DatabaseError, connection
 import logging
 from django.contrib.auth.models import Group, User
 from rest_framework import permissions, viewsets
 from rest_framework.authtoken.models import Token
 
-from project.servicedesk.event_handlers import handle_message_new
-from project.servicedesk.serializers import GroupSerializer, UserSerializer
+from project.servicedesk import admission
+from project.servicedesk.event_handlers import ahandle_message_new
+from project.servicedesk.event_queue import EVENT_HANDLERS, aenqueue, enqueue, queue_enabled
+from project.servicedesk.serializers import (
+    GroupSerializer, TicketSerializer, TimelineTicketSerializer, UserSerializer, VKUserSummarySerializer
+)
 
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -36,6 +48,73 @@ class GroupViewSet(viewsets.ModelViewSet):
 logger = logging.getLogger(__name__)
 
 
+CALLBACK_HANDLERS = EVENT_HANDLERS
+
+ASYNC_CALLBACK_HANDLERS = {
+    'message_new': ahandle_message_new,
+}
+
+
+def health(request):
+    """Проверка живости для балансировщика и оркестратора: процесс отвечает и база доступна"""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except DatabaseError:
+        logger.exception("Health check failed")
+        return JsonResponse({'status': 'unavailable'}, status=503)
+    return JsonResponse({'status': 'ok'})
+
+
+def reject(reason, response):
+    admission.count_rejection(reason)
+    return None, response
+
+
+def parse_vk_callback(request):
+    """
+    Разбирает и проверяет запрос Callback API: дешевые проверки идут до
+    логирования, чтобы мусорные запросы стоили как можно меньше.
+    Возвращает (data, response): если response не None, его нужно сразу отдать VK
+    """
+    options = admission.get_admission_settings()
+    length = admission.content_length(request)
+    if length is None:
+        return reject('no_length', HttpResponse('Length required', status=411))
+    if length > options['MAX_BODY_BYTES']:
+        return reject('too_large', HttpResponse('Request too large', status=413))
+    try:
+        data = json.loads(request.body)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return reject('invalid_json', HttpResponse('Invalid JSON', status=400))
+    if not isinstance(data, dict):
+        return reject('invalid_json', HttpResponse('Invalid JSON', status=400))
+
+    if not admission.known_group(data.get('group_id'), options['GROUPS_REFRESH_INTERVAL']):
+        return reject('unknown_group', HttpResponse('Unknown group', status=403))
+
+    # Обработка подтверждения сервера
+    event_type = data.get('type')
+    if event_type == 'confirmation':
+        return data, HttpResponse(settings.VK_CALLBACK_API['CONFIRMATION_TOKEN'])
+
+    # Проверка секретного ключа (если используется)
+    secret = settings.VK_CALLBACK_API.get('SECRET_KEY')
+    if secret and not hmac.compare_digest(str(data.get('secret', '')), secret):
+        return reject('invalid_secret', HttpResponse('Invalid secret', status=403))
+
+    # При перегрузке второстепенные события подтверждаются без обработки, иначе VK будет их повторять
+    if event_type not in options['PRIORITY_TYPES'] and admission.overloaded(options):
+        return reject('shed', HttpResponse('ok'))
+
+    logger.info("Received VK callback", extra={
+        'event_type': event_type,
+        'group_id': data.get('group_id'),
+        'payload': data,
+    })
+    return data, None
+
+
 @csrf_exempt
 @require_POST
 def vk_callback(request):
@@ -43,39 +122,54 @@ def vk_callback(request):
     Основной обработчик Callback API от VK
     """
     try:
-        data = json.loads(request.body.decode('utf-8'))
-        logger.info(f"Received VK callback data: {data}")
+        data, response = parse_vk_callback(request)
+        if response:
+            return response
+
+        # Обработка разных типов событий
+        handler = CALLBACK_HANDLERS.get(data.get('type'))
+        if handler:
+            if queue_enabled():
+                # Обработают процессы consume_events, запрос VK не ждет обработки
+                enqueue(data)
+            else:
+                # Запускаем обработчик в фоне (можно использовать celery/dramatiq)
+                started = time.monotonic()
+                handler.delay(data) if hasattr(handler, 'delay') else handler(data)
+                admission.observe(time.monotonic() - started)
 
-        # Проверка типа события
-        event_type = data.get('type')
+        # Всегда возвращаем 'ok' для VK
+        return HttpResponse('ok')
 
-        # Обработка подтверждения сервера
-        if event_type == 'confirmation':
-            return HttpResponse(settings.VK_CALLBACK_API['CONFIRMATION_TOKEN'])
+    except Exception:
+        logger.exception("Error processing callback")
+        return HttpResponse('error', status=500)
 
-        # Проверка секретного ключа (если используется)
-        if 'secret' in settings.VK_CALLBACK_API:
-            if data.get('secret') != settings.VK_CALLBACK_API['SECRET_KEY']:
-                return HttpResponse('Invalid secret', status=403)
 
-        # Обработка разных типов событий
-        handlers = {
-            'message_new': handle_message_new,
-        }
+@csrf_exempt
+@require_POST
+async def vk_callback_async(request):
+    """
+    Асинхронный обработчик Callback API для запуска под ASGI:
+    ожидание ответа VK не занимает поток воркера
+    """
+    try:
+        # Проверки групп и нагрузки обращаются к базе синхронно
+        data, response = await sync_to_async(parse_vk_callback)(request)
+        if response:
+            return response
 
-        handler = handlers.get(event_type)
+        handler = ASYNC_CALLBACK_HANDLERS.get(data.get('type'))
         if handler:
-            # Запускаем обработчик в фоне (можно использовать celery/dramatiq)
-            handler.delay(data) if hasattr(handler, 'delay') else handler(data)
+            if queue_enabled():
+                await aenqueue(data)
+            else:
+                await handler(data)
 
-        # Всегда возвращаем 'ok' для VK
         return HttpResponse('ok')
 
-    except json.JSONDecodeError:
-        logger.error("Invalid JSON received")
-        return HttpResponse('Invalid JSON', status=400)
-    except Exception as e:
-        logger.error(f"Error processing callback: {e}")
+    except Exception:
+        logger.exception("Error processing callback")
         return HttpResponse('error', status=500)
 
 
@@ -83,10 +177,24 @@ from django.contrib.auth.decorators import login_required, user_passes_test
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib import messages
 from django.core.paginator import Paginator
-from django.db.models import Q, Count
+from django.db.models import Q, Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
-from .models import Ticket, Message, Tag, VKGroup
-import requests
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from . import analytics, assignment, fragments, profiling, sharding, timeline
+from .broadcast import send_bulk_reply
+from .models import Ticket, Message, Tag, VKGroup, StatsRollup
+from .exports import EXPORT_FORMATS, export_tickets_stream
+from .filters import filter_tickets, get_ticket_filters, tag_facets, ticket_typeahead
+from .vk_api import VKAPIError, VKClient
+from .work_queue import merged_queue, pull_next
+
+WORK_QUEUE_SIZE = 50
+TICKET_API_PAGE_SIZE = 100
+PROFILES_PAGE_SIZE = 50
 
 
 def is_admin(user):
@@ -97,47 +205,40 @@ def is_admin(user):
 @user_passes_test(is_admin)
 def ticket_list(request):
     """Список обращений с фильтрами"""
-    status_filter = request.GET.get('status', '')
-    priority_filter = request.GET.get('priority', '')
-    assigned_filter = request.GET.get('assigned', '')
-    search_query = request.GET.get('q', '')
-
-    tickets = Ticket.objects.all().prefetch_related('tags')
-
-    # Применяем фильтры
-    if status_filter:
-        tickets = tickets.filter(status=status_filter)
-    if priority_filter:
-        tickets = tickets.filter(priority=priority_filter)
-    if assigned_filter == 'me':
-        tickets = tickets.filter(admin=request.user)
-    elif assigned_filter == 'unassigned':
-        tickets = tickets.filter(admin__isnull=True)
-
-    # Поиск
-    if search_query:
-        tickets = tickets.filter(
-            Q(ticket_id__icontains=search_query) |
-            Q(user_name__icontains=search_query) |
-            Q(subject__icontains=search_query) |
-            Q(messages__text__icontains=search_query)
-        ).distinct()
-
-    # Пагинация
-    paginator = Paginator(tickets.order_by('-updated_at'), 25)
+    current_filters = get_ticket_filters(request.GET)
+
+    # Количество непрочитанных считаем подзапросом, а не запросом на каждую строку
+    unread_subquery = Message.objects.filter(
+        ticket=OuterRef('pk'), is_admin=False, is_read=False
+    ).order_by().values('ticket').annotate(cnt=Count('pk')).values('cnt')
+    tickets = Ticket.objects.select_related('admin').annotate(
+        unread_count=Coalesce(Subquery(unread_subquery), 0)
+    )
+
+    # Применяем фильтры и поиск
+    tickets = filter_tickets(tickets, current_filters, request.user)
+
+    # Пагинация; с шардами страница собирается слиянием списков шардов
+    tickets = sharding.merged(tickets.order_by('-updated_at'), key=attrgetter('updated_at'), reverse=True)
+    paginator = Paginator(tickets, 25)
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
+    # Строки, не изменившиеся с прошлого рендера, берутся из кэша фрагментов
+    fragments.attach_versions(page_obj)
+    all_tags = fragments.cached_tags()
+    facets = tag_facets(current_filters, request.user)
 
     context = {
         'page_obj': page_obj,
         'status_choices': Ticket.STATUS_CHOICES,
         'priority_choices': Ticket.PRIORITY_CHOICES,
-        'current_filters': {
-            'status': status_filter,
-            'priority': priority_filter,
-            'assigned': assigned_filter,
-            'q': search_query,
-        },
+        'all_tags': all_tags,
+        'tag_facets': [(tag, facets.get(tag.pk, 0)) for tag in all_tags],
+        'fragment_timeout': fragments.get_cache_settings()['FRAGMENT_TIMEOUT'],
+        'current_filters': current_filters,
+        'filter_query': urlencode(
+            {name: value for name, value in current_filters.items() if value}, doseq=True
+        ),
         'unread_counts': get_unread_counts(),
     }
     return render(request, 'support/ticket_list.html', context)
@@ -145,11 +246,17 @@ def ticket_list(request):
 
 @login_required
 @user_passes_test(is_admin)
+@sharding.ticket_shard_view
 def ticket_detail(request, ticket_id):
     """Детальная страница обращения"""
-    ticket = get_object_or_404(Ticket.objects.prefetch_related('tags', 'messages'), ticket_id=ticket_id)
+    ticket = get_object_or_404(
+        Ticket.objects.select_related('vk_group', 'admin').prefetch_related('tags'),
+        ticket_id=ticket_id
+    )
 
     if request.method == 'POST':
+        load_before = assignment.snapshot([ticket])
+
         # Отправка ответа
         if 'response' in request.POST:
             response_text = request.POST.get('response', '').strip()
@@ -164,7 +271,7 @@ def ticket_detail(request, ticket_id):
 
                 if success:
                     # Сохраняем сообщение от администратора
-                    Message.objects.create(
+                    reply = Message.objects.create(
                         ticket=ticket,
                         text=response_text,
                         is_admin=True,
@@ -174,9 +281,11 @@ def ticket_detail(request, ticket_id):
 
                     # Обновляем статус обращения
                     ticket.status = 'answered'
+                    ticket.waiting_since = None
                     ticket.admin = request.user
                     ticket.updated_at = timezone.now()
                     ticket.save()
+                    analytics.record_reply(ticket, reply)
 
                     messages.success(request, 'Ответ успешно отправлен')
                 else:
@@ -189,7 +298,15 @@ def ticket_detail(request, ticket_id):
                 ticket.status = new_status
                 if new_status == 'closed':
                     ticket.closed_at = timezone.now()
+                # Вернувшееся в очередь обращение встает в нее по времени возврата, а не в конец
+                if new_status not in Ticket.QUEUE_STATUSES:
+                    ticket.waiting_since = None
+                elif ticket.waiting_since is None:
+                    ticket.waiting_since = timezone.now()
                 ticket.save()
+                if new_status == 'closed':
+                    analytics.record_resolved([ticket])
+                    timeline.tickets_closed([ticket])
                 messages.success(request, 'Статус обновлен')
 
         # Назначение на себя
@@ -212,13 +329,22 @@ def ticket_detail(request, ticket_id):
                 ticket.save()
                 messages.success(request, 'Приоритет обновлен')
 
+        # Переносим нагрузку, если сменились ответственный, статус или приоритет
+        assignment.rebalance(load_before, [ticket])
+
     # Помечаем сообщения пользователя как прочитанные
-    ticket.messages.filter(is_admin=False, is_read=False).update(is_read=True)
+    if ticket.messages.filter(is_admin=False, is_read=False).update(is_read=True):
+        fragments.touch_tickets([ticket.pk])
+
+    # Переписку читаем после обработки POST, чтобы в ней был только что отправленный ответ
+    ticket_messages = list(ticket.messages.select_related('admin_author'))
 
     context = {
         'ticket': ticket,
-        'messages': ticket.messages.all(),
-        'all_tags': Tag.objects.all(),
+        'messages': ticket_messages,
+        'all_tags': fragments.cached_tags(),
+        'fragment_timeout': fragments.get_cache_settings()['FRAGMENT_TIMEOUT'],
+        'shard': sharding.current_shard(),
     }
     return render(request, 'support/ticket_detail.html', context)
 
@@ -232,29 +358,270 @@ def bulk_action(request):
         action = request.POST.get('action')
 
         if ticket_ids and action:
-            tickets = Ticket.objects.filter(ticket_id__in=ticket_ids)
-
-            if action == 'assign_to_me':
-                tickets.update(admin=request.user)
-                messages.success(request, f'Назначено {len(tickets)} обращений')
-            elif action == 'change_status':
-                new_status = request.POST.get('new_status')
-                if new_status:
-                    tickets.update(status=new_status)
-                    if new_status == 'closed':
-                        tickets.update(closed_at=timezone.now())
-                    messages.success(request, f'Обновлен статус {len(tickets)} обращений')
-            elif action == 'add_tag':
-                tag_id = request.POST.get('tag_id')
-                if tag_id:
-                    tag = get_object_or_404(Tag, id=tag_id)
-                    for ticket in tickets:
-                        ticket.tags.add(tag)
-                    messages.success(request, f'Добавлен тег к {len(tickets)} обращениям')
+            # Выбранные обращения могут лежать в разных шардах
+            done = Counter()
+            for _ in sharding.for_each_shard():
+                done.update(apply_bulk_action(request, Ticket.objects.filter(ticket_id__in=ticket_ids), action))
+
+            if 'assigned' in done:
+                messages.success(request, f'Назначено {done["assigned"]} обращений')
+            if 'status_changed' in done:
+                messages.success(request, f'Обновлен статус {done["status_changed"]} обращений')
+            if 'tagged' in done:
+                messages.success(request, f'Добавлен тег к {done["tagged"]} обращениям')
+            if done['answered']:
+                messages.success(request, f'Ответ отправлен в {done["answered"]} обращений')
+            if done['failed']:
+                messages.error(request, f'Не удалось отправить ответ в {done["failed"]} обращений')
 
     return redirect('ticket_list')
 
 
+def apply_bulk_action(request, tickets, action):
+    """Массовое действие над обращениями текущего шарда; возвращает счетчики для сообщений"""
+    if action in ('assign_to_me', 'change_status'):
+        # Состояние до изменения нужно для пересчета нагрузки и аналитики
+        affected = list(tickets.only(
+            'pk', 'ticket_id', 'user_id', 'status', 'priority', 'load_weight', 'created_at', 'vk_group_id',
+            'admin_id', 'waiting_since'
+        ))
+        load_before = assignment.snapshot(affected)
+
+    if action == 'assign_to_me':
+        updated = tickets.update(admin=request.user)
+        for ticket in affected:
+            ticket.admin_id = request.user.pk
+        assignment.rebalance(load_before, affected)
+        fragments.touch_tickets([ticket.pk for ticket in affected])
+        return {'assigned': updated}
+    elif action == 'change_status':
+        new_status = request.POST.get('new_status')
+        if new_status:
+            now = timezone.now()
+            changes = {'status': new_status}
+            closing = []
+            if new_status == 'closed':
+                changes['closed_at'] = now
+                closing = [ticket for ticket in affected if ticket.status != 'closed']
+            if new_status in Ticket.QUEUE_STATUSES:
+                changes['waiting_since'] = Coalesce('waiting_since', Value(now))
+            else:
+                changes['waiting_since'] = None
+            updated = tickets.update(**changes)
+            for ticket in affected:
+                ticket.status = new_status
+                ticket.waiting_since = (ticket.waiting_since or now) if new_status in Ticket.QUEUE_STATUSES else None
+            assignment.rebalance(load_before, affected)
+            fragments.touch_tickets([ticket.pk for ticket in affected])
+            for ticket in closing:
+                ticket.closed_at = changes['closed_at']
+            if closing:
+                analytics.record_resolved(closing)
+                timeline.tickets_closed(closing)
+            return {'status_changed': updated}
+    elif action == 'add_tag':
+        tag_id = request.POST.get('tag_id')
+        if tag_id:
+            tag = get_object_or_404(Tag, id=tag_id)
+            # Одна вставка в связующую таблицу вместо add() на каждое обращение
+            TicketTags = Ticket.tags.through
+            links = [TicketTags(ticket_id=pk, tag_id=tag.pk)
+                     for pk in tickets.values_list('pk', flat=True)]
+            TicketTags.objects.bulk_create(links, ignore_conflicts=True)
+            return {'tagged': len(links)}
+    elif action == 'reply':
+        reply_text = request.POST.get('reply_text', '').strip()
+        if reply_text:
+            answered, failed = send_bulk_reply(tickets, reply_text, request.user)
+            return {'answered': answered, 'failed': failed}
+    return {}
+
+
+@login_required
+@user_passes_test(is_admin)
+def export_tickets(request):
+    """Потоковая выгрузка обращений с перепиской (CSV или JSONL) с фильтрами списка"""
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return HttpResponse('Unknown format', status=400)
+
+    tickets = filter_tickets(Ticket.objects.all(), get_ticket_filters(request.GET), request.user)
+    content_type, extension = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(
+        export_tickets_stream(tickets, export_format),
+        content_type=content_type
+    )
+    filename = f"tickets-{timezone.now():%Y%m%d-%H%M}.{extension}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@login_required
+@user_passes_test(is_admin)
+def work_queue(request):
+    """Очередь работы: срочные и дольше всех ожидающие обращения первыми"""
+    if request.method == 'POST':
+        ticket = pull_next(request.user)
+        if ticket:
+            return redirect('ticket_detail', ticket_id=ticket.ticket_id)
+        messages.info(request, 'Очередь пуста')
+        return redirect('work_queue')
+
+    context = {
+        'tickets': merged_queue(request.user)[:WORK_QUEUE_SIZE],
+    }
+    return render(request, 'support/work_queue.html', context)
+
+
+@login_required
+@user_passes_test(is_admin)
+def user_timeline(request, user_id):
+    """История пользователя ВК: сводка и все его обращения во всех группах, новые первыми"""
+    try:
+        page = timeline.user_timeline(user_id, before=request.GET.get('before'))
+    except ValueError:
+        return redirect('user_timeline', user_id=user_id)
+    context = {'user_id': user_id, **page}
+    return render(request, 'support/user_timeline.html', context)
+
+
+@login_required
+@user_passes_test(is_admin)
+def profiles(request):
+    """Самые медленные снимки профилирования с топом функций и SQL"""
+    context = {
+        'profiles': profiling.load_profiles()[:PROFILES_PAGE_SIZE],
+        'options': profiling.get_profiling_settings(),
+    }
+    return render(request, 'support/profiles.html', context)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def work_queue_api(request):
+    """Первые обращения очереди текущего оператора; limit - до WORK_QUEUE_SIZE"""
+    try:
+        limit = min(int(request.query_params.get('limit', WORK_QUEUE_SIZE)), WORK_QUEUE_SIZE)
+    except ValueError:
+        raise ValidationError('limit должен быть числом')
+    tickets = merged_queue(request.user)[:limit]
+    return Response(TicketSerializer(tickets, many=True).data)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def ticket_list_api(request):
+    """
+    Обращения с фильтрами списка (включая tag и tag_mode=any|all) и счетчиками
+    по тегам для этих фильтров; limit - до TICKET_API_PAGE_SIZE, offset - сдвиг
+    (с шардами offset + limit не больше sharding.MAX_MERGED_ROWS)
+    """
+    try:
+        limit = min(int(request.query_params.get('limit', TICKET_API_PAGE_SIZE)), TICKET_API_PAGE_SIZE)
+        offset = max(int(request.query_params.get('offset', 0)), 0)
+    except ValueError:
+        raise ValidationError('limit и offset должны быть числами')
+    if sharding.is_sharded() and offset + limit > sharding.MAX_MERGED_ROWS:
+        # Сдвиг по слиянию шардов читает offset строк из каждого шарда
+        raise ValidationError(
+            f'С шардами доступны первые {sharding.MAX_MERGED_ROWS} обращений, сузьте выборку фильтрами'
+        )
+
+    filters = get_ticket_filters(request.query_params)
+    tickets = filter_tickets(Ticket.objects.select_related('admin'), filters, request.user)
+    tickets = sharding.merged(
+        tickets.order_by('-updated_at', '-pk'), key=attrgetter('updated_at', 'pk'), reverse=True
+    )
+    facets = tag_facets(filters, request.user)
+    return Response({
+        'results': TicketSerializer(tickets[offset:offset + limit], many=True).data,
+        'tags': [
+            {'id': tag.pk, 'name': tag.name, 'count': facets.get(tag.pk, 0)}
+            for tag in fragments.cached_tags()
+        ],
+    })
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def ticket_typeahead_api(request):
+    """Подсказки для поля поиска по части имени пользователя или номера обращения (q)"""
+    return Response({'results': ticket_typeahead(request.query_params.get('q', ''))})
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def user_timeline_api(request, user_id):
+    """
+    История пользователя ВК: сводка, обращения с последними сообщениями и курсор
+    next для следующей страницы (параметр before); limit - до TIMELINE_PAGE_SIZE
+    """
+    try:
+        limit = min(int(request.query_params.get('limit', timeline.TIMELINE_PAGE_SIZE)), timeline.TIMELINE_PAGE_SIZE)
+        page = timeline.user_timeline(user_id, before=request.query_params.get('before'), limit=max(limit, 1))
+    except ValueError:
+        raise ValidationError('limit должен быть числом, before - курсором из next')
+    return Response({
+        'summary': VKUserSummarySerializer(page['summary']).data if page['summary'] else None,
+        'results': TimelineTicketSerializer(page['tickets'], many=True).data,
+        'next': page['next'],
+    })
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAdminUser])
+def work_queue_next_api(request):
+    """Забирает следующее обращение из очереди и назначает его на текущего оператора"""
+    ticket = pull_next(request.user)
+    if ticket is None:
+        return Response(status=204)
+    return Response(TicketSerializer(ticket).data)
+
+
+def parse_period(params, default_days=30):
+    """Период отчета из параметров start/end (дата или дата-время), по умолчанию последние дни"""
+    end = parse_moment(params.get('end')) or timezone.now()
+    start = parse_moment(params.get('start')) or end - timedelta(days=default_days)
+    return start, end
+
+
+def parse_moment(value):
+    if not value:
+        return None
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValidationError(f'Некорректная дата: {value}')
+        moment = datetime.combine(day, datetime.min.time())
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def analytics_report(request):
+    """
+    Отчет по нагрузке и SLA из почасовых агрегатов.
+    Параметры: dimension (all/group/operator/tag), dimension_id, start, end, series=hourly
+    """
+    dimension = request.query_params.get('dimension', StatsRollup.ALL)
+    if dimension not in dict(StatsRollup.DIMENSION_CHOICES):
+        raise ValidationError(f'Неизвестный срез: {dimension}')
+    try:
+        dimension_id = int(request.query_params['dimension_id']) if request.query_params.get('dimension_id') else None
+    except ValueError:
+        raise ValidationError('dimension_id должен быть числом')
+    start, end = parse_period(request.query_params)
+
+    if request.query_params.get('series') == 'hourly':
+        rows = analytics.hourly_volume(dimension, start, end, dimension_id or 0)
+    else:
+        rows = analytics.report(dimension, start, end, dimension_id)
+    return Response({'dimension': dimension, 'start': start, 'end': end, 'results': rows})
+
+
 @login_required
 def go_to_main(request):
     return redirect('ticket_list')
@@ -265,36 +632,26 @@ def go_login(request):
 
 
 def get_unread_counts():
-    """Получение количества непрочитанных сообщений по статусам"""
-    return {
-        'open': Ticket.objects.filter(status='open').count(),
-        'answered': Ticket.objects.filter(status='answered').count(),
-        'waiting': Ticket.objects.filter(status='waiting').count(),
-        'total_unread': Message.objects.filter(is_admin=False, is_read=False).count(),
-    }
+    """Получение количества непрочитанных сообщений по статусам (сумма по шардам)"""
+    counts = Counter()
+    for _ in sharding.for_each_shard():
+        counts.update(Ticket.objects.aggregate(
+            open=Count('pk', filter=Q(status='open')),
+            answered=Count('pk', filter=Q(status='answered')),
+            waiting=Count('pk', filter=Q(status='waiting')),
+        ))
+        counts['total_unread'] += Message.objects.filter(is_admin=False, is_read=False).count()
+    return dict(counts)
 
 
 def send_vk_message(user_id, text, access_token):
     """Отправка сообщения через API ВКонтакте"""
-    url = 'https://api.vk.com/method/messages.send'
-
-    params = {
-        'user_id': user_id,
-        'message': text,
-        'access_token': access_token,
-        'v': '5.131',
-        'random_id': 0
-    }
-
     try:
-        response = requests.post(url, params=params)
-        data = response.json()
-
-        if 'error' in data:
-            print(f"VK API Error: {data['error']}")
-            return False
-
+        VKClient(access_token).call('messages.send', user_id=user_id, message=text, random_id=0)
         return True
-    except Exception as e:
-        print(f"Error sending message: {e}")
+    except VKAPIError as e:
+        logger.warning("VK API error", extra={'vk_error': e.error})
+        return False
+    except Exception:
+        logger.exception("Error sending message")
         return False
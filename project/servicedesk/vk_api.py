@@ -0,0 +1,411 @@
+"""
+Клиенты VK API: синхронный на requests.Session и асинхронный на httpx
+с общим пулом соединений на event loop.
+
+Вызовы склеиваются в execute (до EXECUTE_MAX_CALLS методов за запрос):
+явно - в контексте VKClient.batch(), и автоматически (AUTO_BATCH) - вызовы
+одного токена из разных потоков, сделанные, пока предыдущий запрос токена
+в полете, и вызовы из корутин одной итерации event loop. Одиночный вызов
+уходит сразу, полная пачка - не дожидаясь остальных. Результаты и ошибки
+отдельных методов возвращаются каждому вызывающему.
+"""
+import asyncio
+import json
+import threading
+from concurrent.futures import Future
+import time
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+
+API_URL = 'https://api.vk.com/method/'
+
+# Максимум вызовов API внутри одного execute
+EXECUTE_MAX_CALLS = 25
+
+# Максимум получателей в одном вызове messages.send с peer_ids
+SEND_PEERS_PER_CALL = 100
+
+
+def get_api_settings():
+    """Настройки клиента с значениями по умолчанию"""
+    options = {
+        'API_URL': API_URL,
+        'VERSION': '5.199',
+        # Вызовов в секунду на один токен (лимит VK для ключа сообщества - 20)
+        'RATE_LIMIT': 20,
+        'TIMEOUT': 10,
+        'MAX_CONNECTIONS': 200,
+        'MAX_KEEPALIVE_CONNECTIONS': 50,
+        # Автоматическая склейка одновременных вызовов в execute (False - каждый вызов отдельным запросом)
+        'AUTO_BATCH': True,
+    }
+    options.update(getattr(settings, 'VK_API', {}))
+    return options
+
+
+class VKAPIError(Exception):
+    """Ошибка, которую вернул VK API в поле error"""
+
+    def __init__(self, error):
+        self.error = error
+        self.code = error.get('error_code')
+        self.msg = error.get('error_msg', '')
+        super().__init__(f"[{self.code}] {self.msg}")
+
+
+def unwrap(method, data):
+    """Возвращает поле response ответа или выбрасывает VKAPIError"""
+    if 'error' in data:
+        raise VKAPIError(data['error'])
+    if 'response' not in data:
+        raise VKAPIError({'error_code': None, 'error_msg': f'Unexpected answer for {method}'})
+    return data['response']
+
+
+class RateLimiter:
+    """
+    Равномерно распределяет вызовы: не чаще rate в секунду.
+    reserve() резервирует слот и возвращает, сколько секунд подождать до него
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        return slot - now
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(access_token):
+    """Общий для процесса ограничитель на токен; None, если лимит отключен"""
+    rate = get_api_settings()['RATE_LIMIT']
+    if not rate:
+        return None
+    with _limiters_lock:
+        if access_token not in _limiters:
+            _limiters[access_token] = RateLimiter(rate)
+        return _limiters[access_token]
+
+
+def execute_code(calls):
+    """VKScript для execute: массив результатов вызовов [(method, params, ...)] в исходном порядке"""
+    return 'return [' + ','.join(
+        f'API.{method}({json.dumps(params, ensure_ascii=False)})' for method, params, *_ in calls
+    ) + '];'
+
+
+def execute_results(calls, data):
+    """
+    Разбирает ответ execute: результат или VKAPIError на каждый вызов.
+    Упавший метод возвращает false, а его ошибка идет следующей в execute_errors
+    """
+    if 'error' in data:
+        return [VKAPIError(data['error'])] * len(calls)
+    response = data.get('response') or []
+    errors = iter(data.get('execute_errors', []))
+    results = []
+    for index, (method, *_) in enumerate(calls):
+        result = response[index] if index < len(response) else False
+        if result is False:
+            result = VKAPIError(next(errors, {'error_code': None, 'error_msg': f'{method} failed in execute'}))
+        results.append(result)
+    return results
+
+
+def batch_request(chunk):
+    """Запрос для пачки вызовов: сам метод, если он один, иначе execute"""
+    if len(chunk) == 1:
+        method, params, _ = chunk[0]
+        return method, params
+    return 'execute', {'code': execute_code(chunk)}
+
+
+def batch_outcomes(chunk, data):
+    if len(chunk) == 1:
+        try:
+            return [unwrap(chunk[0][0], data)]
+        except VKAPIError as e:
+            return [e]
+    return execute_results(chunk, data)
+
+
+def settle(chunk, outcomes):
+    """Передает результаты и ошибки в futures вызывающих"""
+    for (_, _, future), outcome in zip(chunk, outcomes):
+        if future.done():
+            continue
+        if isinstance(outcome, Exception):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+
+
+def split_calls(calls):
+    return [calls[start:start + EXECUTE_MAX_CALLS] for start in range(0, len(calls), EXECUTE_MAX_CALLS)]
+
+
+def run_batch(client, calls):
+    """Выполняет вызовы [(method, params, future)] пачками через execute"""
+    for chunk in split_calls(calls):
+        method, params = batch_request(chunk)
+        try:
+            outcomes = batch_outcomes(chunk, client.request(method, params))
+        except Exception as e:
+            outcomes = [e] * len(chunk)
+        settle(chunk, outcomes)
+
+
+async def arun_batch(client, calls):
+    """Асинхронный run_batch: пачки отправляются одновременно"""
+    async def run_chunk(chunk):
+        method, params = batch_request(chunk)
+        try:
+            outcomes = batch_outcomes(chunk, await client.request(method, params))
+        except Exception as e:
+            outcomes = [e] * len(chunk)
+        settle(chunk, outcomes)
+
+    await asyncio.gather(*(run_chunk(chunk) for chunk in split_calls(calls)))
+
+
+class VKBatch:
+    """Явная пачка: вызовы копятся и выполняются через execute при выходе из контекста"""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def call(self, method, **params):
+        """Ставит вызов в пачку, возвращает Future с его результатом"""
+        future = Future()
+        self.calls.append((method, params, future))
+        return future
+
+    def flush(self):
+        calls, self.calls = self.calls, []
+        run_batch(self.client, calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            for _, _, future in self.calls:
+                future.cancel()
+
+
+class CallWindow:
+    """
+    Склейка вызовов одного токена и сессии из разных потоков. Если запросов
+    в полете нет, вызов уходит сразу; пока запрос в полете, новые вызовы ждут
+    и уходят следующей пачкой с первым освободившимся потоком. Набравшиеся
+    EXECUTE_MAX_CALLS вызовов отправляются сразу, параллельно с текущим запросом
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pending = []
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def submit(self, method, params):
+        future = Future()
+        with self.condition:
+            self.pending.append((method, params, future))
+            while not future.done():
+                if self.in_flight and len(self.pending) < EXECUTE_MAX_CALLS:
+                    self.condition.wait()
+                    continue
+                calls = self.pending[:EXECUTE_MAX_CALLS]
+                del self.pending[:EXECUTE_MAX_CALLS]
+                self.in_flight += 1
+                self.condition.release()
+                try:
+                    run_batch(self.client, calls)
+                finally:
+                    self.condition.acquire()
+                    self.in_flight -= 1
+                    self.condition.notify_all()
+        return future.result()
+
+
+_windows = {}
+_windows_lock = threading.Lock()
+
+
+def get_call_window(client):
+    """Общее для процесса окно склейки токена и сессии клиента; None, если склейка отключена"""
+    if not client.options['AUTO_BATCH']:
+        return None
+    key = (client.access_token, client.session)
+    with _windows_lock:
+        if key not in _windows:
+            _windows[key] = CallWindow(client)
+        return _windows[key]
+
+
+class VKClient:
+    """Синхронный клиент; соединения переиспользуются через общую сессию"""
+
+    _session = None
+
+    def __init__(self, access_token, session=None):
+        self.access_token = access_token
+        self.options = get_api_settings()
+        self.session = session or self.get_session()
+
+    @classmethod
+    def get_session(cls):
+        if cls._session is None:
+            cls._session = requests.Session()
+        return cls._session
+
+    def call(self, method, **params):
+        window = get_call_window(self) if method != 'execute' else None
+        if window:
+            return window.submit(method, params)
+        return unwrap(method, self.request(method, params))
+
+    def request(self, method, params):
+        """Один HTTP-запрос к API с учетом лимита частоты; возвращает ответ целиком"""
+        params = {'access_token': self.access_token, 'v': self.options['VERSION'], **params}
+        limiter = get_rate_limiter(self.access_token)
+        if limiter:
+            delay = limiter.reserve()
+            if delay > 0:
+                time.sleep(delay)
+        response = self.session.post(
+            self.options['API_URL'] + method, data=params, timeout=self.options['TIMEOUT']
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def batch(self):
+        """Контекст явной пачки вызовов: with client.batch() as batch: future = batch.call(...)"""
+        return VKBatch(self)
+
+    def send_many(self, peer_ids, message, **params):
+        """Одно сообщение нескольким получателям (не больше SEND_PEERS_PER_CALL) одним вызовом"""
+        return delivered_peers(self.call('messages.send', **send_many_params(peer_ids, message, **params)))
+
+
+def send_many_params(peer_ids, message, **params):
+    """Параметры messages.send для нескольких получателей"""
+    if len(peer_ids) > SEND_PEERS_PER_CALL:
+        raise ValueError(f'messages.send accepts at most {SEND_PEERS_PER_CALL} peer_ids')
+    params.setdefault('random_id', 0)
+    return {'peer_ids': ','.join(str(peer_id) for peer_id in peer_ids), 'message': message, **params}
+
+
+def delivered_peers(result):
+    """{peer_id: message_id} доставленных из ответа messages.send с peer_ids; ошибки получателей пропускаются"""
+    return {item['peer_id']: item.get('message_id') for item in result if 'error' not in item}
+
+
+# Пул httpx привязан к event loop, в котором созданы его соединения
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client():
+    """Общий httpx.AsyncClient текущего event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        options = get_api_settings()
+        client = httpx.AsyncClient(
+            base_url=options['API_URL'],
+            timeout=options['TIMEOUT'],
+            limits=httpx.Limits(
+                max_connections=options['MAX_CONNECTIONS'],
+                max_keepalive_connections=options['MAX_KEEPALIVE_CONNECTIONS'],
+            ),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+class AsyncCallWindow:
+    """
+    Склейка вызовов одного токена и HTTP-клиента из корутин event loop: пачка
+    уходит на следующей итерации цикла или сразу, когда набралось EXECUTE_MAX_CALLS
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pending = []
+        self.tasks = set()
+
+    async def submit(self, method, params):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((method, params, future))
+        if len(self.pending) >= EXECUTE_MAX_CALLS:
+            self.flush()
+        elif len(self.pending) == 1:
+            loop.call_soon(self.flush)
+        return await future
+
+    def flush(self):
+        calls, self.pending = self.pending, []
+        if not calls:
+            return
+        task = asyncio.ensure_future(arun_batch(self.client, calls))
+        # Ссылка на задачу, чтобы ее не собрал сборщик мусора до завершения
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+_async_windows = weakref.WeakKeyDictionary()
+
+
+def get_async_call_window(client):
+    """Окно склейки токена и HTTP-клиента в текущем event loop; None, если склейка отключена"""
+    if not client.options['AUTO_BATCH']:
+        return None
+    windows = _async_windows.setdefault(asyncio.get_running_loop(), {})
+    key = (client.access_token, client.http_client)
+    if key not in windows:
+        windows[key] = AsyncCallWindow(client)
+    return windows[key]
+
+
+class AsyncVKClient:
+    """Асинхронный клиент: одновременно в полете может быть до MAX_CONNECTIONS вызовов"""
+
+    def __init__(self, access_token, http_client=None):
+        self.access_token = access_token
+        self.options = get_api_settings()
+        self.http_client = http_client
+
+    async def call(self, method, **params):
+        window = get_async_call_window(self) if method != 'execute' else None
+        if window:
+            return await window.submit(method, params)
+        return unwrap(method, await self.request(method, params))
+
+    async def request(self, method, params):
+        """Один HTTP-запрос к API с учетом лимита частоты; возвращает ответ целиком"""
+        params = {'access_token': self.access_token, 'v': self.options['VERSION'], **params}
+        limiter = get_rate_limiter(self.access_token)
+        if limiter:
+            delay = limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        http_client = self.http_client or get_async_http_client()
+        response = await http_client.post(method, data=params)
+        response.raise_for_status()
+        return response.json()
@@ -0,0 +1,68 @@
+"""
+Очередь работы операторов: сначала самые срочные обращения, среди них -
+дольше всех ожидающие ответа. Порядок совпадает с частичным индексом
+ticket_work_queue, поэтому выборка следующего обращения идет по индексу.
+С шардами очереди шардов сливаются в одну по тому же порядку.
+"""
+from django.db.models import Q
+
+from . import assignment, sharding
+from .models import Ticket
+
+QUEUE_ORDER = ('-priority_rank', 'waiting_since', 'id')
+
+
+def queue_key(ticket):
+    """Ключ сортировки в порядке QUEUE_ORDER (пустой waiting_since - в конце, как в PostgreSQL)"""
+    return -ticket.priority_rank, ticket.waiting_since is None, ticket.waiting_since, ticket.pk
+
+
+def queue_tickets(user=None):
+    """Обращения текущего шарда, ожидающие оператора; с user - только его и неназначенные"""
+    tickets = Ticket.objects.filter(status__in=Ticket.QUEUE_STATUSES)
+    if user is not None:
+        tickets = tickets.filter(Q(admin__isnull=True) | Q(admin=user))
+    return tickets.order_by(*QUEUE_ORDER)
+
+
+def merged_queue(user=None):
+    """Очередь по всем шардам: queryset или ShardedList, поддерживает срезы"""
+    return sharding.merged(queue_tickets(user).select_related('admin'), key=queue_key)
+
+
+def pull_next(user):
+    """
+    Забирает первое обращение очереди, доступное пользователю, и назначает его на него.
+    С шардами шарды перебираются в порядке их первых обращений
+    """
+    if not sharding.is_sharded():
+        return claim_next(user)
+    heads = []
+    for alias in sharding.for_each_shard():
+        head = queue_tickets(user).first()
+        if head is not None:
+            heads.append((queue_key(head), alias))
+    for _, alias in sorted(heads):
+        with sharding.use_shard(alias):
+            ticket = claim_next(user)
+        if ticket is not None:
+            return ticket
+    return None
+
+
+def claim_next(user):
+    """
+    Назначает первое обращение очереди текущего шарда на пользователя.
+    Обращения, которые в этот момент забирают другие операторы, пропускаются
+    """
+    with sharding.atomic():
+        pk = queue_tickets(user).select_for_update(skip_locked=True).values_list('pk', flat=True).first()
+        if pk is None:
+            return None
+        ticket = Ticket.objects.get(pk=pk)
+        if ticket.admin_id != user.pk:
+            load_before = assignment.snapshot([ticket])
+            ticket.admin = user
+            ticket.save()
+            assignment.rebalance(load_before, [ticket])
+    return ticket
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,10 +45,14 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Статика (в том числе админки) из STATIC_ROOT прямо из воркеров gunicorn
+    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'project.servicedesk.middleware.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'project.servicedesk.middleware.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -71,6 +76,34 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'project.wsgi.application'
 
+# Кэш фрагментов шаблонов, справочников и общих счетчиков (флуд, отказы callback).
+# serve запускает несколько процессов, им нужен общий Redis: адрес задает
+# переменная окружения REDIS_URL (redis://host:6379/0). Без нее - кэш в памяти
+# процесса, годится только для разработки в одном процессе
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'servicedesk',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'servicedesk',
+        }
+    }
+
+SERVICEDESK_CACHE = {
+    'FRAGMENT_TIMEOUT': 3600,
+    'TAGS_TIMEOUT': 300,
+    'FACETS_TIMEOUT': 60,
+    'TYPEAHEAD_TIMEOUT': 30,
+}
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
@@ -85,6 +118,29 @@ DATABASES = {
     }
 }
 
+# Роутеры баз: сначала шарды обращений по сообществам, затем реплики для чтения
+DATABASE_ROUTERS = [
+    'project.servicedesk.sharding.ShardRouter',
+    'project.servicedesk.routers.ReplicaRouter',
+]
+
+# Алиасы DATABASES для выделенных шардов обращений (VKGroup.shard). Шард -
+# отдельная база или схема PostgreSQL той же базы, например
+# 'OPTIONS': {'options': '-c search_path=big_group,public'}; таблицы создаются
+# командой migrate --database <алиас>, данные переносит move_group_shard
+SERVICEDESK_SHARDS = []
+
+# Реплики для чтения: алиасы из DATABASES с теми же данными, что у default
+# (например, 'replica': {..., 'TEST': {'MIRROR': 'default'}}). Чтения уходят на
+# реплики только в запросах на чтение; после записи пользователь STICKY_SECONDS
+# читает из основной базы
+SERVICEDESK_REPLICAS = {
+    'ALIASES': [],
+    'STICKY_SECONDS': 5,
+    'MAX_LAG_SECONDS': 10,
+    'LAG_CHECK_INTERVAL': 5,
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -119,6 +175,18 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Сюда collectstatic собирает статику при сборке образа, отдает ее WhiteNoise
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'whitenoise.storage.CompressedStaticFilesStorage',
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -135,3 +203,115 @@ VK_CALLBACK_API = {
     'ACCESS_TOKEN': 'vk1.a.zuNR-iZizPBZyrg7VLy-v8i7MU6NhQkMmyX9iYNNTcLAzY7DUbqA_9aOhXZn9OK2S3t7-FtUZFfRW_GIFaIJ2v-l-TxCI5YgI03uViY-Ui2CeQ501N_NxuGD9pnyRmX_YpSzNPxiikF_7482XyTWSeiMNDN7nATNx7prQQnlJincCvICAr-9pYEiAI16iQkoPF1RBQ03KcNxw8oUTxw94w',
     'GROUP_ID': '195265134',
 }
+
+# Клиент VK API: адрес (можно указать локальную заглушку), лимит вызовов на токен
+# пул соединений асинхронного клиента и склейка одновременных вызовов в execute
+VK_API = {
+    'API_URL': 'https://api.vk.com/method/',
+    'VERSION': '5.199',
+    'RATE_LIMIT': 20,
+    'TIMEOUT': 10,
+    'MAX_CONNECTIONS': 200,
+    'MAX_KEEPALIVE_CONNECTIONS': 50,
+    'AUTO_BATCH': True,
+}
+
+# Автоматическое распределение новых обращений по наименее загруженным операторам
+SERVICEDESK_ASSIGNMENT = {
+    'ENABLED': True,
+    'PRIORITY_WEIGHTS': {'low': 1, 'medium': 2, 'high': 3, 'critical': 5},
+    'TAG_WEIGHTS': {},
+}
+
+# Обслуживание: автозакрытие простаивающих обращений и сроки хранения переписки
+SERVICEDESK_MAINTENANCE = {
+    'AUTO_CLOSE_AFTER_DAYS': {'answered': 7},
+    'MESSAGE_RETENTION_DAYS': None,
+    'ATTACHMENT_RETENTION_DAYS': None,
+    'BATCH_SIZE': 500,
+    'BATCH_PAUSE': 0.1,
+}
+
+# Очередь входящих событий VK: при QUEUE=True Callback API только сохраняет
+# события, а обрабатывает их команда consume_events пулом из WORKERS процессов;
+# события одного собеседника обрабатываются по порядку в своей партиции
+SERVICEDESK_EVENTS = {
+    'QUEUE': False,
+    'PARTITIONS': 64,
+    'WORKERS': 4,
+    'BATCH_SIZE': 100,
+    'LEASE_SECONDS': 30,
+    'POLL_INTERVAL': 0.5,
+    'MAX_ATTEMPTS': 5,
+    'METRICS_INTERVAL': 60,
+    'COALESCE_WINDOW': 1,
+    'FLOOD_LIMIT': 30,
+    'FLOOD_PERIOD': 60,
+}
+
+# Профилирование по требованию: доля запросов и событий или заголовок от сотрудника
+SERVICEDESK_PROFILING = {
+    'SAMPLE_RATE': 0,
+    'HEADER': 'X-Servicedesk-Profile',
+    'DIRECTORY': BASE_DIR / 'profiles',
+    'MAX_PROFILES': 200,
+    'TOP_FUNCTIONS': 25,
+    'TOP_QUERIES': 25,
+}
+
+# Боевой сервер (manage.py serve): gunicorn с предзагрузкой приложения
+SERVICEDESK_SERVER = {
+    'BIND': '0.0.0.0:8000',
+    'WORKERS': 4,
+    'THREADS': 1,
+    'ASGI': False,
+    'MAX_REQUESTS': 1000,
+    'MAX_REQUESTS_JITTER': 100,
+    'TIMEOUT': 30,
+    'GRACEFUL_TIMEOUT': 30,
+    'KEEPALIVE': 5,
+}
+
+# Допуск запросов Callback API: лимит тела и сброс второстепенных событий при перегрузке
+SERVICEDESK_ADMISSION = {
+    'MAX_BODY_BYTES': 64 * 1024,
+    'PRIORITY_TYPES': ['message_new'],
+    'SHED_QUEUE_DEPTH': 10000,
+    'SHED_LATENCY': 10,
+    'LOAD_CHECK_INTERVAL': 2,
+    'GROUPS_REFRESH_INTERVAL': 60,
+}
+
+# Логи пишутся в JSON фоновым потоком; события message_new логируются выборочно
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'project.servicedesk.logutils.JsonFormatter',
+            'max_length': 2000,
+        },
+    },
+    'filters': {
+        'event_sampling': {
+            '()': 'project.servicedesk.logutils.EventSamplingFilter',
+            'rates': {'message_new': 0.1},
+            'default_rate': 1.0,
+        },
+    },
+    'handlers': {
+        'background': {
+            '()': 'project.servicedesk.logutils.BackgroundQueueHandler',
+            'maxsize': 10000,
+            'formatter': 'json',
+            'filters': ['event_sampling'],
+        },
+    },
+    'loggers': {
+        'project.servicedesk': {
+            'handlers': ['background'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
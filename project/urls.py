@@ -28,12 +28,24 @@ router.register(r"groups", views.GroupViewSet)
 
 urlpatterns = [
     path('', views.ticket_list, name='ticket_list'),
+    path('queue/', views.work_queue, name='work_queue'),
+    path('api/tickets/', views.ticket_list_api, name='ticket_list_api'),
+    path('api/tickets/typeahead/', views.ticket_typeahead_api, name='ticket_typeahead_api'),
+    path('api/users/<int:user_id>/timeline/', views.user_timeline_api, name='user_timeline_api'),
+    path('api/queue/', views.work_queue_api, name='work_queue_api'),
+    path('api/queue/next/', views.work_queue_next_api, name='work_queue_next_api'),
+    path('tickets/export/', views.export_tickets, name='export_tickets'),
     path('tickets/bulk-action/', views.bulk_action, name='bulk_action'),
     path('tickets/<str:ticket_id>/', views.ticket_detail, name='ticket_detail'),
+    path('users/<int:user_id>/', views.user_timeline, name='user_timeline'),
+    path('profiles/', views.profiles, name='profiles'),
+    path('api/analytics/', views.analytics_report, name='analytics_report'),
     path('accounts/login/', views.go_login, name="go_login"),
     path('accounts/profile/', views.go_to_main, name="redirect_to_main"),
     path('admin/', admin.site.urls),
     # path("api/", include(router.urls)),
     path("auth/", include("rest_framework.urls", namespace="rest_framework")),
+    path('health/', views.health, name='health'),
     path('vk/callback/', views.vk_callback, name='vk_callback'),
+    path('vk/callback/async/', views.vk_callback_async, name='vk_callback_async'),
 ]